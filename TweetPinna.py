@@ -15,131 +15,771 @@ Example:
     $ python TweetPinna.py config.cfg
 """
 
-from email.mime.text import MIMEText
 from pymongo import errors
-from pymongo import MongoClient
-from time import sleep
+from TweetPinnaAggregates import Aggregates
+from TweetPinnaAlerts import AlertDispatcher
+from TweetPinnaIngest import BulkWriter
+from TweetPinnaIngest import enrich_tweet
+from TweetPinnaIngest import ENRICHMENT_FIELD
+from TweetPinnaIngest import ensure_enrichment_indexes
+from TweetPinnaIngest import ensure_indexes
+from TweetPinnaIngest import IngestQueue
+from TweetPinnaIngest import MongoConnection
+from TweetPinnaIngest import OverloadPolicy
+from TweetPinnaIngest import parse_raw_status
+from TweetPinnaIngest import RecentIdFilter
+from TweetPinnaIngest import STAGE_SECONDS
+from TweetPinnaIngest import TWEETS
+from TweetPinnaMatcher import TermMatcher
+from TweetPinnaMedia import create_media_manifest
+from TweetPinnaMediaQueue import MediaDownloadQueue
+from TweetPinnaMetrics import MetricsServer
+from TweetPinnaMetrics import registry
+from TweetPinnaSpool import TweetSpool
+from TweetPinnaUsers import UserStore
+import atexit
+import collections
 import config
-import datetime
 import os
+import queue
 import signal
-import smtplib
-import subprocess
 import sys
-import _thread
+import threading
 import time
 import tweepy
 
+STREAM_MESSAGES = registry.counter(
+    'tweetpinna_stream_messages_total', 'Messages received from the stream')
+STREAM_BYTES = registry.counter(
+    'tweetpinna_stream_bytes_total', 'Bytes received from the stream')
+STREAM_LAG = registry.histogram(
+    'tweetpinna_stream_lag_seconds',
+    'Time from the creation of a tweet (timestamp_ms) until its receipt')
+STREAM_CONNECTS = registry.counter(
+    'tweetpinna_stream_connects_total', 'Established stream connections')
+STREAM_ERRORS = registry.counter(
+    'tweetpinna_stream_errors_total', 'Stream errors by HTTP status code',
+    ['code'])
+RELOADS = registry.counter(
+    'tweetpinna_reloads_total',
+    'Reloads of the tracking terms and locations by result', ['result'])
+RELOAD_GAP = registry.histogram(
+    'tweetpinna_reload_gap_seconds',
+    'Time without statuses between the old and the new connection of a '
+    'handover; 0 if they overlapped', buckets=(0, 1, 5, 10, 30, 60, 300))
+RELOAD_OVERLAP = registry.histogram(
+    'tweetpinna_reload_overlap_seconds',
+    'Time both connections of a handover have been delivering',
+    buckets=(0, 1, 5, 10, 30, 60, 300))
+RELOAD_DUPLICATES = registry.counter(
+    'tweetpinna_reload_duplicates_total',
+    'Duplicates dropped while both connections of a handover delivered')
+
+# Guards tracking_terms, tracking_locations and twitter_stream, which are
+# replaced on the main thread while the listener threads read them
+filter_lock = threading.Lock()
+
 
 class TwitterStreamListener(tweepy.StreamListener):
-    """The Tweepy StreamListener."""
+    """The Tweepy StreamListener.
+
+    A single listener handles both the tracking terms and the locations.
+    """
 
-    def __init__(self):
-        """Docstring for Logger."""
+    def __init__(self, name):
+        """Initialization.
+
+        :param str name: the name of the stream, used for the spool
+        """
         global end_script
         super(TwitterStreamListener, self).__init__()
+        # Written documents; on_inserted runs on the BulkWriter and on the
+        # spool replay thread
         self.counter = 0
-        self.status_buffer = []
-        self.mongo_db_connected = False
+        self.counter_lock = threading.Lock()
+        self.spool = None
+        if cfg['tweet_buffer'] == 1:
+            self.spool = TweetSpool(cfg, log, name)
+        self.mongo = MongoConnection(cfg, log, on_connected=self.clear_buffer)
+        self.mongo_coll_tweets = self.mongo.collection
+        self.writer = BulkWriter(cfg, log, self.mongo_coll_tweets,
+                                 on_inserted=self.on_inserted,
+                                 on_failed=self.on_write_failed)
+        self.ingest_queue = IngestQueue(cfg, log, self.process_document)
+        self.recent_ids = RecentIdFilter(cfg['dedup_recent_ids'])
+        self.overload = OverloadPolicy(
+            cfg, log,
+            lambda: self.ingest_queue.depth() / float(
+                max(1, cfg['ingest_queue_size'])),
+            self.writer.oldest_age)
+        self.matcher = TermMatcher(tracking_terms)
+
+        self.aggregates = Aggregates(cfg, self.mongo.db)
 
-        self.connect_mongodb()
-        if not self.mongo_db_connected:
+        self.users = None
+        if cfg['mongo_compact_users'] == 1:
+            self.users = UserStore(
+                self.mongo.db[UserStore.collection_name(cfg)])
+
+        self.media_queue = None
+        if cfg['media_download_instantly'] == 1:
+            self.media_queue = MediaDownloadQueue(
+                cfg, log, create_media_manifest(cfg, self.mongo.db))
+
+        if not self.mongo.connect():
             print ('Cannot connect to MongoDB!')
             end_script(self)
+        log.log_add(2, 'Connection to MongoDB established')
+        ensure_indexes(self.mongo_coll_tweets, log)
+        if cfg['ingest_enrich'] == 1:
+            ensure_enrichment_indexes(self.mongo_coll_tweets, log)
+        self.aggregates.ensure_indexes()
+        if self.users:
+            self.users.ensure_indexes()
+        if self.media_queue and self.media_queue.manifest:
+            self.media_queue.manifest.ensure_indexes()
+        self.mongo.start()
+        self.register_metrics()
 
-    def connect_mongodb(self):
-        """Connecting to MongoDB."""
-        try:
-            self.mongo_client = MongoClient(cfg['mongo_path'],
-                                            connectTimeoutMS=500,
-                                            serverSelectionTimeoutMS=500)
+    def register_metrics(self):
+        """Exposing the state of the pipeline as gauges."""
+        registry.gauge(
+            'tweetpinna_ingest_queue_depth',
+            'Tweets waiting in the ingest queue').set_function(
+                self.ingest_queue.depth)
+        registry.gauge(
+            'tweetpinna_writer_pending',
+            'Tweets waiting in the current batch').set_function(
+                self.writer.pending)
+        registry.gauge(
+            'tweetpinna_overload_level',
+            'Current load shedding level; 0 captures everything').set_function(
+                lambda: self.overload.level)
+        registry.gauge(
+            'tweetpinna_mongo_connected',
+            '1 if MongoDB is considered reachable').set_function(
+                lambda: int(self.mongo.connected()))
+        registry.gauge(
+            'tweetpinna_mongo_failures',
+            'Number of lost MongoDB connections').set_function(
+                lambda: self.mongo.failures)
+        registry.gauge(
+            'tweetpinna_mongo_reconnects',
+            'Number of reestablished MongoDB connections').set_function(
+                lambda: self.mongo.reconnects)
 
-            # Check whether the connection is established or not
-            self.mongo_client.server_info()
+        if self.spool:
+            registry.gauge(
+                'tweetpinna_spool_bytes',
+                'Size of the spooled tweets on disk').set_function(
+                    lambda: self.spool.size)
 
-            self.mongo_db = self.mongo_client[cfg['mongo_db']]
-            self.mongo_coll_tweets = self.mongo_db[cfg['mongo_coll']]
+        if self.media_queue:
+            jobs = registry.gauge('tweetpinna_media_queue_jobs',
+                                  'Media download jobs by status', ['status'])
+            for status in (self.media_queue.PENDING, self.media_queue.RUNNING,
+                           self.media_queue.DONE, self.media_queue.FAILED):
+                jobs.labels(status).set_function(
+                    lambda status=status:
+                        self.media_queue.counts().get(status, 0))
 
-            self.mongo_db_connected = True
-            log.log_add(2, 'Connection to MongoDB established')
-        except:
-            self.mongo_db_connected = False
+    def add_to_mongodb(self, document, received=None):
+        """Adding a status document to MongoDB."""
+        self.writer.add(document, received)
 
-    @staticmethod
-    def media_download(insert_id):
-        """Calling the media downloader."""
-        if cfg['media_download_instantly'] == 1:
+    def on_inserted(self, documents):
+        """Handling documents that have been written (or replayed from the spool)."""
+        if self.users:
             try:
-                fnull = open(os.devnull, 'w')
-                subprocess.Popen(["python", "TweetPinnaImageDownloader.py",
-                                  sys.argv[1], str(insert_id)],
-                                 shell=False, stdout=fnull,
-                                 stderr=subprocess.STDOUT)
+                self.users.flush()
             except Exception as e:
-                log.log_add(4, 'Could not instantly download media files ({})'.
-                            format(e))
+                log.log_add(3, 'Could not write user snapshots ({})'.format(e))
 
-    def add_to_mongodb(self, status):
-        """Addint statuses to MongoDB."""
         try:
-            insert = self.mongo_coll_tweets.insert_one(status._json)
-            insert_id = insert.inserted_id
-            self.media_download(insert_id)
-            self.counter += 1
-        except errors.ServerSelectionTimeoutError:
+            self.aggregates.update(documents, get_stream_source)
+            self.aggregates.add_lost(self.overload.take_lost())
+        except Exception as e:
+            log.log_add(3, 'Could not update the aggregates ({})'.format(e))
+
+        if self.media_queue:
+            start = time.time()
+            self.media_queue.add_tweets(documents)
+            STAGE_SECONDS.labels('media_enqueue').observe(time.time() - start)
+        with self.counter_lock:
+            self.counter += len(documents)
+            counter = self.counter
+        supervisor.notify('saved', counter)
+
+    def on_write_failed(self, documents, error):
+        """Buffering documents that could not be written by the BulkWriter."""
+        if isinstance(error, errors.ServerSelectionTimeoutError):
             log.log_add(cfg['log_email_threshold'],
                         'MongoDB ServerSelectionTimeoutError')
-            self.connect_mongodb()
-        except Exception as e:
+        else:
             log.log_add(cfg['log_email_threshold'],
-                        'Could not write to MongoDB ({})'.format(e))
+                        'Could not write to MongoDB ({})'.format(error))
+        self.mongo.report_failure(error)
+
+        if self.spool:
+            # The snapshots which have not been written would be lost on a
+            # restart
+            if self.users:
+                self.users.expand(documents)
+            self.spool.append(documents)
 
     def clear_buffer(self):
-        """Write the buffer to MongoDB."""
-        if self.mongo_db_connected:
-            while len(self.status_buffer) > 0:
-                self.add_to_mongodb(self.status_buffer.pop())
+        """Replay the spooled statuses to MongoDB.
 
-        if len(self.status_buffer) == 0:
+        Called by the MongoDB reconnect coordinator once the connection has
+        been (re)established.
+        """
+        if not (self.spool and self.spool.pending()):
+            return
+
+        self.writer.flush()
+        if self.spool.replay(self.mongo_coll_tweets, self.on_inserted):
             log.log_add(3, 'Buffer has been cleared')
+        else:
+            self.mongo.report_failure('buffer replay failed')
+
+    def on_data(self, raw_data):
+        """Handling raw stream messages.
+
+        With ingest_raw_json, statuses are parsed with a fast JSON parser and
+        handed over as dicts, without building tweepy Status objects. Other
+        messages are left to tweepy.
+        """
+        received = time.time()
+        STREAM_MESSAGES.inc()
+        STREAM_BYTES.inc(len(raw_data))
+
+        if cfg['ingest_raw_json'] == 1:
+            document = parse_raw_status(raw_data)
+            STAGE_SECONDS.labels('parse').observe(time.time() - received)
+            if document is not None:
+                TWEETS.labels('received').inc()
+                if self.overload.admit(document) and \
+                        not self.ingest_queue.put((received, document)):
+                    self.overload.dropped(document)
+                return True
+
+        return super(TwitterStreamListener, self).on_data(raw_data)
 
     def on_status(self, status):
-        """Collecting statuses and handling them."""
-        if self.mongo_db_connected:
-            self.add_to_mongodb(status)
+        """Collecting statuses and handing them over to the ingest workers."""
+        TWEETS.labels('received').inc()
+        if self.overload.admit(status._json) and \
+                not self.ingest_queue.put((time.time(), status._json)):
+            self.overload.dropped(status._json)
 
-            if len(self.status_buffer) > 1:
-                _thread.start_new(self.clear_buffer, ())
-        else:
-            if cfg['tweet_buffer'] == 1 and len(self.status_buffer) < cfg['tweet_buffer_max']:
-                self.status_buffer.append(status)
-            _thread.start_new(self.connect_mongodb, ())
+    def process_document(self, item):
+        """Handling a status document. Called by the ingest workers.
+
+        :param tuple item: the time of receipt and the status document
+        """
+        received, document = item
+        if 'timestamp_ms' in document:
+            STREAM_LAG.observe(
+                max(0, received - int(document['timestamp_ms']) / 1000))
+
+        # Duplicates that slipped through are rejected by the unique index
+        if self.recent_ids.seen(document.get('id')):
+            return
+
+        if cfg['ingest_enrich'] == 1:
+            enrich_tweet(document, self.matcher)
+
+        if self.mongo.connected():
+            # Spooled tweets keep their complete user objects
+            if self.users:
+                self.users.compact(document)
+            self.add_to_mongodb(document, received)
+        elif self.spool:
+            self.spool.append([document])
+
+    def on_connect(self):
+        """Reacting to a (re)established stream connection."""
+        STREAM_CONNECTS.inc()
+        supervisor.notify('connected')
 
     def on_error(self, status_code):
-        """Reacting to Twitter errors."""
-        global end_script
+        """Reacting to Twitter errors.
 
+        420, 429 and 401 end the stream; the supervisor decides whether and
+        when to reconnect.
+        """
+        STREAM_ERRORS.labels(status_code).inc()
         if status_code == 420:
             log.log_add(4, 'Twitter 420 Error')
             log.last_twitter_error_message = 420
+            supervisor.notify('error', 420)
             return False
         elif status_code == 429:
             log.log_add(4, 'Twitter 429 Error')
             log.last_twitter_error_message = 429
+            supervisor.notify('error', 429)
             return False
         elif status_code == 401:
             # Unauthorized
             log.log_add(4, 'Twitter 401 Error')
             log.last_twitter_error_message = 401
             print ('Twitter authentication error!')
-            end_script(self)
+            supervisor.notify('error', 401)
             return False
         else:
             log.log_add(4, 'Twitter {}'.format(status_code))
 
+    def on_exception(self, exception):
+        """Reacting to exceptions that end the stream thread."""
+        log.log_add(4, 'Twitter stream exception ({})'.format(exception))
+        supervisor.notify('exception', exception)
+
+
+class StreamConnection(tweepy.StreamListener):
+    """The Tweepy listener of a single stream connection.
+
+    Messages are handed to the TwitterStreamListener, which runs the pipeline
+    shared by all connections. While the filter is being reloaded, two
+    connections deliver at the same time; each one keeps track of its role
+    and of when it has delivered.
+    """
+
+    # The connection in use, the connection with a reloaded filter and a
+    # connection that is being ended
+    CURRENT = 'current'
+    CANDIDATE = 'candidate'
+    RETIRED = 'retired'
+
+    def __init__(self, pipeline, role=CURRENT):
+        """Initialization.
+
+        :param object pipeline: the TwitterStreamListener
+        :param str role: current or candidate
+        """
+        super(StreamConnection, self).__init__()
+        self.pipeline = pipeline
+        self.role = role
+        self.stream = None
+        self.first_data = None
+        self.last_data = None
+
+    def on_connect(self):
+        """Reporting the connection to the pipeline or the handover."""
+        if self.role == self.CURRENT:
+            self.pipeline.on_connect()
+        elif self.role == self.CANDIDATE:
+            STREAM_CONNECTS.inc()
+            supervisor.notify('handover', (self, 'connected'))
+        else:
+            # Tweepy reconnects a retired stream whose connection has been
+            # closed, e.g. by Twitter in favour of the new one
+            self.stream.disconnect()
+
+    def on_data(self, raw_data):
+        """Handing a message to the pipeline."""
+        now = time.time()
+        if self.first_data is None:
+            self.first_data = now
+            if self.role == self.CANDIDATE:
+                supervisor.notify('handover', (self, 'delivering'))
+        self.last_data = now
+        return self.pipeline.on_data(raw_data)
+
+    def on_error(self, status_code):
+        """Reporting errors; a new or retired connection is ended."""
+        if self.role == self.CURRENT:
+            return self.pipeline.on_error(status_code)
+
+        STREAM_ERRORS.labels(status_code).inc()
+        if self.role == self.CANDIDATE:
+            log.log_add(4, 'Twitter {} on the reloaded connection'.format(
+                status_code))
+            supervisor.notify('handover', (self, 'failed'))
+        return False
+
+    def on_exception(self, exception):
+        """Reporting exceptions that end the stream thread."""
+        if self.role == self.CURRENT:
+            self.pipeline.on_exception(exception)
+        elif self.role == self.CANDIDATE:
+            log.log_add(4, 'Twitter stream exception on the reloaded '
+                        'connection ({})'.format(exception))
+            supervisor.notify('handover', (self, 'failed'))
+
+
+class StreamSupervisor():
+    """Reacting to the events of the listener on the main thread.
+
+    The supervisor blocks until the listener reports an event or one of its
+    timers is due. Reconnects after 420/429 errors are scheduled instead of
+    sleeping.
+
+    When the tracking terms or locations in the configuration file change
+    (or on SIGHUP), a connection with the new filter is started. Twitter
+    allows only one standing connection per account, so the current one is
+    ended first. With twitter_reload_access_token(_secret) of a second
+    account, the new connection is opened alongside the current one
+    instead; once it delivers, it takes over and the old connection is kept
+    for reload_overlap seconds so that no tweets are lost in between. Tweets
+    delivered by both are dropped by the RecentIdFilter.
+    """
+
+    # Seconds to wait before reconnecting after the first, second and
+    # third consecutive 420/429; a fourth one ends the script
+    BACKOFF_420_429 = (10, 60, 300)
+
+    def __init__(self, config_path=None, track_terms=True,
+                 track_locations=True):
+        """Initialization.
+
+        :param str config_path: the configuration file to reload the
+        tracking terms and locations from
+        :param bool track_terms: whether twitter_tracking_terms are tracked
+        :param bool track_locations: whether twitter_tracking_locations are
+        tracked
+        """
+        # A SimpleQueue can be posted to from the signal handler
+        self.events = queue.SimpleQueue()
+        self.stream = None
+        self.listener = None
+        self.errors_420_429 = 0
+        self.last_milestone = 0
+        self.reconnect_at = None
+
+        # Reloading the filter
+        self.config_path = config_path
+        self.track_terms = track_terms
+        self.track_locations = track_locations
+        self.config_mtime = self.get_config_mtime()
+        self.config_check_at = None
+        self.candidate = None
+        self.candidate_filter = None
+        self.handover_deadline = None
+        self.retiring = None
+        self.retire_at = None
+        self.handover_duplicates = 0
+
+    def notify(self, event, value=None):
+        """Posting an event. Safe to call from any thread.
+
+        :param str event: saved, connected, error, exception, reload or
+        handover
+        :param object value: the current count, status code, exception or
+        the state of the new connection
+        """
+        self.events.put((event, value))
+
+    def run(self, stream):
+        """Handling events until the script is ended.
+
+        :param stream object stream: the Tweepy stream object
+        """
+        self.stream = stream
+        self.listener = getattr(stream.listener, 'pipeline', stream.listener)
+        if self.config_path and cfg['reload_watch_interval'] > 0:
+            self.config_check_at = time.time() + cfg['reload_watch_interval']
+
+        while True:
+            timers = [timer for timer in (
+                self.reconnect_at, self.config_check_at,
+                self.handover_deadline, self.retire_at) if timer is not None]
+            timeout = None
+            if timers:
+                timeout = max(0, min(timers) - time.time())
+
+            try:
+                event, value = self.events.get(timeout=timeout)
+            except queue.Empty:
+                event, value = None, None
+
+            if event == 'saved':
+                self.on_saved(value)
+            elif event == 'connected':
+                self.errors_420_429 = 0
+            elif event == 'error':
+                self.on_error(value)
+            elif event == 'exception':
+                self.schedule_reconnect(self.BACKOFF_420_429[0])
+            elif event == 'reload':
+                self.reload()
+            elif event == 'handover':
+                self.on_handover(value)
+
+            self.on_timers()
+
+    def on_timers(self):
+        """Running the timers which are due."""
+        now = time.time()
+        if self.reconnect_at is not None and now >= self.reconnect_at:
+            self.reconnect()
+        if self.config_check_at is not None and now >= self.config_check_at:
+            self.config_check_at = now + cfg['reload_watch_interval']
+            mtime = self.get_config_mtime()
+            if mtime != self.config_mtime:
+                self.config_mtime = mtime
+                self.reload()
+        if self.handover_deadline is not None and \
+                now >= self.handover_deadline:
+            self.abort_handover('no statuses within {} seconds'.format(
+                cfg['reload_handover_timeout']))
+        if self.retire_at is not None and now >= self.retire_at:
+            self.retire()
+
+    def on_saved(self, current_count):
+        """Printing the current streaming status at every milestone.
+
+        :param int current_count: the number of saved tweets
+        """
+        # The counter grows by whole batches, so it rarely hits a multiple
+        # of report_steps exactly
+        if (current_count // cfg['report_steps'] <=
+                self.last_milestone // cfg['report_steps']):
+            return
+
+        self.last_milestone = current_count
+        print ('[{}] {} Tweets have been saved'.
+               format(time.strftime("%Y-%m-%d %H:%M:%S"), current_count))
+        if not log.enabled(1):
+            # The reports are only built if they are logged
+            return
+
+        log.log_add(1, '{} Tweets have been saved ({})', current_count,
+                    self.listener.writer.report())
+        log.log_add(1, 'Ingest {}, {} duplicates dropped',
+                    self.listener.ingest_queue.report(),
+                    self.listener.recent_ids.duplicates)
+        log.log_add(1, self.listener.mongo.report())
+        if self.listener.overload.max_level:
+            log.log_add(1, 'Overload {}', self.listener.overload.report())
+        if self.listener.spool:
+            log.log_add(1, 'Buffer {}', self.listener.spool.report())
+        if self.listener.media_queue:
+            log.log_add(1, self.listener.media_queue.report())
+
+    def on_error(self, status_code):
+        """Handling the errors which ended the stream.
+
+        :param int status_code: the HTTP status code returned by Twitter
+        """
+        if status_code in (420, 429):
+            # Handling 420 (Enhance Your Calm) and 429 (Too Many Requests)
+            self.errors_420_429 += 1
+            if self.errors_420_429 > len(self.BACKOFF_420_429):
+                log.log_add(
+                    cfg['log_email_threshold'],
+                    'Too many 420/429s, Disengaging')
+                end_script(self.stream)
+                return
+
+            delay = self.BACKOFF_420_429[self.errors_420_429 - 1]
+            log.log_add(1, '420/429 number {}, reconnecting in {} seconds'.
+                        format(self.errors_420_429, delay))
+            self.schedule_reconnect(delay)
+        elif status_code == 401:
+            log.log_add(
+                cfg['log_email_threshold'],
+                'Twitter Authentication failed')
+            end_script(self.stream)
+
+    def schedule_reconnect(self, delay):
+        """Reconnecting the stream after delay seconds.
+
+        :param int delay: seconds to wait
+        """
+        self.reconnect_at = time.time() + delay
+
+    def reconnect(self):
+        """Restarting the stream once it has stopped."""
+        self.reconnect_at = None
+        if self.stream.running or self.candidate is not None:
+            # During a handover, the old connection is restarted if the new
+            # one fails
+            return
+
+        log.log_add(1, 'Reconnecting the stream')
+        start_stream(self.stream)
+
+    def get_config_mtime(self):
+        """Returning the modification time of the configuration file."""
+        try:
+            return os.path.getmtime(self.config_path)
+        except (OSError, TypeError):
+            return None
+
+    def reload(self):
+        """Reading the tracking terms and locations again.
+
+        If they have changed, a connection with the new filter is started,
+        alongside the current one if there are credentials for a second
+        connection. A handover in progress is replaced.
+        """
+        try:
+            reloaded_cfg = load_config(self.config_path)
+            terms = []
+            if self.track_terms:
+                terms = list(reloaded_cfg['twitter_tracking_terms'])
+            locations = []
+            if self.track_locations:
+                locations = [list(box) for box in
+                             reloaded_cfg['twitter_tracking_locations']]
+        except Exception as e:
+            RELOADS.labels('failed').inc()
+            log.log_add(3, 'Could not reload the configuration ({})'.format(e))
+            return
+
+        if len(terms) == 0 and len(locations) == 0:
+            RELOADS.labels('failed').inc()
+            log.log_add(3, 'Reloaded configuration has neither terms nor '
+                        'locations to track')
+            return
+
+        # Only the main thread replaces the filter
+        current = (list(tracking_terms),
+                   [list(box) for box in tracking_locations])
+        if self.candidate_filter == (terms, locations) or \
+                (self.candidate is None and current == (terms, locations)):
+            RELOADS.labels('unchanged').inc()
+            log.log_add(1, 'Configuration reloaded, terms and locations '
+                        'are unchanged')
+            return
+
+        if self.candidate is not None:
+            self.abort_handover('replaced by a newer configuration',
+                                restart=False)
+
+        access = (cfg['twitter_reload_access_token'],
+                  cfg['twitter_reload_access_token_secret'])
+        if not all(access):
+            # A second connection with the same account would end the
+            # current one, so the current one is ended first
+            access = None
+            self.reconnect_at = None
+            if self.stream.running:
+                self.stream.disconnect()
+
+        log.log_add(2, 'Terms or locations have changed ({} terms, {} '
+                    'locations), starting a new connection{}'.format(
+                        len(terms), len(locations),
+                        ' alongside the current one' if access else ''))
+        self.candidate_filter = (terms, locations)
+        self.candidate = create_stream(
+            self.listener, StreamConnection.CANDIDATE, access)
+        self.handover_deadline = time.time() + cfg['reload_handover_timeout']
+        self.handover_duplicates = self.listener.recent_ids.duplicates
+        start_stream(self.candidate, terms, locations)
+
+    def on_handover(self, event):
+        """Handling the events of the connection with the new filter.
+
+        :param tuple event: the StreamConnection and its state (connected,
+        delivering or failed)
+        """
+        connection, state = event
+        if self.candidate is None or connection is not self.candidate.listener:
+            # A connection that has already been given up
+            return
+
+        if state == 'connected':
+            log.log_add(1, 'New connection established, waiting for statuses')
+        elif state == 'delivering':
+            self.take_over()
+        elif state == 'failed':
+            self.abort_handover('the new connection has failed')
+
+    def take_over(self):
+        """Making the new connection the current one."""
+        global tracking_terms, tracking_locations, twitter_stream
+
+        old, new = self.stream, self.candidate
+        old_terms = tracking_terms
+        with filter_lock:
+            tracking_terms, tracking_locations = self.candidate_filter
+            twitter_stream = new
+        self.candidate = None
+        self.candidate_filter = None
+        self.handover_deadline = None
+
+        # Gap between the last status of the old connection and the first
+        # one of the new connection
+        if old.listener.last_data is not None:
+            RELOAD_GAP.observe(max(0, new.listener.first_data -
+                                   old.listener.last_data))
+
+        new.listener.role = StreamConnection.CURRENT
+        old.listener.role = StreamConnection.RETIRED
+        self.stream = new
+        self.reconnect_at = None
+        self.errors_420_429 = 0
+
+        # While both connections deliver, the terms of both are matched
+        self.listener.matcher = TermMatcher(
+            list(tracking_terms) +
+            [term for term in old_terms if term not in tracking_terms])
+        if self.retiring is not None:
+            self.retire()
+        # An old connection that has been ended before the reload is not
+        # kept any longer
+        overlap = cfg['reload_overlap'] if old.running else 0
+        self.retiring = old
+        self.retire_at = time.time() + overlap
+        RELOADS.labels('applied').inc()
+        log.log_add(2, 'New connection delivering, ending the old one in '
+                    '{} seconds'.format(overlap))
+
+    def retire(self):
+        """Ending the old connection after a handover."""
+        old, self.retiring = self.retiring, None
+        self.retire_at = None
+        old.disconnect()
+        self.listener.matcher = TermMatcher(tracking_terms)
+
+        overlap = 0
+        if old.listener.last_data is not None and \
+                self.stream.listener.first_data is not None:
+            overlap = max(0, old.listener.last_data -
+                          self.stream.listener.first_data)
+        RELOAD_OVERLAP.observe(overlap)
+        duplicates = max(0, self.listener.recent_ids.duplicates -
+                         self.handover_duplicates)
+        RELOAD_DUPLICATES.inc(duplicates)
+        log.log_add(2, 'Handover completed ({:.1f} seconds overlap, {} '
+                    'duplicates dropped)'.format(overlap, duplicates))
+
+    def abort_handover(self, reason, restart=True):
+        """Ending the new connection and keeping the current one.
+
+        :param str reason: why the handover has been given up
+        :param bool restart: whether to restart the current connection if it
+        has been ended for the reload
+        """
+        candidate, self.candidate = self.candidate, None
+        self.candidate_filter = None
+        self.handover_deadline = None
+        candidate.listener.role = StreamConnection.RETIRED
+        candidate.disconnect()
+        RELOADS.labels('failed').inc()
+        log.log_add(3, 'Reload failed, keeping the current connection '
+                    '({})'.format(reason))
+        if restart and not self.stream.running:
+            start_stream(self.stream)
+
+    def handover_streams(self):
+        """Returning the streams of a handover in progress."""
+        return [stream for stream in (self.candidate, self.retiring)
+                if stream is not None]
+
 
 class Logger():
-    """Handling all log events and keeping track of event logfiles."""
+    """Handling all log events and keeping track of event logfiles.
+
+    With log_async, entries are handed to a background thread which keeps the
+    logfile open, writes queued entries in batches and switches to the next
+    day's file at midnight. Otherwise, every entry is appended directly.
+    Alert emails are always sent by a background AlertDispatcher.
+    """
+
+    # Seconds log_tail waits for the entries queued before it was called
+    TAIL_WAIT = 1
 
     def __init__(self, cfg):
         """Initialization."""
@@ -147,26 +787,67 @@ class Logger():
         self.last_message = None
         self.last_twitter_error_message = None
         self.last_email_messages = {}
+        self.min_level = cfg['log_min_level']
         if not os.path.isdir(self.cfg['log_dir']):
             os.makedirs(self.cfg['log_dir'])
 
-    def log_add(self, level, message):
+        self.alerts = None
+        if cfg['log_email_enabled'] == 1:
+            self.alerts = AlertDispatcher(cfg, self)
+
+        self.queue = None
+        if cfg['log_async'] == 1:
+            self.queue = queue.Queue(maxsize=cfg['log_queue_size'])
+            self.dropped = 0
+            self.file = None
+            self.file_date = None
+            self.writer = threading.Thread(target=self._write_loop,
+                                           name='LogWriter')
+            self.writer.daemon = True
+            self.writer.start()
+
+        if self.queue is not None or self.alerts is not None:
+            atexit.register(self.close)
+
+    def enabled(self, level):
+        """Returning whether messages of a level are logged at all.
+
+        :param int level: the log-level of the message
+        """
+        return level >= self.min_level
+
+    def log_add(self, level, message, *args):
         """Adding an entry to the current logfile.
 
+        Messages below log_min_level are discarded before they are formatted.
+
         :param int level: the log-level (usually 1-5) of the message
+        :param str message: the message; formatted with args if there are any
         """
+        if level < self.min_level:
+            return
+        if args:
+            message = message.format(*args)
+
         self.last_message = message
-        log_date = time.strftime("%Y-%m-%d")
-        log_time = time.strftime("%H:%M:%S")
-        log_file = open('{}/{}-{}.log'.format(self.cfg['log_dir'],
-                                              self.cfg['instance_name'],
-                                              log_date), 'a')
-        log_file.write('[{0} {1}][{2}] {3}\n'.
-                       format(log_date, log_time, level, message))
-        log_file.close()
+        now = time.localtime()
+        log_date = time.strftime("%Y-%m-%d", now)
+        log_time = time.strftime("%H:%M:%S", now)
+
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait((log_date, log_time, level, message))
+            except queue.Full:
+                # Never blocking the caller; the writer reports the loss
+                self.dropped += 1
+        else:
+            log_file = open(self._log_path(log_date), 'a')
+            log_file.write('[{0} {1}][{2}] {3}\n'.
+                           format(log_date, log_time, level, message))
+            log_file.close()
 
         if (level >= self.cfg['log_email_threshold'] and
-                self.cfg['log_email_enabled'] == 1):
+                self.alerts is not None):
             self.log_send_email(
                 'Level {} Event in {}'.format(level, self.cfg['instance_name']),
                 message)
@@ -177,14 +858,20 @@ class Logger():
         :param int n: the number of messages to return; 0 returns all
         :return list: a list of entries
         """
+        if self.queue is not None:
+            # Waiting (briefly) for the entries queued so far to be written;
+            # the writer sets the marker once the batch containing it is out
+            marker = threading.Event()
+            try:
+                self.queue.put_nowait(marker)
+                marker.wait(self.TAIL_WAIT)
+            except queue.Full:
+                pass
+
         log_date = time.strftime("%Y-%m-%d")
-        if os.path.isfile('{}/{}-{}.log'.format(self.cfg['log_dir'],
-                                                self.cfg['instance_name'],
-                                                log_date)):
+        if os.path.isfile(self._log_path(log_date)):
 
-            with open('{}/{}-{}.log'.format(self.cfg['log_dir'],
-                                            self.cfg['instance_name'],
-                                            log_date)) as log_file:
+            with open(self._log_path(log_date)) as log_file:
                 lines = log_file.readlines()
                 if n == 0:
                     return lines
@@ -193,59 +880,194 @@ class Logger():
         else:
             return ['There is no logfile for {}'.format(log_date)]
 
+    def close(self):
+        """Sending queued alerts, writing queued entries, closing the logfile.
+
+        Later entries are written directly; later alerts are not sent.
+        """
+        if self.alerts is not None:
+            self.alerts.stop()
+            self.alerts = None
+
+        if self.queue is None:
+            return
+
+        self.queue.put(None)
+        self.writer.join(5)
+        self.queue = None
+
+    def _log_path(self, log_date):
+        """Returning the path of the logfile of a day."""
+        return '{}/{}-{}.log'.format(self.cfg['log_dir'],
+                                     self.cfg['instance_name'], log_date)
+
+    def _write_loop(self):
+        """Writing queued entries in batches until None is received."""
+        dropped_reported = 0
+        running = True
+        while running:
+            entries = [self.queue.get()]
+            while True:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # One write per day and batch; a new day opens a new file
+            lines = collections.OrderedDict()
+            markers = []
+            for entry in entries:
+                if entry is None:
+                    running = False
+                    continue
+                if isinstance(entry, threading.Event):
+                    markers.append(entry)
+                    continue
+                log_date, log_time, level, message = entry
+                lines.setdefault(log_date, []).append(
+                    '[{0} {1}][{2}] {3}\n'.format(log_date, log_time, level,
+                                                  message))
+
+            if self.dropped != dropped_reported:
+                log_date = time.strftime("%Y-%m-%d")
+                lines.setdefault(log_date, []).append(
+                    '[{0} {1}][3] {2} log entries have been dropped\n'.format(
+                        log_date, time.strftime("%H:%M:%S"),
+                        self.dropped - dropped_reported))
+                dropped_reported = self.dropped
+
+            for log_date, date_lines in lines.items():
+                self._write(log_date, ''.join(date_lines))
+            for marker in markers:
+                marker.set()
+
+            for entry in entries:
+                self.queue.task_done()
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _write(self, log_date, data):
+        """Appending data to the logfile of a day with a single write.
+
+        :param str log_date: the day of the entries
+        :param str data: the formatted entries
+        """
+        try:
+            if self.file_date != log_date:
+                if self.file is not None:
+                    self.file.close()
+                self.file = None
+                self.file = open(self._log_path(log_date), 'ab', buffering=0)
+                self.file_date = log_date
+
+            self.file.write(data.encode('utf-8'))
+        except (IOError, OSError) as e:
+            self.file_date = None
+            print('Could not write to the logfile ({})'.format(e))
+
     def log_send_email(self, subject, message):
         """Sending an email to the specified administrator.
 
+        The email is handed to the AlertDispatcher, which sends it on a
+        background thread, possibly together with other alerts.
+
         :param str subject: the subject of the email
         :param str message: the body of the message
         """
-        try:
-            time_div = datetime.datetime.now(
-            ) - self.last_email_messages[message]
-            time_div = divmod(time_div.days * 86400 + time_div.seconds, 60)
-        except KeyError:
-            time_div = (self.cfg['log_email_threshold'] + 1, 0)
+        if self.alerts is not None:
+            self.alerts.alert(subject, message)
 
-        if (time_div[0] > self.cfg['email_spam_wait']):
-            try:
-                self.last_email_messages[message] = datetime.datetime.now()
-
-                msg = MIMEText(message)
-                msg['Subject'] = subject
-                msg['From'] = self.cfg['email_sender']
-                msg['To'] = self.cfg['email_receiver']
-
-                s = smtplib.SMTP(
-                    self.cfg['email_server'],
-                    self.cfg['email_server_port'])
-                if self.cfg['email_starttls'] == 1:
-                    s.starttls()
-                s.login(self.cfg['email_user'], self.cfg['email_password'])
-                s.sendmail(
-                    self.cfg['email_sender'], [
-                        self.cfg['email_receiver']], msg.as_string())
-                s.quit()
-                self.log_add(1, 'Email sent')
-            except Exception:
-                self.log_add(
-                    self.cfg['log_email_threshold'] - 1,
-                    'Could not send email')
-        else:
-            self.log.log_add(2, 'Email has not been sent to prevent spam')
 
+def get_stream_source(document):
+    """Returning whether a streamed tweet has matched a term or a location.
+
+    Without derived fields, tweets of a combined stream count as 'stream'.
 
-def start_stream(stream):
+    :param dict document: the status
+    """
+    with filter_lock:
+        terms, locations = tracking_terms, tracking_locations
+    if not locations:
+        return 'stream'
+    if not terms:
+        return 'location'
+
+    try:
+        if document[ENRICHMENT_FIELD]['term'] is None:
+            return 'location'
+    except (KeyError, TypeError):
+        pass
+    return 'stream'
+
+
+def get_bounding_boxes(locations):
+    """Flattening a list of bounding boxes as expected by the Twitter API.
+
+    :param list locations: a list of [lon, lat, lon, lat] bounding boxes
+    """
+    return [coordinate for box in locations for coordinate in box]
+
+
+def create_stream(listener, role=StreamConnection.CURRENT, access=None):
+    """Creating the Tweepy stream for a listener.
+
+    The stream connects to twitter_stream_host, which can also be a local
+    stand-in such as TweetPinnaStreamServer.py.
+
+    :param object listener: the TwitterStreamListener
+    :param str role: the role of the connection, see StreamConnection
+    :param tuple access: the access token and secret to connect with;
+    defaults to twitter_access_token(_secret)
+    """
+    if access is None:
+        access = (cfg['twitter_access_token'],
+                  cfg['twitter_access_token_secret'])
+    auth = tweepy.OAuthHandler(
+        cfg['twitter_consumer_key'],
+        cfg['twitter_consumer_secret'])
+    auth.set_access_token(*access)
+    api = tweepy.API(auth)
+
+    # 1/0 switch certificate verification on/off; any other value is the
+    # path of a certificate (bundle) to verify against
+    verify = cfg['twitter_stream_verify']
+    if verify in (0, 1):
+        verify = verify == 1
+
+    connection = StreamConnection(listener, role)
+    stream = tweepy.Stream(auth=api.auth, listener=connection,
+                           host=cfg['twitter_stream_host'], verify=verify)
+    connection.stream = stream
+    return stream
+
+
+def start_stream(stream, terms=None, locations=None):
     """Starting the Tweepy stream.
 
+    Terms and locations are tracked by the same connection; Twitter delivers
+    every status that matches any of them.
+
     :param stream object stream: the Tweepy stream object
+    :param list terms: the terms to track; defaults to tracking_terms
+    :param list locations: the locations to track; defaults to
+    tracking_locations
     """
     log.log_add(1, 'Stream started by start_stream')
+    with filter_lock:
+        if terms is None:
+            terms = tracking_terms
+        if locations is None:
+            locations = tracking_locations
 
     try:
-        twitter_stream.filter(track=cfg['twitter_tracking_terms'], is_async=True)
+        stream.filter(track=terms or None,
+                      locations=get_bounding_boxes(locations) or None,
+                      is_async=True)
     except Exception as e:
         log.log_add(cfg['log_email_threshold'],
-                    'twitter_stream Exception ({})'.format(e.message))
+                    'twitter_stream Exception ({})'.format(e))
         end_script(stream)
 
 
@@ -260,6 +1082,29 @@ def stop_stream(stream):
     except:
         log.log_add(1, 'Stream could not be disconnected by stop_stream')
 
+    # Ending a handover in progress
+    for other in supervisor.handover_streams():
+        other.disconnect()
+
+    # Handling the queued statuses and writing the current batch
+    listener = getattr(stream, 'listener', stream)
+    listener = getattr(listener, 'pipeline', listener)
+    if hasattr(listener, 'ingest_queue'):
+        listener.ingest_queue.stop()
+    if hasattr(listener, 'writer'):
+        # Spools the batch if MongoDB is not available
+        listener.writer.stop()
+    if hasattr(listener, 'mongo'):
+        listener.mongo.stop()
+    if getattr(listener, 'media_queue', None):
+        listener.media_queue.stop()
+
+
+def reload_handler(signum, frame):
+    """Reloading the tracking terms and locations on SIGHUP."""
+    log.log_add(1, 'Reload requested by signal {}'.format(signum))
+    supervisor.notify('reload')
+
 
 def signal_handler(signum, frame):
     """Handlig interrupt signals."""
@@ -281,34 +1126,68 @@ def end_script(stream):
     print ('[{}] Ending TweetPinna (Inst.: {})'.
            format(time.strftime("%Y-%m-%d %H:%M:%S"), cfg['instance_name']))
 
+    # os._exit skips atexit, the queued log entries are written here
+    log.close()
     os._exit(0)
     sys.exit(1)
 
 
 def check_config(config_file_path):
-    """Checking a configuration file. Returns True if all entries are there.
+    """Checking a configuration file. Returns True if it can be read.
+
+    Options missing in the file (e.g. those added by an update) are
+    reported; load_config takes them from the default configuration.
 
     :param str config_file_path: path to the file that should be tested
     """
     reference_cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
-    test_cfg = config.Config(open(config_file_path, 'r'))
+    try:
+        test_cfg = config.Config(open(config_file_path, 'r'))
+    except Exception as e:
+        print ('Configuration could not be read ({})'.format(e))
+        return False
 
-    for cfg_entry in reference_cfg.as_dict().keys():
+    for cfg_entry in reference_cfg.keys():
         if cfg_entry not in test_cfg:
-            print ('Option {} is missing in the configuration'.
-                   format(cfg_entry))
-            return False
+            print ('Option {} is missing in the configuration, using the '
+                   'default ({!r})'.format(cfg_entry, reference_cfg[cfg_entry]))
     return True
 
 
-if __name__ == '__main__':
+def load_config(config_file_path):
+    """Loading a configuration file.
+
+    Options missing in the file are taken from the default configuration.
+
+    :param str config_file_path: path to the configuration file
+    """
+    reference_cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
+    loaded_cfg = config.Config(open(config_file_path, 'r'))
+
+    for cfg_entry in reference_cfg.keys():
+        if cfg_entry not in loaded_cfg:
+            loaded_cfg[cfg_entry] = reference_cfg[cfg_entry]
+    return loaded_cfg
+
+
+def main(track_terms=True, track_locations=True):
+    """Running the TweetPinna stream until the script is ended.
+
+    :param bool track_terms: whether to track twitter_tracking_terms
+    :param bool track_locations: whether to track twitter_tracking_locations
+    """
+    global cfg, log, tracking_terms, tracking_locations
+    global twitter_listener, twitter_stream, supervisor
+
     signal.signal(signal.SIGINT, signal_handler)
 
     # Config
+    config_path = 'cfg/TweetPinnaDefault.cfg'
     try:
         if os.path.isfile(sys.argv[1]):
             if check_config(sys.argv[1]):
-                cfg = config.Config(open(sys.argv[1], 'r'))
+                config_path = sys.argv[1]
+                cfg = load_config(config_path)
                 log = Logger(cfg)
             else:
                 print('Configuration appears to be faulty')
@@ -319,64 +1198,48 @@ if __name__ == '__main__':
             sys.exit(1)
     except IndexError:
         print('Using default configuration')
-        cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
+        cfg = load_config('cfg/TweetPinnaDefault.cfg')
         log = Logger(cfg)
 
+    tracking_terms = cfg['twitter_tracking_terms'] if track_terms else []
+    tracking_locations = []
+    if track_locations:
+        tracking_locations = cfg['twitter_tracking_locations']
+
+    if len(tracking_terms) == 0 and len(tracking_locations) == 0:
+        print('There are neither terms nor locations to track')
+        log.log_add(1, 'No terms or locations to track')
+        sys.exit(1)
+
+    # Keeping a location-only instance apart from a combined one
+    stream_name = cfg['instance_name']
+    if not track_terms:
+        stream_name += '-location'
+
     # TweetPinna
     print('[{}] Starting TweetPinna (Inst.: {})'.
            format(time.strftime("%Y-%m-%d %H:%M:%S"), cfg['instance_name']))
     log.log_add(1, 'Starting TweetPinna (Inst.: {})'.format(cfg['instance_name']))
 
+    # Metrics
+    if cfg['metrics_enabled'] == 1:
+        try:
+            MetricsServer(registry, cfg['metrics_host'], cfg['metrics_port'])
+            log.log_add(1, 'Metrics available on http://{}:{}/metrics'.format(
+                cfg['metrics_host'], cfg['metrics_port']))
+        except OSError as e:
+            log.log_add(3, 'Could not start the metrics server ({})'.format(e))
+
     # Initialize Tweepy
-    twitter_listener = TwitterStreamListener()
-    auth = tweepy.OAuthHandler(
-        cfg['twitter_consumer_key'],
-        cfg['twitter_consumer_secret'])
-    auth.set_access_token(
-        cfg['twitter_access_token'],
-        cfg['twitter_access_token_secret'])
-    api = tweepy.API(auth)
-    twitter_stream = tweepy.Stream(auth=api.auth, listener=twitter_listener)
+    supervisor = StreamSupervisor(config_path, track_terms, track_locations)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload_handler)
+    twitter_listener = TwitterStreamListener(stream_name)
+    twitter_stream = create_stream(twitter_listener)
     start_stream(twitter_stream)
 
-    twitter_420_429s = 0
-    twitter_420_429_escalation = 0
-    last_tweet_milestone = 0
+    supervisor.run(twitter_stream)
 
-    while True:
-        # Handling 420 (Enhance Your Calm) and 429 (Too Many Requests) Errors
-        if log.last_twitter_error_message in (420, 429):
-            twitter_420_429s += 1
-            if twitter_420_429s > 3 and twitter_420_429_escalation == 3:
-                log.log_add(
-                    cfg['log_email_threshold'],
-                    'Too many 420/429s, Disengaging')
-                end_script(twitter_stream)
-            if twitter_420_429s == 3 and twitter_420_429_escalation == 2:
-                twitter_420_429_escalation = 3
-                log.log_add(1, 'Third 420/429, Sleeping for 5 Minutes')
-                sleep(300)
-            elif twitter_420_429s == 2 and twitter_420_429_escalation == 1:
-                twitter_420_429_escalation = 2
-                log.log_add(1, 'Second 420/429, Sleeping for 60 Seconds')
-                sleep(60)
-            elif twitter_420_429s == 1 and twitter_420_429_escalation == 0:
-                twitter_420_429_escalation = 1
-                log.log_add(1, 'First 420/429, Sleeping for 10 Seconds')
-                sleep(10)
-
-        # Handling 401 Error
-        if log.last_twitter_error_message == 401:
-            log.log_add(
-                cfg['log_email_threshold'],
-                'Twitter Authentication failed')
-            stop_stream(twitter_stream)
-            keep_running = False
-
-        # Printing current streaming status
-        current_count = twitter_listener.counter
-        if (current_count % cfg['report_steps'] == 0 and current_count > last_tweet_milestone):
-            last_tweet_milestone = current_count
-            print ('[{}] {} Tweets have been saved'.
-                   format(time.strftime("%Y-%m-%d %H:%M:%S"), current_count))
-            log.log_add(1, '{} Tweets have been saved'.format(current_count))
+
+if __name__ == '__main__':
+    main()
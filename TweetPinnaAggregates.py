@@ -0,0 +1,936 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Aggregates.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module maintains collections that are derived from the tweets while
+they are being written, so that the dashboard does not have to aggregate
+the whole collection.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+from pymongo import UpdateOne
+from TweetPinnaIngest import ENRICHMENT_FIELD
+from TweetPinnaIngest import get_created_date
+from TweetPinnaIngest import get_full_text
+from TweetPinnaIngest import get_hashtags
+import collections
+import datetime
+import random
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The characters str.split() splits at: \s, the Unicode separators and
+# the ASCII information separators
+TOKEN_PATTERN = r'[^\s\p{Z}\x{1c}-\x{1f}\x{85}]+'
+
+
+def get_tweet_hashtags(tweet):
+    """Returning the lowercase hashtags of a tweet, derived or computed.
+
+    :param dict tweet: the status
+    """
+    try:
+        return tweet[ENRICHMENT_FIELD]['hashtags']
+    except (KeyError, TypeError):
+        return get_hashtags(tweet)
+
+
+def get_tweet_created(tweet):
+    """Returning the (UTC) creation time of a tweet, derived or computed.
+
+    :param dict tweet: the status
+    """
+    try:
+        return tweet[ENRICHMENT_FIELD]['created']
+    except (KeyError, TypeError):
+        return get_created_date(tweet)
+
+
+def get_tweet_terms(tweet):
+    """Returning the tracking terms a tweet has matched, if known.
+
+    :param dict tweet: the status
+    """
+    try:
+        enrichment = tweet[ENRICHMENT_FIELD]
+    except (KeyError, TypeError):
+        return []
+
+    if 'matched_terms' in enrichment:
+        return enrichment['matched_terms']
+    return [enrichment['term']] if enrichment.get('term') else []
+
+
+def get_text_expression(status='$'):
+    """Returning an aggregation expression for the untruncated text of a
+    status, as get_full_text does without rebuilding retweets.
+
+    :param str status: the path of the status, e.g. '$retweeted_status.'
+    """
+    return {'$ifNull': [status + 'extended_tweet.full_text', {'$ifNull': [
+        status + 'full_text', {'$ifNull': [status + 'text', '']}]}]}
+
+
+def get_tokens_expression():
+    """Returning an aggregation expression for the number of tokens of a
+    tweet, counted like enrich_tweet: len(get_full_text(tweet).split()).
+
+    Requires MongoDB 4.2 ($regexFindAll).
+    """
+    def count(text):
+        return {'$size': {'$regexFindAll': {'input': text,
+                                             'regex': TOKEN_PATTERN}}}
+
+    # A rebuilt retweet adds 'RT' and '@screen_name:'
+    return {'$cond': [
+        {'$gt': ['$retweeted_status', None]},
+        {'$add': [2, count(get_text_expression('$retweeted_status.'))]},
+        count(get_text_expression())]}
+
+
+def get_hashtags_expression():
+    """Returning an aggregation expression for the lowercase hashtags of a
+    tweet, as returned by get_hashtags (unique, including the extended tweet
+    and the retweeted status)."""
+    paths = ('$entities.hashtags', '$extended_tweet.entities.hashtags',
+             '$retweeted_status.entities.hashtags',
+             '$retweeted_status.extended_tweet.entities.hashtags')
+    return {'$setUnion': [
+        {'$map': {'input': {'$ifNull': [path, []]}, 'as': 'hashtag',
+                  'in': {'$toLower': '$$hashtag.text'}}}
+        for path in paths]}
+
+
+def get_rollup_key(value):
+    """Returning a value that can be used as a MongoDB field name.
+
+    :param str value: e.g. a tracking term
+    """
+    return value.replace('.', '_').replace('$', '_')
+
+
+class HashtagCounter():
+    """Counting hashtags in a separate collection as tweets are written.
+
+    Every document is a lowercase hashtag (_id) and the number of tweets
+    using it (count). The counts of a batch are added with a single unordered
+    bulk write of $inc upserts.
+
+    The counts only include the tweets stored before TweetPinna started
+    counting once they have been seeded by rebuild; a marker in the state
+    collection records this.
+    """
+
+    # Counting the hashtags of all tweets like update does: the derived
+    # hashtags, or the same normalization applied to the entities
+    PIPELINE = [
+        {'$project': {'hashtags': {'$ifNull': [
+            '${}.hashtags'.format(ENRICHMENT_FIELD),
+            get_hashtags_expression()]}}},
+        {'$unwind': '$hashtags'},
+        {'$group': {'_id': '$hashtags', 'count': {'$sum': 1}}}]
+
+    SEEDED_ID = 'hashtags'
+
+    def __init__(self, collection, state_collection=None):
+        """Initialization.
+
+        :param object collection: the hashtag collection
+        :param object state_collection: the collection of the seeded marker,
+        see TweetStatistics; without it, the counts are considered seeded
+        """
+        self.collection = collection
+        self.state_collection = state_collection
+
+    @staticmethod
+    def collection_name(cfg):
+        """Returning the name of the hashtag collection of an instance.
+
+        :param object cfg: the TweetPinna configuration
+        """
+        return '{}_hashtags'.format(cfg['mongo_coll'])
+
+    def ensure_indexes(self):
+        """Creating the index used for sorting by frequency."""
+        self.collection.create_index([('count', DESCENDING),
+                                      ('_id', DESCENDING)], background=True)
+
+    def seeded(self):
+        """Returning whether the counts include the tweets stored before
+        counting started."""
+        if self.state_collection is None:
+            return True
+        return self.state_collection.find_one(
+            {'_id': self.SEEDED_ID}) is not None
+
+    def mark_seeded(self):
+        """Recording that the counts include all stored tweets."""
+        if self.state_collection is not None:
+            self.state_collection.update_one(
+                {'_id': self.SEEDED_ID},
+                {'$set': {'seeded': datetime.datetime.utcnow()}},
+                upsert=True)
+
+    def update(self, tweets):
+        """Adding the hashtags of written tweets to the counts.
+
+        :param list tweets: the tweets that have been written
+        """
+        counts = collections.Counter()
+        for tweet in tweets:
+            counts.update(get_tweet_hashtags(tweet))
+
+        if counts:
+            self.collection.bulk_write(
+                [UpdateOne({'_id': hashtag}, {'$inc': {'count': count}},
+                           upsert=True)
+                 for hashtag, count in counts.items()], ordered=False)
+
+    def top(self, skip=0, limit=0):
+        """Returning hashtags from highest to lowest frequency.
+
+        :param int skip: the number of hashtags to skip
+        :param int limit: the number of hashtags to return; 0 returns all
+        :return list: (hashtag, count) tuples
+        """
+        hashtags = self.collection.find().sort(
+            [('count', DESCENDING), ('_id', DESCENDING)]).skip(skip)
+        if limit > 0:
+            hashtags = hashtags.limit(limit)
+
+        return [(hashtag['_id'], hashtag['count']) for hashtag in hashtags]
+
+    def number(self):
+        """Returning the number of unique hashtags."""
+        return self.collection.estimated_document_count()
+
+    def rebuild(self, tweets):
+        """Replacing all counts with a full aggregation of the tweets.
+
+        Counts added by a running TweetPinna during the rebuild are lost.
+
+        :param object tweets: the tweet collection
+        """
+        tweets.aggregate(self.PIPELINE + [{'$out': self.collection.name}],
+                         allowDiskUse=True)
+        self.ensure_indexes()
+        self.mark_seeded()
+
+    def check(self, tweets):
+        """Comparing the counts with a full aggregation of the tweets.
+
+        :param object tweets: the tweet collection
+        :return list: (hashtag, counted, aggregated) for every difference
+        """
+        aggregated = tweets.aggregate(
+            self.PIPELINE + [{'$sort': {'_id': 1}}], allowDiskUse=True)
+        counted = self.collection.find().sort([('_id', 1)])
+
+        # Merging both sorted streams, so that neither is held in memory
+        differences = []
+        expected = next(aggregated, None)
+        actual = next(counted, None)
+        while expected is not None or actual is not None:
+            if actual is None or (expected is not None and
+                                  expected['_id'] < actual['_id']):
+                differences.append((expected['_id'], 0, expected['count']))
+                expected = next(aggregated, None)
+            elif expected is None or actual['_id'] < expected['_id']:
+                if actual['count'] != 0:
+                    differences.append((actual['_id'], actual['count'], 0))
+                actual = next(counted, None)
+            else:
+                if actual['count'] != expected['count']:
+                    differences.append((actual['_id'], actual['count'],
+                                        expected['count']))
+                expected = next(aggregated, None)
+                actual = next(counted, None)
+
+        return differences
+
+
+class TweetRollups():
+    """Counting tweets per minute in a separate collection.
+
+    Every document is a minute (_id, UTC) with the number of tweets created
+    in it (count), the number of those received from the stream (streamed,
+    i.e. carrying a timestamp_ms) and, with details, the numbers per source
+    (sources) and per tracking term (terms). Tweets that have not been
+    captured under load are counted as well (shed and dropped), they are
+    not part of count. Graphs and statistics sum these documents instead of
+    loading tweets.
+    """
+
+    def __init__(self, collection, details=True):
+        """Initialization.
+
+        :param object collection: the rollup collection
+        :param bool details: counting per source and tracking term
+        """
+        self.collection = collection
+        self.details = details
+
+    @staticmethod
+    def collection_name(cfg):
+        """Returning the name of the rollup collection of an instance.
+
+        :param object cfg: the TweetPinna configuration
+        """
+        return '{}_rollups'.format(cfg['mongo_coll'])
+
+    def update(self, tweets, source):
+        """Adding written tweets to the minutes they have been created in.
+
+        Tweets without a creation time are counted in the current minute.
+
+        :param list tweets: the tweets that have been written
+        :param source: the source of the tweets (e.g. stream, timeline) or a
+        function returning the source of a tweet; None is not counted
+        """
+        now = datetime.datetime.utcnow()
+        increments = collections.defaultdict(collections.Counter)
+        for tweet in tweets:
+            minute = (get_tweet_created(tweet) or now).replace(
+                second=0, microsecond=0)
+            counts = increments[minute]
+            counts['count'] += 1
+            if 'timestamp_ms' in tweet:
+                counts['streamed'] += 1
+
+            if self.details:
+                tweet_source = source(tweet) if callable(source) else source
+                if tweet_source:
+                    counts['sources.' + tweet_source] += 1
+                for term in get_tweet_terms(tweet):
+                    counts['terms.' + get_rollup_key(term)] += 1
+
+        if increments:
+            self.collection.bulk_write(
+                [UpdateOne({'_id': minute}, {'$inc': dict(counts)},
+                           upsert=True)
+                 for minute, counts in increments.items()], ordered=False)
+
+    def add_lost(self, lost_minutes):
+        """Adding the numbers of tweets that have not been captured under
+        load, so that statistics can be corrected.
+
+        :param dict lost_minutes: (minute, 'shed' or 'dropped') -> number of
+        tweets, see OverloadPolicy
+        """
+        increments = collections.defaultdict(dict)
+        for (minute, reason), lost in lost_minutes.items():
+            increments[minute][reason] = lost
+
+        if increments:
+            self.collection.bulk_write(
+                [UpdateOne({'_id': minute}, {'$inc': counts}, upsert=True)
+                 for minute, counts in increments.items()], ordered=False)
+
+    def start(self, n, field='count'):
+        """Returning the minute from which on the last n tweets have been
+        created.
+
+        :param int n: the number of tweets
+        :param str field: the count to add up, e.g. streamed
+        :return datetime: the minute; None if there are no rollups
+        """
+        start = None
+        total = 0
+        # Minutes without the count (e.g. with lost tweets only, see
+        # add_lost) are skipped
+        for rollup in self.collection.find(
+                {field: {'$gt': 0}}, {field: 1}).sort([('_id', DESCENDING)]):
+            start = rollup['_id']
+            total += rollup[field]
+            if total >= n:
+                break
+
+        return start
+
+    def totals(self, period, start=None, end=None, field='count'):
+        """Returning the number of tweets per period.
+
+        :param int period: the length of a period in minutes, e.g. 60
+        :param datetime start: the first minute to include
+        :param datetime end: the first minute not to include
+        :param str field: the count to add up, e.g. streamed
+        :return list: (beginning of the period, count) tuples, oldest first
+        """
+        # Periods without the count (e.g. with timeline tweets only when
+        # counting streamed tweets) are left out
+        match = {field: {'$gt': 0}}
+        if start is not None:
+            match['_id'] = {'$gte': start}
+        if end is not None:
+            match.setdefault('_id', {})['$lt'] = end
+
+        # Truncating the minutes to the beginning of their period
+        length = period * 60 * 1000
+        pipeline = [
+            {'$match': match},
+            {'$group': {
+                '_id': {'$subtract': ['$_id', {'$mod': [
+                    {'$subtract': ['$_id', EPOCH]}, length]}]},
+                'count': {'$sum': '$' + field}}},
+            {'$sort': {'_id': 1}}]
+
+        return [(total['_id'], total['count'])
+                for total in self.collection.aggregate(pipeline,
+                                                       allowDiskUse=True)]
+
+    def total(self, start=None, fields=('count',)):
+        """Returning the number of tweets created since a given minute.
+
+        :param datetime start: the first minute to include; None for all
+        :param tuple fields: the counts to add up, e.g. ('shed', 'dropped')
+        for the tweets that have not been captured
+        """
+        pipeline = [
+            {'$match': {'_id': {'$gte': start}} if start else {}},
+            {'$group': {'_id': None, 'count': {'$sum': {
+                '$add': [{'$ifNull': ['$' + field, 0]}
+                         for field in fields]}}}}]
+        totals = list(self.collection.aggregate(pipeline))
+        return totals[0]['count'] if totals else 0
+
+    def rebuild(self, tweets, batch_size=1000):
+        """Replacing all rollups with a recount of the tweets.
+
+        The source of stored tweets is unknown, only tweets carrying a
+        timestamp_ms are attributed to the stream. The numbers of tweets
+        that have not been captured (see add_lost) are carried over. Counts
+        added by a running TweetPinna during the rebuild are lost.
+
+        :param object tweets: the tweet collection
+        :param int batch_size: the number of tweets per bulk write
+        """
+        rebuilt = TweetRollups(
+            self.collection.database[self.collection.name + '_rebuild'],
+            self.details)
+        rebuilt.collection.drop()
+
+        projection = {'timestamp_ms': 1, 'created_at': 1,
+                      ENRICHMENT_FIELD + '.created': 1,
+                      ENRICHMENT_FIELD + '.term': 1,
+                      ENRICHMENT_FIELD + '.matched_terms': 1}
+        stream = (lambda tweet: 'stream' if 'timestamp_ms' in tweet
+                  else None)
+
+        batch = []
+        for tweet in tweets.find({}, projection).sort([('_id', 1)]):
+            batch.append(tweet)
+            if len(batch) >= batch_size:
+                rebuilt.update(batch, stream)
+                batch = []
+        rebuilt.update(batch, stream)
+
+        # The lost tweets cannot be recounted from the stored ones
+        lost = [UpdateOne({'_id': rollup['_id']}, {'$set': {
+                    reason: rollup[reason] for reason in ('shed', 'dropped')
+                    if reason in rollup}}, upsert=True)
+                for rollup in self.collection.find(
+                    {'$or': [{'shed': {'$exists': True}},
+                             {'dropped': {'$exists': True}}]},
+                    {'shed': 1, 'dropped': 1})]
+        if lost:
+            rebuilt.collection.bulk_write(lost, ordered=False)
+
+        if rebuilt.collection.estimated_document_count() > 0:
+            rebuilt.collection.rename(self.collection.name, dropTarget=True)
+        else:
+            self.collection.drop()
+
+
+class TweetStatistics():
+    """Keeping running totals of the tweet collection.
+
+    The totals (documents, documents per source, tokens, hashtags and media
+    items) are stored in a single document, together with the _id of the
+    last tweet they include (the watermark). A refresh only aggregates the
+    tweets after the watermark, so its cost depends on the number of new
+    tweets, not on the size of the collection.
+
+    Media are counted as items, since tweets do not contain the sizes of
+    the files; the bytes of the downloaded media are kept by MediaManifest.
+
+    Tweets are only included once they are lag seconds old, so that batches
+    still being written are not skipped. Tweets replayed from the buffer
+    receive their _id when they are replayed (see TweetSpool), so they are
+    counted like new tweets; only tweets written with an _id older than
+    lag seconds would be missed until the totals are rebuilt.
+    """
+
+    TOTALS_ID = 'totals'
+
+    # Tweets aggregated at once
+    BATCH_SIZE = 50000
+
+    # Streamed tweets carry timestamp_ms, tweets from the REST API (timeline
+    # and replies) do not
+    SOURCES = ('stream', 'rest')
+
+    def __init__(self, collection):
+        """Initialization.
+
+        :param object collection: the statistics collection
+        """
+        self.collection = collection
+
+    @staticmethod
+    def collection_name(cfg):
+        """Returning the name of the statistics collection of an instance.
+
+        :param object cfg: the TweetPinna configuration
+        """
+        return '{}_statistics'.format(cfg['mongo_coll'])
+
+    @staticmethod
+    def pipeline(match, batch_size):
+        """Returning the pipeline summing up a batch of tweets.
+
+        Derived fields are used where they exist; otherwise, the tokens
+        and hashtags are counted the same way by the server (see
+        get_tokens_expression and get_hashtags_expression).
+
+        :param dict match: the filter on _id
+        :param int batch_size: the number of tweets
+        """
+        return [
+            {'$match': {'_id': match}},
+            {'$sort': {'_id': 1}},
+            {'$limit': batch_size},
+            {'$group': {
+                '_id': None,
+                'last': {'$max': '$_id'},
+                'documents': {'$sum': 1},
+                'stream': {'$sum': {
+                    '$cond': [{'$gt': ['$timestamp_ms', None]}, 1, 0]}},
+                'tokens': {'$sum': {'$ifNull': [
+                    '${}.tokens'.format(ENRICHMENT_FIELD),
+                    get_tokens_expression()]}},
+                'hashtags': {'$sum': {'$size': {'$ifNull': [
+                    '${}.hashtags'.format(ENRICHMENT_FIELD),
+                    get_hashtags_expression()]}}},
+                'media': {'$sum': {'$size': {'$ifNull': [
+                    '$extended_entities.media',
+                    {'$ifNull': ['$entities.media', []]}]}}}}}]
+
+    def totals(self):
+        """Returning the stored totals without refreshing them."""
+        totals = self.collection.find_one({'_id': self.TOTALS_ID}) or {}
+        result = {field: totals.get(field, 0)
+                  for field in ('documents', 'tokens', 'hashtags', 'media')}
+        result['sources'] = {source: totals.get('sources', {}).get(source, 0)
+                             for source in self.SOURCES}
+        result['watermark'] = totals.get('watermark')
+        return result
+
+    def refresh(self, tweets, lag=60, max_documents=0):
+        """Adding the tweets after the watermark to the totals.
+
+        Concurrent refreshes do not count tweets twice: a batch is only
+        added if the watermark has not been moved in the meantime.
+
+        :param object tweets: the tweet collection
+        :param int lag: the minimum age (s) of the tweets to include
+        :param int max_documents: stopping after about this many tweets,
+        the rest is added by the next refresh; 0 for no limit
+        :return int: the number of tweets added
+        """
+        self.collection.update_one(
+            {'_id': self.TOTALS_ID},
+            {'$setOnInsert': {'watermark': None}}, upsert=True)
+        watermark = self.totals()['watermark']
+        until = ObjectId.from_datetime(
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=lag))
+
+        added = 0
+        while not max_documents or added < max_documents:
+            match = {'$lt': until}
+            if watermark is not None:
+                match['$gt'] = watermark
+            batch = list(tweets.aggregate(
+                self.pipeline(match, self.BATCH_SIZE), allowDiskUse=True))
+            if not batch or not batch[0]['documents']:
+                break
+
+            batch = batch[0]
+            result = self.collection.update_one(
+                {'_id': self.TOTALS_ID, 'watermark': watermark},
+                {'$set': {'watermark': batch['last'],
+                          'updated': datetime.datetime.utcnow()},
+                 '$inc': {'documents': batch['documents'],
+                          'sources.stream': batch['stream'],
+                          'sources.rest': batch['documents'] -
+                          batch['stream'],
+                          'tokens': batch['tokens'],
+                          'hashtags': batch['hashtags'],
+                          'media': batch['media']}})
+            if result.modified_count == 0:
+                # Another refresh has moved the watermark
+                break
+
+            watermark = batch['last']
+            added += batch['documents']
+
+        return added
+
+    def rebuild(self, tweets):
+        """Recounting the totals from scratch.
+
+        :param object tweets: the tweet collection
+        :return int: the number of tweets counted
+        """
+        self.collection.delete_one({'_id': self.TOTALS_ID})
+        return self.refresh(tweets)
+
+
+class UserSummaries():
+    """Summarizing the tweets of the tracked users.
+
+    Every document is a tracked screen name (_id) with the number of its
+    tweets, the latest tweet and the profile image of the latest tweet.
+    Summaries are created from the stored tweets (build, using the index on
+    user.screen_name and id) and then updated as tweets are written, so the
+    timelines page reads one document per user instead of all of their
+    tweets.
+
+    Tweets written by a running TweetPinna while a summary is built may be
+    missed until it is rebuilt.
+    """
+
+    def __init__(self, collection, tweets, screen_names):
+        """Initialization.
+
+        :param object collection: the summaries collection
+        :param object tweets: the tweet collection
+        :param list screen_names: the tracked users, with or without @
+        """
+        self.collection = collection
+        self.tweets = tweets
+        self.screen_names = [screen_name.lstrip('@')
+                             for screen_name in screen_names]
+
+    @staticmethod
+    def collection_name(cfg):
+        """Returning the name of the summaries collection of an instance.
+
+        :param object cfg: the TweetPinna configuration
+        """
+        return '{}_user_summaries'.format(cfg['mongo_coll'])
+
+    @staticmethod
+    def get_latest(tweet):
+        """Returning the fields of a summary taken from the latest tweet.
+
+        :param dict tweet: the latest tweet of the user
+        """
+        return {'user_id': tweet['user'].get('id'),
+                'last_id': tweet['id'],
+                'last_tweet': get_full_text(tweet),
+                'last_tweet_date': tweet.get('created_at'),
+                'profile_image_url': tweet['user'].get(
+                    'profile_image_url_https')}
+
+    def ensure_indexes(self):
+        """Creating the index on the tweets used to build the summaries."""
+        self.tweets.create_index([('user.screen_name', ASCENDING),
+                                  ('id', DESCENDING)], background=True)
+
+    def summarize(self, screen_name):
+        """Returning the summary of a user computed from the stored tweets.
+
+        :param str screen_name: the screen name, without @
+        """
+        query = {'user.screen_name': screen_name}
+        latest = self.tweets.find_one(query, sort=[('id', DESCENDING)])
+        summary = {'_id': screen_name,
+                   'count': self.tweets.count_documents(query),
+                   'last_id': 0}
+        if latest:
+            summary.update(self.get_latest(latest))
+
+        return summary
+
+    def build(self, screen_name):
+        """Creating or replacing the summary of a user from the stored tweets.
+
+        :param str screen_name: the screen name, without @
+        """
+        self.collection.replace_one({'_id': screen_name},
+                                    self.summarize(screen_name), upsert=True)
+
+    def build_missing(self):
+        """Building the summaries of tracked users which have none.
+
+        :return int: the number of summaries built
+        """
+        existing = set(summary['_id'] for summary in self.collection.find(
+            {'_id': {'$in': self.screen_names}}, {'_id': 1}))
+        missing = [screen_name for screen_name in self.screen_names
+                   if screen_name not in existing]
+        for screen_name in missing:
+            self.build(screen_name)
+
+        return len(missing)
+
+    def update(self, tweets):
+        """Adding written tweets of tracked users to their summaries.
+
+        :param list tweets: the tweets that have been written
+        """
+        counts = collections.Counter()
+        latest = {}
+        for tweet in tweets:
+            screen_name = (tweet.get('user') or {}).get('screen_name')
+            if screen_name not in self.screen_names:
+                continue
+            counts[screen_name] += 1
+            if screen_name not in latest or \
+                    tweet['id'] > latest[screen_name]['id']:
+                latest[screen_name] = tweet
+
+        operations = []
+        for screen_name, count in counts.items():
+            operations.append(UpdateOne({'_id': screen_name},
+                                        {'$inc': {'count': count}}))
+            # Only replacing the latest tweet by a newer one
+            operations.append(UpdateOne(
+                {'_id': screen_name,
+                 'last_id': {'$lt': latest[screen_name]['id']}},
+                {'$set': self.get_latest(latest[screen_name])}))
+
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def summaries(self):
+        """Returning the summaries of the tracked users, in their order.
+
+        Users without a summary are missing.
+        """
+        summaries = {summary['_id']: summary for summary in
+                     self.collection.find({'_id': {'$in': self.screen_names}})}
+        return [summaries[screen_name] for screen_name in self.screen_names
+                if screen_name in summaries]
+
+    def rebuild(self):
+        """Rebuilding the summaries of all tracked users.
+
+        :return int: the number of tweets of the tracked users
+        """
+        self.collection.delete_many(
+            {'_id': {'$nin': self.screen_names}})
+        for screen_name in self.screen_names:
+            self.build(screen_name)
+
+        return sum(summary['count'] for summary in self.summaries())
+
+
+class TweetSample():
+    """Keeping a uniform random sample of all stored tweets (a reservoir).
+
+    The sample has a fixed number of slots (documents with _id 0 to size-1,
+    referencing a tweet by its id); a counter document holds the number of
+    tweets seen. The n-th tweet takes a slot if n <= size, otherwise it
+    replaces a random slot with probability size/n, so every stored tweet
+    is in the sample with the same probability. Reading n random tweets
+    takes two small queries, regardless of the size of the collection.
+
+    Tweets are only sampled once the sample has been initialized: drawn
+    from the stored tweets by rebuild, or started empty for an empty
+    archive. Otherwise, it would only represent the tweets written since.
+    """
+
+    COUNTER_ID = 'seen'
+
+    def __init__(self, collection, size=5000):
+        """Initialization.
+
+        :param object collection: the sample collection
+        :param int size: the number of tweets in the sample
+        """
+        self.collection = collection
+        self.size = size
+
+    @staticmethod
+    def collection_name(cfg):
+        """Returning the name of the sample collection of an instance.
+
+        :param object cfg: the TweetPinna configuration
+        """
+        return '{}_sample'.format(cfg['mongo_coll'])
+
+    def seen(self):
+        """Returning the number of tweets the sample has been drawn from, or
+        None if it has not been initialized."""
+        counter = self.collection.find_one({'_id': self.COUNTER_ID})
+        return counter['count'] if counter else None
+
+    def initialize(self):
+        """Starting an empty sample, for an archive without tweets."""
+        self.collection.update_one({'_id': self.COUNTER_ID},
+                                   {'$setOnInsert': {'count': 0}},
+                                   upsert=True)
+
+    def update(self, tweets):
+        """Sampling written tweets, if the sample has been initialized.
+
+        :param list tweets: the tweets that have been written
+        """
+        ids = [tweet['id'] for tweet in tweets if 'id' in tweet]
+        if not ids:
+            return
+
+        # Reserving the positions of the tweets, so that concurrent writers
+        # continue each other's count
+        counter = self.collection.find_one_and_update(
+            {'_id': self.COUNTER_ID}, {'$inc': {'count': len(ids)}})
+        if counter is None:
+            return
+        seen = counter['count']
+
+        slots = {}
+        for position, tweet_id in enumerate(ids, seen):
+            if position < self.size:
+                slots[position] = tweet_id
+            else:
+                slot = random.randrange(position + 1)
+                if slot < self.size:
+                    slots[slot] = tweet_id
+
+        if slots:
+            self.collection.bulk_write(
+                [UpdateOne({'_id': slot}, {'$set': {'id': tweet_id}},
+                           upsert=True)
+                 for slot, tweet_id in slots.items()], ordered=False)
+
+    def sample(self, tweets, n):
+        """Returning up to n random tweets of the sample.
+
+        :param object tweets: the tweet collection
+        :param int n: the number of tweets; at most the size of the sample
+        :return list: the tweets
+        """
+        filled = min(self.seen() or 0, self.size)
+        slots = random.sample(range(filled), min(max(n, 0), filled))
+        if not slots:
+            return []
+
+        ids = [slot['id'] for slot in self.collection.find(
+            {'_id': {'$in': slots}}, {'id': 1})]
+        sample = list(tweets.find({'id': {'$in': ids}}))
+        random.shuffle(sample)
+        return sample
+
+    def rebuild(self, tweets):
+        """Drawing a new sample from all stored tweets.
+
+        :param object tweets: the tweet collection
+        :return int: the number of tweets sampled
+        """
+        count = tweets.estimated_document_count()
+        sample = [tweet['id'] for tweet in tweets.aggregate(
+            [{'$sample': {'size': self.size}}, {'$project': {'id': 1}}],
+            allowDiskUse=True) if 'id' in tweet]
+
+        self.collection.delete_many({})
+        if sample:
+            self.collection.insert_many(
+                [{'_id': slot, 'id': tweet_id}
+                 for slot, tweet_id in enumerate(sample)])
+        self.collection.replace_one({'_id': self.COUNTER_ID},
+                                    {'count': max(count, len(sample))},
+                                    upsert=True)
+
+        return len(sample)
+
+
+class Aggregates():
+    """Keeping the enabled derived collections up to date."""
+
+    def __init__(self, cfg, db):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object db: the MongoDB database
+        """
+        self.tweets = db[cfg['mongo_coll']]
+
+        self.hashtags = None
+        if cfg['ingest_hashtag_counts'] == 1:
+            self.hashtags = HashtagCounter(
+                db[HashtagCounter.collection_name(cfg)],
+                db[TweetStatistics.collection_name(cfg)])
+
+        self.rollups = None
+        if cfg['ingest_rollups'] == 1:
+            self.rollups = TweetRollups(
+                db[TweetRollups.collection_name(cfg)],
+                cfg['ingest_rollups_details'] == 1)
+
+        self.users = None
+        if cfg['ingest_user_summaries'] == 1 and \
+                cfg['twitter_tracking_users']:
+            self.users = UserSummaries(
+                db[UserSummaries.collection_name(cfg)], db[cfg['mongo_coll']],
+                cfg['twitter_tracking_users'])
+
+        self.sample = None
+        if cfg['ingest_sample'] == 1:
+            self.sample = TweetSample(db[TweetSample.collection_name(cfg)],
+                                      cfg['ingest_sample_size'])
+
+    def ensure_indexes(self):
+        """Creating the indexes of the derived collections and initializing
+        those which need no rebuild."""
+        if self.hashtags:
+            self.hashtags.ensure_indexes()
+            # An empty archive needs no seeding; otherwise, the counts are
+            # seeded by rebuild-hashtags
+            if not self.hashtags.seeded() and \
+                    self.tweets.find_one({}, {'_id': 1}) is None:
+                self.hashtags.mark_seeded()
+        if self.users:
+            self.users.ensure_indexes()
+            self.users.build_missing()
+        # An empty archive needs no initial draw; otherwise, the sample is
+        # drawn by rebuild-sample
+        if self.sample and self.sample.seen() is None and \
+                self.tweets.find_one({}, {'_id': 1}) is None:
+            self.sample.initialize()
+
+    def update(self, tweets, source):
+        """Adding tweets that have been written to the derived collections.
+
+        :param list tweets: the tweets that have been written
+        :param source: the source of the tweets (stream, location, timeline
+        or replies) or a function returning the source of a tweet
+        """
+        if self.hashtags:
+            self.hashtags.update(tweets)
+        if self.rollups:
+            self.rollups.update(tweets, source)
+        if self.users:
+            self.users.update(tweets)
+        if self.sample:
+            self.sample.update(tweets)
+
+    def add_lost(self, lost_minutes):
+        """Recording the numbers of tweets that have not been captured.
+
+        :param dict lost_minutes: (minute, 'shed' or 'dropped') -> number of
+        tweets
+        """
+        if self.rollups:
+            self.rollups.add_lost(lost_minutes)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Alerts.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module sends the alert emails of the logger on a background thread.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from email.mime.text import MIMEText
+import collections
+import queue
+import smtplib
+import threading
+import time
+
+
+class AlertDispatcher():
+    """Sending alert emails without blocking the thread that logged them.
+
+    Alerts arriving within email_digest_wait seconds of the first one are
+    sent together as a digest. An alert is sent at most once every
+    email_spam_wait minutes; repetitions in between are counted and
+    mentioned in the next email. The SMTP session is kept open and reused.
+    """
+
+    def __init__(self, cfg, log):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object log: the TweetPinna logger
+        """
+        self.cfg = cfg
+        self.log = log
+        self.digest_wait = cfg['email_digest_wait']
+        self.spam_wait = cfg['email_spam_wait'] * 60
+        self.queue = queue.Queue(maxsize=1000)
+        self.smtp = None
+
+        # Time of the last email and number of suppressed alerts per key
+        self.last_sent = {}
+        self.suppressed = collections.Counter()
+
+        # Statistics
+        self.sent = 0
+        self.dropped = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name='AlertDispatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def alert(self, subject, message, key=None):
+        """Queueing an alert. Never blocks.
+
+        :param str subject: the subject of the email
+        :param str message: the body of the message
+        :param str key: alerts with the same key are rate limited together;
+        defaults to the message
+        """
+        try:
+            self.queue.put_nowait((key or message, subject, message,
+                                   time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout=10):
+        """Sending the queued alerts and closing the SMTP session.
+
+        :param int timeout: seconds to wait for the dispatcher
+        """
+        if self.stopped.is_set():
+            return
+
+        self.stopped.set()
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    def _run(self):
+        """Collecting alerts into digests until None is received."""
+        stop = False
+        while not stop:
+            alert = self.queue.get()
+            if alert is None:
+                break
+
+            # Coalescing the rest of a burst; not waiting once stopped
+            alerts = [alert]
+            deadline = time.time() + self.digest_wait
+            while not self.stopped.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    alert = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if alert is None:
+                    stop = True
+                    break
+                alerts.append(alert)
+
+            try:
+                self._dispatch(alerts)
+            except Exception as e:
+                self.log.log_add(self.cfg['log_email_threshold'] - 1,
+                                 'Could not send email ({})'.format(e))
+
+        self._close_session()
+
+    def _dispatch(self, alerts):
+        """Sending the alerts that are not suppressed as one email.
+
+        :param list alerts: (key, subject, message, time) tuples
+        """
+        now = time.time()
+        entries = collections.OrderedDict()
+        for key, subject, message, created in alerts:
+            if key in entries:
+                entries[key]['count'] += 1
+            elif now - self.last_sent.get(key, 0) < self.spam_wait:
+                self.suppressed[key] += 1
+                self.log.log_add(2, 'Email has not been sent to prevent spam')
+            else:
+                entries[key] = {'subject': subject, 'message': message,
+                                'time': created, 'count': 1}
+
+        if not entries:
+            return
+
+        for key, entry in entries.items():
+            entry['count'] += self.suppressed.pop(key, 0)
+
+        if len(entries) == 1:
+            entry = list(entries.values())[0]
+            subject = entry['subject']
+            body = entry['message']
+            if entry['count'] > 1:
+                body += '\n\n(logged {} times)'.format(entry['count'])
+        else:
+            subject = 'Digest of {} Events in {}'.format(
+                len(entries), self.cfg['instance_name'])
+            lines = []
+            for entry in entries.values():
+                lines.append('[{}] {}: {}{}'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(entry['time'])),
+                    entry['subject'], entry['message'],
+                    ' (logged {} times)'.format(entry['count'])
+                    if entry['count'] > 1 else ''))
+            body = '\n'.join(lines)
+
+        if self._send(subject, body):
+            for key in entries:
+                self.last_sent[key] = now
+            self.sent += 1
+            self.log.log_add(1, 'Email sent')
+
+    def _send(self, subject, body):
+        """Sending an email, reconnecting once if the session has been lost.
+
+        :param str subject: the subject of the email
+        :param str body: the body of the email
+        :return bool: whether the email has been sent
+        """
+        msg = MIMEText(body)
+        msg['Subject'] = subject
+        msg['From'] = self.cfg['email_sender']
+        msg['To'] = self.cfg['email_receiver']
+
+        error = None
+        for attempt in range(2):
+            try:
+                if self.smtp is None:
+                    self.smtp = self._connect()
+                self.smtp.sendmail(self.cfg['email_sender'],
+                                   [self.cfg['email_receiver']],
+                                   msg.as_string())
+                return True
+            except (smtplib.SMTPException, OSError) as e:
+                # E.g. the server has closed the idle session
+                error = e
+                self._close_session()
+
+        self.log.log_add(self.cfg['log_email_threshold'] - 1,
+                         'Could not send email ({})'.format(error))
+        return False
+
+    def _connect(self):
+        """Opening an SMTP session."""
+        smtp = smtplib.SMTP(self.cfg['email_server'],
+                            self.cfg['email_server_port'], timeout=30)
+        if self.cfg['email_starttls'] == 1:
+            smtp.starttls()
+        if self.cfg['email_user']:
+            smtp.login(self.cfg['email_user'], self.cfg['email_password'])
+        return smtp
+
+    def _close_session(self):
+        """Closing the SMTP session, if any."""
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Benchmark.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This script benchmarks parts of the ingest pipeline using synthetic
+tweets. It does not need a Twitter connection.
+
+Benchmarks:
+    raw [n]             CPU time per tweet of the raw JSON ingest path
+                        compared to building tweepy Status objects
+    ingest [n] [rate]   end-to-end ingest of n tweets sent at rate tweets/s
+                        (0 is unlimited) by a local TweetPinnaStreamServer;
+                        needs the MongoDB of cfg/TweetPinnaDefault.cfg
+    matcher [n]         time per tweet of matching 10 to 1000 tracking
+                        terms, one term at a time and with the TermMatcher
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+
+Example:
+    $ python TweetPinnaBenchmark.py raw 20000
+    $ python TweetPinnaBenchmark.py ingest 100000 0
+    $ python TweetPinnaBenchmark.py matcher 5000
+"""
+
+from TweetPinnaIngest import parse_raw_status
+from TweetPinnaMatcher import get_searchable_text
+from TweetPinnaMatcher import TermMatcher
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+WORDS = ['the', 'archive', 'stream', 'tweet', 'data', 'research', 'news',
+         'city', 'today', 'people', 'vote', 'weather', 'music', 'game',
+         'open', 'science', 'photo', 'live', 'update', 'thanks']
+
+
+def generate_tweet(number, terms=(), seed=None):
+    """Generating a synthetic status resembling a streamed v1.1 tweet.
+
+    :param int number: a running number which determines the ids
+    :param list terms: terms of which one is mentioned in the text
+    :param int seed: seed for the random choices (defaults to number)
+    :return dict: the status
+    """
+    rnd = random.Random(number if seed is None else seed)
+    now = datetime.datetime.utcnow()
+    tweet_id = 1200000000000000000 + number
+    user_id = rnd.randint(1, 50000)
+    screen_name = 'user{}'.format(user_id)
+
+    words = [rnd.choice(WORDS) for i in range(rnd.randint(5, 25))]
+    hashtags = [rnd.choice(WORDS) for i in range(rnd.randint(0, 3))]
+    if terms:
+        words.insert(rnd.randint(0, len(words)), rnd.choice(terms))
+    text = ' '.join(words + ['#' + hashtag for hashtag in hashtags])
+
+    user = {
+        'id': user_id, 'id_str': str(user_id), 'name': 'User {}'.format(user_id),
+        'screen_name': screen_name, 'location': 'Somewhere',
+        'url': None, 'description': ' '.join(rnd.choice(WORDS)
+                                             for i in range(12)),
+        'translator_type': 'none', 'protected': False, 'verified': False,
+        'followers_count': rnd.randint(0, 10000),
+        'friends_count': rnd.randint(0, 2000), 'listed_count': 3,
+        'favourites_count': rnd.randint(0, 5000),
+        'statuses_count': rnd.randint(0, 50000),
+        'created_at': 'Mon Jan 01 10:00:00 +0000 2012',
+        'utc_offset': None, 'time_zone': None, 'geo_enabled': False,
+        'lang': None, 'contributors_enabled': False, 'is_translator': False,
+        'profile_background_color': 'C0DEED',
+        'profile_background_image_url':
+            'http://abs.twimg.com/images/themes/theme1/bg.png',
+        'profile_background_image_url_https':
+            'https://abs.twimg.com/images/themes/theme1/bg.png',
+        'profile_background_tile': False,
+        'profile_link_color': '1DA1F2',
+        'profile_sidebar_border_color': 'C0DEED',
+        'profile_sidebar_fill_color': 'DDEEF6',
+        'profile_text_color': '333333',
+        'profile_use_background_image': True,
+        'profile_image_url':
+            'http://pbs.twimg.com/profile_images/{}/a_normal.jpg'.format(
+                user_id),
+        'profile_image_url_https':
+            'https://pbs.twimg.com/profile_images/{}/a_normal.jpg'.format(
+                user_id),
+        'default_profile': True, 'default_profile_image': False,
+        'following': None, 'follow_request_sent': None,
+        'notifications': None}
+
+    tweet = {
+        'created_at': now.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+        'id': tweet_id, 'id_str': str(tweet_id), 'text': text[:140],
+        'source': '<a href="http://twitter.com" rel="nofollow">Twitter Web '
+                  'Client</a>',
+        'truncated': len(text) > 140,
+        'in_reply_to_status_id': None, 'in_reply_to_status_id_str': None,
+        'in_reply_to_user_id': None, 'in_reply_to_user_id_str': None,
+        'in_reply_to_screen_name': None, 'user': user, 'geo': None,
+        'coordinates': None, 'place': None, 'contributors': None,
+        'is_quote_status': False, 'quote_count': 0, 'reply_count': 0,
+        'retweet_count': 0, 'favorite_count': 0,
+        'entities': {
+            'hashtags': [{'text': hashtag, 'indices': [0, 0]}
+                         for hashtag in hashtags],
+            'urls': [], 'user_mentions': [], 'symbols': []},
+        'favorited': False, 'retweeted': False, 'filter_level': 'low',
+        'lang': 'en',
+        'timestamp_ms': str(int(time.time() * 1000))}
+
+    if tweet['truncated']:
+        tweet['extended_tweet'] = {
+            'full_text': text, 'display_text_range': [0, len(text)],
+            'entities': tweet['entities']}
+
+    if rnd.random() < 0.3:
+        retweeted = dict(tweet)
+        retweeted['id'] = tweet_id - 1000
+        retweeted['id_str'] = str(retweeted['id'])
+        tweet['retweeted_status'] = retweeted
+        tweet['text'] = 'RT @{}: {}'.format(screen_name, tweet['text'])[:140]
+
+    return tweet
+
+
+def benchmark_raw(n=20000):
+    """Comparing the CPU time per tweet of both ingest paths.
+
+    :param int n: the number of tweets to parse
+    """
+    raw_tweets = [json.dumps(generate_tweet(i)) for i in range(n)]
+    size = sum(len(raw_tweet) for raw_tweet in raw_tweets) / n
+    print('{} synthetic tweets, avg. {} bytes'.format(n, round(size)))
+
+    # Raw path: fast JSON parser, dict handed to the writer
+    start = time.process_time()
+    for raw_tweet in raw_tweets:
+        document = parse_raw_status(raw_tweet)
+        document.get('id')
+    raw_time = time.process_time() - start
+    print('raw path:    {} us/tweet'.format(round(raw_time / n * 1000000, 1)))
+
+    # Current path: tweepy parses the JSON and builds a Status model graph
+    try:
+        import tweepy
+    except ImportError:
+        print('tweepy path: skipped, tweepy is not installed')
+        return
+
+    api = tweepy.API()
+    start = time.process_time()
+    for raw_tweet in raw_tweets:
+        status = tweepy.models.Status.parse(api, json.loads(raw_tweet))
+        status._json.get('id')
+    tweepy_time = time.process_time() - start
+    print('tweepy path: {} us/tweet'.format(
+        round(tweepy_time / n * 1000000, 1)))
+    print('speedup:     {}x'.format(round(tweepy_time / raw_time, 1)))
+
+
+def get_memory_usage():
+    """Returning the resident memory of this process in bytes (Linux)."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError):
+        return 0
+
+
+def benchmark_ingest(n=100000, rate=0):
+    """Measuring the whole ingest, from the TLS stream to MongoDB.
+
+    TweetPinna runs in this process against a local TweetPinnaStreamServer
+    and writes to <mongo_coll>_benchmark, which is dropped afterwards.
+
+    :param int n: the number of tweets to stream
+    :param int rate: tweets per second; 0 sends as fast as possible
+    """
+    from pymongo import MongoClient
+    from TweetPinnaStreamServer import create_certificate
+    from TweetPinnaStreamServer import StreamServer
+    from TweetPinnaStreamServer import synthetic_tweets
+    import config
+    import TweetPinna
+
+    cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
+    cfg['instance_name'] = 'TweetPinnaBenchmark'
+    cfg['mongo_coll'] = '{}_benchmark'.format(cfg['mongo_coll'])
+    cfg['log_email_enabled'] = 0
+    cfg['media_download_instantly'] = 0
+    cfg['tweet_buffer'] = 0
+
+    mongo_client = MongoClient(cfg['mongo_path'], serverSelectionTimeoutMS=2000)
+    try:
+        mongo_client.server_info()
+    except Exception as e:
+        print('MongoDB is not available at {} ({})'.format(cfg['mongo_path'], e))
+        return
+    mongo_client[cfg['mongo_db']].drop_collection(cfg['mongo_coll'])
+
+    # Stand-in stream
+    certfile, keyfile = create_certificate(tempfile.mkdtemp())
+    terms = ['benchmark']
+    server = StreamServer(('127.0.0.1', 0), synthetic_tweets(n, terms),
+                          certfile, keyfile, rate=rate)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    cfg['twitter_stream_host'] = 'localhost:{}'.format(server.server_address[1])
+    cfg['twitter_stream_verify'] = certfile
+
+    # TweetPinna, set up like TweetPinna.main() does
+    TweetPinna.cfg = cfg
+    TweetPinna.log = TweetPinna.Logger(cfg)
+    TweetPinna.tracking_terms = terms
+    TweetPinna.tracking_locations = []
+    TweetPinna.supervisor = TweetPinna.StreamSupervisor()
+    listener = TweetPinna.TwitterStreamListener('benchmark')
+    stream = TweetPinna.create_stream(listener)
+    TweetPinna.twitter_listener = listener
+    TweetPinna.twitter_stream = stream
+
+    memory_start = get_memory_usage()
+    memory_max = memory_start
+    print('Streaming {} synthetic tweets at {}'.format(
+        n, '{} tweets/s'.format(rate) if rate else 'full speed'))
+    TweetPinna.start_stream(stream)
+    supervisor_thread = threading.Thread(target=TweetPinna.supervisor.run,
+                                         args=(stream,))
+    supervisor_thread.daemon = True
+    supervisor_thread.start()
+
+    # Waiting until everything has been sent and nothing has changed for
+    # a few flush intervals
+    idle_timeout = max(5, cfg['mongo_batch_max_age'] * 3)
+    last_progress = time.time()
+    last_state = None
+    last_commit = None
+    while time.time() - last_progress < idle_timeout:
+        time.sleep(0.1)
+        memory_max = max(memory_max, get_memory_usage())
+        state = (server.sent, listener.writer.flushed_documents,
+                 listener.ingest_queue.dropped)
+        if state != last_state:
+            if last_state and state[1] != last_state[1]:
+                last_commit = time.time()
+            last_state = state
+            last_progress = time.time()
+
+    TweetPinna.stop_stream(stream)
+    server.stop()
+
+    # Results
+    sent = server.sent
+    committed = listener.writer.flushed_documents
+    duration = max((last_commit or time.time()) - (server.first_sent or 0),
+                   0.001)
+    p50, p99 = listener.writer.latency_percentiles(50, 99)
+    print('sent:               {}'.format(sent))
+    print('committed:          {} ({} inserted, {} duplicates)'.format(
+        committed, listener.counter, listener.writer.duplicates))
+    print('dropped:            {} (ingest queue full)'.format(
+        listener.ingest_queue.dropped))
+    print('lost:               {}'.format(
+        sent - committed - listener.ingest_queue.dropped -
+        listener.recent_ids.duplicates))
+    print('throughput:         {} tweets/s'.format(round(committed / duration)))
+    if p50 is not None:
+        print('receipt to commit:  p50 {} ms, p99 {} ms'.format(
+            round(p50 * 1000, 1), round(p99 * 1000, 1)))
+    print('max. queue depth:   {}'.format(listener.ingest_queue.depth_max))
+    print('memory growth:      {} MB (start {} MB, max. {} MB)'.format(
+        round((memory_max - memory_start) / 1000000, 1),
+        round(memory_start / 1000000, 1), round(memory_max / 1000000, 1)))
+    print('writer:             {}'.format(listener.writer.report()))
+
+    mongo_client[cfg['mongo_db']].drop_collection(cfg['mongo_coll'])
+
+
+def match_terms(text, terms):
+    """Matching the terms one at a time, as a baseline for the matcher.
+
+    :param str text: the text to search
+    :param list terms: the tracking terms
+    """
+    text = text.lower()
+    return [term for term in terms
+            if all(word in text for word in term.lower().split())]
+
+
+def benchmark_matcher(n=5000):
+    """Comparing the time per tweet of matching terms one at a time and
+    with the TermMatcher, for a growing number of terms.
+
+    :param int n: the number of tweets to match
+    """
+    for number_of_terms in (10, 100, 1000):
+        rnd = random.Random(number_of_terms)
+        terms = []
+        for i in range(number_of_terms):
+            term = 'term{}'.format(i)
+            if rnd.random() < 0.3:
+                term += ' ' + rnd.choice(WORDS)
+            terms.append(term)
+        texts = [get_searchable_text(generate_tweet(i, terms))
+                 for i in range(n)]
+
+        start = time.process_time()
+        baseline_matches = sum(len(match_terms(text, terms))
+                               for text in texts)
+        baseline_time = time.process_time() - start
+
+        start = time.process_time()
+        matcher = TermMatcher(terms)
+        build_time = time.process_time() - start
+
+        start = time.process_time()
+        matches = sum(len(matcher.match_text(text)) for text in texts)
+        matcher_time = time.process_time() - start
+
+        print('{} terms: one at a time {} us/tweet, matcher {} us/tweet '
+              '(built in {} ms); {} and {} matches'.format(
+                  number_of_terms, round(baseline_time / n * 1000000, 1),
+                  round(matcher_time / n * 1000000, 1),
+                  round(build_time * 1000, 1), baseline_matches, matches))
+
+    print('matcher implementation: {}'.format(
+        'pyahocorasick' if matcher.automaton is not None else 'Python'))
+
+
+benchmarks = {
+    'raw': benchmark_raw,
+    'ingest': benchmark_ingest,
+    'matcher': benchmark_matcher,
+}
+
+
+if __name__ == '__main__':
+    try:
+        benchmark = benchmarks[sys.argv[1]]
+    except (IndexError, KeyError):
+        print('Available benchmarks: {}'.format(', '.join(sorted(benchmarks))))
+        sys.exit(1)
+
+    benchmark(*[int(arg) for arg in sys.argv[2:]])
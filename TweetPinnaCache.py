@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Cache.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module provides the cache of the dashboard. The cache can be shared by
+all workers of the dashboard (Redis or a directory), is recomputed by one
+worker at a time and keeps serving the old value while it is recomputed.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from cachelib import FileSystemCache
+from cachelib import RedisCache
+from cachelib import SimpleCache
+from TweetPinnaMetrics import registry
+import os
+import threading
+import time
+import uuid
+
+CACHE_REQUESTS = registry.counter(
+    'tweetpinna_dashboard_cache_requests_total',
+    'Cache lookups by name and result (hit, stale, miss, wait)',
+    ['name', 'result'])
+CACHE_COMPUTE_SECONDS = registry.histogram(
+    'tweetpinna_dashboard_cache_compute_seconds',
+    'Time to recompute a cached value', ['name'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+
+
+def create_cache_backend(cfg, log):
+    """Creating the cachelib backend configured by cache_backend.
+
+    'auto' uses Redis if it is reachable and the cache directory
+    otherwise; 'simple' keeps a separate cache in every process.
+
+    :param object cfg: the TweetPinna configuration
+    :param object log: the TweetPinna logger
+    :return tuple: the backend and the directory for lock files, if any
+    """
+    backend = cfg['cache_backend']
+
+    if backend in ('auto', 'redis'):
+        try:
+            redis_cache = RedisCache(cfg['cache_redis_host'],
+                                     cfg['cache_redis_port'],
+                                     key_prefix='{}-'.format(
+                                         cfg['instance_name']))
+            redis_cache.has('tweetpinna-ping')
+            return redis_cache, None
+        except Exception as e:
+            if backend == 'redis':
+                raise
+            log.log_add(1, 'Redis is not available for the dashboard cache, '
+                        'using {} ({})'.format(cfg['cache_dir'], e))
+        backend = 'filesystem'
+
+    if backend == 'filesystem':
+        # The locks are kept apart, cachelib treats every file in its
+        # directory as a value
+        lock_dir = os.path.join(cfg['cache_dir'], 'locks')
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+        return (FileSystemCache(os.path.join(cfg['cache_dir'], 'values')),
+                lock_dir)
+
+    return SimpleCache(), None
+
+
+class SharedCache():
+    """Caching values that are expensive to compute.
+
+    A value is fresh for its timeout and is kept stale_timeout seconds
+    longer. A stale value is returned at once while one worker recomputes
+    it in the background. Without a value, one worker computes it and the
+    others wait for its result. Locks are entries of the backend (Redis,
+    SimpleCache) or lock files in lock_dir (FileSystemCache).
+    """
+
+    # Seconds between two looks at a value computed by another worker
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, backend, log, stale_timeout=3600, lock_timeout=300,
+                 lock_dir=None):
+        """Initialization.
+
+        :param object backend: the cachelib cache
+        :param object log: the TweetPinna logger
+        :param int stale_timeout: seconds a value is kept after it expired
+        :param int lock_timeout: seconds after which a lock of a worker that
+        did not finish is ignored
+        :param str lock_dir: the directory for lock files; None uses the
+        backend
+        """
+        self.backend = backend
+        self.log = log
+        self.stale_timeout = stale_timeout
+        self.lock_timeout = lock_timeout
+        self.lock_dir = lock_dir
+
+    def get(self, key, compute, timeout, name=None):
+        """Returning a cached value, computing it if necessary.
+
+        :param str key: the cache key
+        :param function compute: returns the value
+        :param int timeout: seconds the value is fresh
+        :param str name: the name used in the metrics; defaults to the key
+        """
+        name = name or key
+        entry = self.backend.get(key)
+        if entry is not None and entry['expires'] > time.time():
+            CACHE_REQUESTS.labels(name, 'hit').inc()
+            return entry['value']
+
+        if entry is not None:
+            # Stale: refreshing in the background unless another worker
+            # already does
+            CACHE_REQUESTS.labels(name, 'stale').inc()
+            token = self.acquire(key)
+            if token:
+                refresh = threading.Thread(
+                    target=self.refresh,
+                    args=(key, compute, timeout, name, token))
+                refresh.daemon = True
+                refresh.start()
+            return entry['value']
+
+        token = self.acquire(key)
+        if token:
+            CACHE_REQUESTS.labels(name, 'miss').inc()
+            try:
+                return self.compute(key, compute, timeout, name)
+            finally:
+                self.release(key, token)
+
+        # Waiting for the worker computing the value
+        CACHE_REQUESTS.labels(name, 'wait').inc()
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            entry = self.backend.get(key)
+            if entry is not None:
+                return entry['value']
+            if not self.locked(key):
+                break
+
+        return self.compute(key, compute, timeout, name)
+
+    def compute(self, key, compute, timeout, name):
+        """Computing a value and storing it."""
+        start = time.time()
+        value = compute()
+        CACHE_COMPUTE_SECONDS.labels(name).observe(time.time() - start)
+        self.backend.set(key, {'value': value,
+                               'expires': time.time() + timeout},
+                         timeout + self.stale_timeout)
+        return value
+
+    def refresh(self, key, compute, timeout, name, token):
+        """Recomputing a stale value. Runs on a background thread."""
+        try:
+            self.compute(key, compute, timeout, name)
+        except Exception as e:
+            self.log.log_add(3, 'Could not refresh the cached {} ({})'.format(
+                name, e))
+        finally:
+            self.release(key, token)
+
+    def acquire(self, key):
+        """Taking the lock of a key. Returns a token, or None if the lock is
+        held by another worker.
+
+        :param str key: the cache key
+        """
+        token = uuid.uuid4().hex
+        if self.lock_dir is None:
+            if self.backend.add('lock-' + key, token, self.lock_timeout):
+                return token
+            return None
+
+        path = self._lock_path(key)
+        for attempt in range(2):
+            try:
+                descriptor = os.open(path, os.O_CREAT | os.O_EXCL |
+                                     os.O_WRONLY)
+                os.write(descriptor, token.encode('ascii'))
+                os.close(descriptor)
+                return token
+            except FileExistsError:
+                # Removing the lock of a worker that did not finish
+                try:
+                    if time.time() - os.path.getmtime(path) < \
+                            self.lock_timeout:
+                        return None
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        return None
+
+    def release(self, key, token):
+        """Releasing the lock of a key if it is still held with the token.
+
+        :param str key: the cache key
+        :param str token: the token returned by acquire
+        """
+        if self.lock_dir is None:
+            if self.backend.get('lock-' + key) == token:
+                self.backend.delete('lock-' + key)
+            return
+
+        path = self._lock_path(key)
+        try:
+            with open(path, 'r') as lock_file:
+                if lock_file.read() == token:
+                    os.remove(path)
+        except OSError:
+            pass
+
+    def locked(self, key):
+        """Returning whether the lock of a key is held.
+
+        :param str key: the cache key
+        """
+        if self.lock_dir is None:
+            return self.backend.has('lock-' + key)
+
+        try:
+            return time.time() - os.path.getmtime(self._lock_path(key)) < \
+                self.lock_timeout
+        except OSError:
+            return False
+
+    def _lock_path(self, key):
+        """Returning the path of the lock file of a key."""
+        return os.path.join(self.lock_dir, '{}.lock'.format(
+            ''.join(character if character.isalnum() else '-'
+                    for character in key)))
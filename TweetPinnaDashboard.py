@@ -20,24 +20,44 @@ Example:
 from bson.son import SON
 from bson.json_util import dumps
 from flask import Flask
+from flask import g
 from flask import jsonify
 from flask import render_template
 from flask import request
+from flask import Response
 from flask_basicauth import BasicAuth
 from pymongo import MongoClient
 from TweetPinna import check_config
+from TweetPinna import load_config
 from TweetPinna import Logger
-from TweetPinnaImageDownloader import download_media_file
-from cachelib import SimpleCache
-import config
+from TweetPinnaAggregates import HashtagCounter
+from TweetPinnaAggregates import TweetRollups
+from TweetPinnaAggregates import TweetSample
+from TweetPinnaAggregates import TweetStatistics
+from TweetPinnaAggregates import UserSummaries
+from TweetPinnaCache import create_cache_backend
+from TweetPinnaCache import SharedCache
+from TweetPinnaIngest import ENRICHMENT_FIELD
+from TweetPinnaMedia import create_media_directories
+from TweetPinnaMedia import create_media_manifest
+from TweetPinnaMedia import download_media_file
+from TweetPinnaMetrics import CONTENT_TYPE
+from TweetPinnaMetrics import registry
+from TweetPinnaUsers import rehydrate
+from TweetPinnaUsers import UserStore
+import datetime
+import hashlib
 import os
+import requests
 import sys
 import re
+import threading
+import time
 
 try:
     if os.path.isfile(sys.argv[1]):
         if check_config(sys.argv[1]):
-            cfg = config.Config(open(sys.argv[1], 'r'))
+            cfg = load_config(sys.argv[1])
             log = Logger(cfg)
         else:
             print ('Configuration appears to be faulty')
@@ -47,16 +67,38 @@ try:
         sys.exit(1)
 except IndexError:
     print ('Using default configuration')
-    cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
+    cfg = load_config('cfg/TweetPinnaDefault.cfg')
     log = Logger(cfg)
 
-cache = SimpleCache()
+# Shared by all workers of the dashboard, see TweetPinnaCache
+cache_backend, cache_lock_dir = create_cache_backend(cfg, log)
+cache = SharedCache(cache_backend, log, cfg['cache_stale_timeout'],
+                    cfg['cache_lock_timeout'], cache_lock_dir)
+
+REQUEST_SECONDS = registry.histogram(
+    'tweetpinna_dashboard_request_seconds',
+    'Time to answer a dashboard request', ['endpoint'])
 
 # MongoDB
 mongo_client = MongoClient(cfg['mongo_path'], connectTimeoutMS=500,
                            serverSelectionTimeoutMS=500)
 mongo_db = mongo_client[cfg['mongo_db']]
 mongo_coll_tweets = mongo_db[cfg['mongo_coll']]
+mongo_coll_hashtags = mongo_db[HashtagCounter.collection_name(cfg)]
+mongo_coll_rollups = mongo_db[TweetRollups.collection_name(cfg)]
+mongo_coll_statistics = mongo_db[TweetStatistics.collection_name(cfg)]
+hashtag_counter = HashtagCounter(mongo_coll_hashtags, mongo_coll_statistics)
+media_manifest = create_media_manifest(cfg, mongo_db)
+mongo_coll_users = mongo_db[UserStore.collection_name(cfg)]
+tweet_sample = TweetSample(mongo_db[TweetSample.collection_name(cfg)],
+                           cfg['ingest_sample_size'])
+user_summaries = UserSummaries(mongo_db[UserSummaries.collection_name(cfg)],
+                               mongo_coll_tweets,
+                               cfg['twitter_tracking_users'])
+
+# The profile images of the tracked users, as served by Flask
+PROFILE_IMAGE_DIR = 'dashboard/static/img/users'
+create_media_directories(cfg)
 
 
 def html_ann_tweet(tweets):
@@ -79,6 +121,11 @@ def html_ann_tweet(tweets):
         except:
             pass
 
+        # The full text derived at ingest
+        try:
+            text = tweet[ENRICHMENT_FIELD]['text']
+        except:
+            pass
 
         # Hashtags
         tweet['text_html_annotated'] = re.sub(r'\B#\w\w+',
@@ -100,41 +147,55 @@ def html_ann_tweet(tweets):
     return tweets
 
 
-def get_hashtags():
-    """Get a list of hashtags from highest to lowest frequency. This does not (yet) take into account 'extended tweets'.
+def compute_hashtags(skip=0, limit=0):
+    """Computing a list of hashtags from highest to lowest frequency.
+
+    With ingest_hashtag_counts, the counts maintained at ingest are read
+    instead of aggregating all tweets, once they have been seeded. Both
+    count the lowercase hashtags of get_hashtags.
 
-    :return list: all hashtags and their frequency
+    :param int skip: the number of hashtags to skip
+    :param int limit: the number of hashtags to return; 0 returns all
+    :return list: hashtags and their frequency
     """
-    hashtags_list = cache.get('hashtags-list')
-    if hashtags_list is None:
-        pipeline = [
-            {"$unwind": "$entities"},
-            {"$unwind": "$entities.hashtags"},
-            {"$unwind": "$entities.hashtags.text"},
-            {"$group": {"_id": "$entities.hashtags.text", "count":
-                        {"$sum": 1}}},
-            {"$sort": SON([("count", -1), ("_id", -1)])}]
-
-        hashtags = mongo_coll_tweets.aggregate(pipeline)
-        hashtags_list = []
-        for hashtag in hashtags:
-            hashtags_list.append((list(hashtag.values())[1], list(hashtag.values())[0]))
-
-        cache.set('hashtags-list', hashtags_list,
-                  cfg['flask_cache_timeout'] * 60)
+    if cfg['ingest_hashtag_counts'] == 1 and hashtag_counter.seeded():
+        return hashtag_counter.top(skip, limit)
+
+    pipeline = HashtagCounter.PIPELINE + [
+        {"$sort": SON([("count", -1), ("_id", -1)])},
+        {"$skip": skip}]
+    if limit > 0:
+        pipeline.append({"$limit": limit})
+
+    hashtags = mongo_coll_tweets.aggregate(pipeline, allowDiskUse=True)
+    hashtags_list = []
+    for hashtag in hashtags:
+        hashtags_list.append((hashtag['_id'], hashtag['count']))
 
     return hashtags_list
 
 
+def get_hashtags(skip=0, limit=0):
+    """Get a list of hashtags from highest to lowest frequency (cached).
+
+    :param int skip: the number of hashtags to skip
+    :param int limit: the number of hashtags to return; 0 returns all
+    :return list: hashtags and their frequency
+    """
+    return cache.get('hashtags-list-{}-{}'.format(skip, limit),
+                     lambda: compute_hashtags(skip, limit),
+                     cfg['flask_cache_timeout'] * 60, 'hashtags')
+
+
 def get_number_hashtags():
-    """Getting the number of unique hashtags in the collection."""
-    hashtags_number = cache.get('hashtags-number')
-    if hashtags_number is None:
-        hashtags_number = len(get_hashtags())
-        cache.set('hashtags-number', hashtags_number,
-                  cfg['flask_cache_timeout'] * 60)
+    """Getting the number of unique hashtags in the collection (cached)."""
+    def compute_number_hashtags():
+        if cfg['ingest_hashtag_counts'] == 1 and hashtag_counter.seeded():
+            return hashtag_counter.number()
+        return len(get_hashtags())
 
-    return hashtags_number
+    return cache.get('hashtags-number', compute_number_hashtags,
+                     cfg['flask_cache_timeout'] * 60)
 
 
 def get_folder_size(start_path):
@@ -152,6 +213,20 @@ def get_folder_size(start_path):
     return total_size / 1000000
 
 
+def get_storage_size():
+    """Getting the size of the media storage in MB.
+
+    With media_manifest, the running total of the manifest is read once it
+    is complete; otherwise, the storage folder is walked (cached).
+    """
+    if media_manifest and media_manifest.complete():
+        return media_manifest.totals()['bytes'] / 1000000
+
+    return cache.get('storage-size',
+                     lambda: get_folder_size(cfg['media_storage']),
+                     cfg['flask_cache_timeout'] * 60)
+
+
 def get_version():
     """Getting the TweetPinna version."""
     try:
@@ -173,84 +248,154 @@ def get_last_entry_time():
 
 
 def get_random_tweets(n):
-    """Getting n random tweets from the collection."""
-    sample = list(mongo_coll_tweets.aggregate([{'$sample': {'size': n}}]))
+    """Getting up to n (at most random_tweets_max) random tweets.
 
-    return sample
+    With ingest_sample, the tweets are drawn from the sample maintained at
+    ingest; otherwise, from the whole collection.
+    """
+    n = min(n, cfg['random_tweets_max'])
+    if n <= 0:
+        # MongoDB rejects a $sample of size 0
+        return []
 
+    if cfg['ingest_sample'] == 1 and tweet_sample.seen() is not None:
+        sample = tweet_sample.sample(mongo_coll_tweets, n)
+    else:
+        sample = list(mongo_coll_tweets.aggregate([{'$sample': {'size': n}}]))
 
-def get_token_count():
-    """Generate the token count based on all documents.
+    return rehydrate(mongo_coll_users, sample)
+
+
+def get_running_totals():
+    """Getting the running totals of the collection.
 
-    A simple space tokenizer is utilized.
-    The token count is cached for 60 minutes.
+    Only the tweets stored since the last refresh are aggregated, see
+    TweetStatistics. The totals are cached for 6 minutes.
     """
-    tokens = cache.get('tokens-number')
+    def compute_running_totals():
+        tweet_statistics = TweetStatistics(mongo_coll_statistics)
+        tweet_statistics.refresh(mongo_coll_tweets, cfg['statistics_lag'],
+                                 cfg['statistics_refresh_max'])
+        return tweet_statistics.totals()
 
-    if tokens is None:
-        tokens = 0
-        tweets = mongo_coll_tweets.find({}, {'text': 1})
-        for tweet in tweets:
-            if 'full_text' in tweet.keys():
-                tokens += len(tweet['full_text'].split(' '))
-            else:
-                tokens += len(tweet['text'].split(' '))
+    return cache.get('running-totals', compute_running_totals, 360)
 
-    cache.set('tokens-number', tokens, 360)
 
-    return tokens
+def get_token_count():
+    """Getting the token count of all documents.
+
+    Tokens are counted like the derived field tokens (the full text split
+    at whitespace), also for tweets without derived fields; see
+    get_tokens_expression.
+    """
+    return get_running_totals()['tokens']
 
 
-def generate_statistics():
+def compute_statistics():
     """Generate basic statistics and return a dictionary."""
-    statistics = cache.get('statistics')
-    if statistics is None:
-        statistics = {}
-        statistics['nr_hashtags'] = ('Number of Hashtags',
-                                     get_number_hashtags())
-        statistics['nr_tokens'] = ('Number of Tokens', get_token_count())
-        statistics['media_storage_size'] = ('Storage Folder Size (MB)',
-                                            str(get_folder_size(
-                                                cfg['media_storage'])))
-
-        cache.set('statistics', statistics,
-                  cfg['flask_cache_timeout'] * 60)
+    statistics = {}
+    statistics['nr_hashtags'] = ('Number of Hashtags',
+                                 get_number_hashtags())
+    statistics['nr_tokens'] = ('Number of Tokens', get_token_count())
+    totals = get_running_totals()
+    statistics['nr_hashtag_uses'] = ('Number of Hashtag Uses',
+                                     totals['hashtags'])
+    statistics['nr_media'] = ('Number of Media Items', totals['media'])
+    statistics['nr_tweets_stream'] = ('Tweets from the Stream',
+                                      totals['sources']['stream'])
+    statistics['nr_tweets_rest'] = ('Tweets from Timelines and Replies',
+                                    totals['sources']['rest'])
+    if cfg['ingest_rollups'] == 1:
+        rollups = TweetRollups(mongo_coll_rollups)
+        now = datetime.datetime.utcnow()
+        statistics['nr_tweets_hour'] = (
+            'Tweets created in the last Hour',
+            rollups.total(now - datetime.timedelta(hours=1)))
+        statistics['nr_tweets_day'] = (
+            'Tweets created in the last Day',
+            rollups.total(now - datetime.timedelta(days=1)))
+        statistics['nr_tweets_lost_day'] = (
+            'Tweets not captured (shed or dropped) in the last Day',
+            rollups.total(now - datetime.timedelta(days=1),
+                          ('shed', 'dropped')))
+    statistics['media_storage_size'] = ('Storage Folder Size (MB)',
+                                        str(get_storage_size()))
+    if media_manifest and media_manifest.complete():
+        statistics['nr_media_files'] = ('Number of Stored Media Files',
+                                        media_manifest.totals()['files'])
 
     return statistics
 
 
-def get_user(screen_name):
-    """Get information about a tracked user."""
-    # Get all tweets, sorted from newest to oldest
-    user_tweets = list(mongo_coll_tweets.find({'user.screen_name':
-                       screen_name[1:]}).sort([('id', -1)]))
-    user = {}
+def generate_statistics():
+    """Getting the basic statistics (cached)."""
+    return cache.get('statistics', compute_statistics,
+                     cfg['flask_cache_timeout'] * 60)
+
+
+def get_user_summaries():
+    """Getting the summaries of the tracked users.
+
+    With ingest_user_summaries, the summaries maintained at ingest are read
+    with a single query; otherwise, they are computed (cached). Summaries
+    of users added to twitter_tracking_users are built when TweetPinna
+    starts, until then the users are shown without numbers.
+    """
+    if cfg['ingest_user_summaries'] == 1:
+        summaries = {summary['_id']: summary
+                     for summary in user_summaries.summaries()}
+        return [summaries.get(screen_name,
+                              {'_id': screen_name, 'count': 'N/A'})
+                for screen_name in user_summaries.screen_names]
+
+    return cache.get('user-summaries', lambda: [
+        user_summaries.summarize(screen_name)
+        for screen_name in user_summaries.screen_names],
+        cfg['flask_cache_timeout'] * 60)
+
+
+def get_profile_image_filename(summary):
+    """Returning the filename of the current profile image of a tracked
+    user, or None if it is not known."""
+    if not summary.get('profile_image_url'):
+        return None
+    digest = hashlib.sha1(summary['profile_image_url'].encode('utf-8'))
+    return '{}-profile-{}.jpg'.format(summary['user_id'],
+                                      digest.hexdigest()[:12])
+
+
+def download_profile_images(images):
+    """Downloading profile images of tracked users. Runs on a background
+    thread; the images are only downloaded by one worker at a time.
+
+    :param list images: (url, filename) tuples
+    """
+    token = cache.acquire('profile-images')
+    if not token:
+        return
 
     try:
-        download_media_file('user-profile-img',
-                            user_tweets[0]['user']['profile_image_url_https'],
-                            'user-{}-current.jpg'.format(screen_name[1:]),
-                            'jpg',
-                            'dashboard/static/img/users')
-        user["profile_picture"] = True
-    except:
-        # The user probably does not have any profile picture
-        user["profile_picture"] = False
+        for url, filename in images:
+            download_media_file(cfg, log, 'user-profile-img', url, filename,
+                                'jpg', PROFILE_IMAGE_DIR,
+                                manifest=media_manifest)
+    finally:
+        cache.release('profile-images', token)
 
-    user["screen_name"] = screen_name[1:]
-    user["number_of_tweets"] = len(user_tweets)
 
-    if user["number_of_tweets"] > 0:
-        try:
-            user["last_tweet"] = user_tweets[0]['text']
-        except KeyError:
-            user["last_tweet"] = user_tweets[0]['full_text']
-        user["last_tweet_date"] = user_tweets[0]['created_at']
-    else:
-        user["last_tweet"] = 'N/A'
-        user["last_tweet_date"] = 'N/A'
+def get_user(summary):
+    """Get information about a tracked user from its summary."""
+    user = {'screen_name': summary['_id'],
+            'number_of_tweets': summary['count'],
+            'last_tweet': summary.get('last_tweet', 'N/A'),
+            'last_tweet_date': summary.get('last_tweet_date', 'N/A'),
+            'profile_image': None}
+
+    filename = get_profile_image_filename(summary)
+    if filename and os.path.isfile(os.path.join(PROFILE_IMAGE_DIR, filename)):
+        user['profile_image'] = filename
 
-    return(user)
+    return user
 
 
 # Flask
@@ -266,6 +411,21 @@ if cfg['dashboard_username']:
     app.config['BASIC_AUTH_USERNAME'] = cfg['dashboard_username']
     app.config['BASIC_AUTH_PASSWORD'] = cfg['dashboard_password']
 
+@app.before_request
+def start_request_timer():
+    """Remembering when the request started."""
+    g.request_start = time.time()
+
+
+@app.after_request
+def observe_request_time(response):
+    """Adding the duration of the request to the metrics."""
+    if 'request_start' in g:
+        REQUEST_SECONDS.labels(request.endpoint or 'unknown').observe(
+            time.time() - g.request_start)
+    return response
+
+
 @app.errorhandler(500)
 def internal_error_handler(error):
     """Handling HTTP 500 errors."""
@@ -328,8 +488,20 @@ def statistics():
 def timelines():
     """Flask Timelines Route."""
     tracked_users = []
-    for user in cfg['twitter_tracking_users']:
-        tracked_users.append(get_user(user))
+    missing_images = []
+    for summary in get_user_summaries():
+        user = get_user(summary)
+        tracked_users.append(user)
+        if summary.get('profile_image_url') and not user['profile_image']:
+            missing_images.append((summary['profile_image_url'],
+                                   get_profile_image_filename(summary)))
+
+    # New or changed profile images are shown once they are downloaded
+    if missing_images:
+        download = threading.Thread(target=download_profile_images,
+                                    args=(missing_images,))
+        download.daemon = True
+        download.start()
 
     return render_template(
         'timelines.html', instance_name=cfg['instance_name'],
@@ -345,6 +517,7 @@ def show_tweet(tweet_id):
     try:
         tweet = mongo_coll_tweets.find_one({'id_str': tweet_id})
         replies = list(mongo_coll_tweets.find({'in_reply_to_status_id_str': tweet_id}))
+        rehydrate(mongo_coll_users, [tweet] + replies)
     except Exception as e:
         log.log_add(3, f'{e}')
         tweet = None
@@ -355,21 +528,37 @@ def show_tweet(tweet_id):
         instance_ver=get_version(), tweet=html_ann_tweet([tweet])[0], replies=html_ann_tweet(replies))
 
 
+@app.route('/metrics')
+def metrics():
+    """Flask Metrics Route.
+
+    Returns the metrics of the dashboard and, if enabled, those of the
+    ingest process.
+    """
+    metrics_text = registry.expose()
+    if cfg['metrics_enabled'] == 1:
+        try:
+            response = requests.get('http://{}:{}/metrics'.format(
+                cfg['metrics_host'], cfg['metrics_port']), timeout=2)
+            response.raise_for_status()
+            metrics_text += response.text
+        except requests.RequestException:
+            metrics_text += '# The ingest metrics are not available\n'
+
+    return Response(metrics_text, content_type=CONTENT_TYPE)
+
+
 @app.route('/ajax/get/hashtags')
 def ajax_get_hashtags():
     """Flask Ajax Get Hashtag Route."""
     f = request.args.get('f', 0, type=int)
     t = request.args.get('t', 0, type=int)
 
-    hashtags_list = get_hashtags()
+    if t != 0 and t <= f:
+        return jsonify({})
 
     try:
-        if t == 0:
-            return jsonify(dict(hashtags_list[f:]))
-        elif t > len(hashtags_list):
-            return jsonify(dict(hashtags_list[f:]))
-        else:
-            return jsonify(dict(hashtags_list[f:t]))
+        return jsonify(dict(get_hashtags(f, t - f if t != 0 else 0)))
     except:
         return False
 
@@ -389,7 +578,7 @@ def ajax_get_statistics():
 @app.route('/ajax/get/storage-size')
 def ajax_get_storage_size():
     """Flask Ajax Get Storage Size Route."""
-    return str(get_folder_size(cfg['media_storage']))
+    return str(get_storage_size())
 
 
 @app.route('/ajax/get/docs-in-collection')
@@ -398,10 +587,10 @@ def ajax_get_docs_in_collection():
     return jsonify(get_last_entry_time(), mongo_coll_tweets.count())
 
 
-@app.route('/ajax/get/random_tweets/<n>')
+@app.route('/ajax/get/random_tweets/<int:n>')
 def ajax_get_random_tweets(n):
     """Flask Ajax Get Random Tweets Route."""
-    return dumps(get_random_tweets(int(n)))
+    return dumps(get_random_tweets(n))
 
 
 if __name__ == "__main__":
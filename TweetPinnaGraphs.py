@@ -26,8 +26,9 @@ import matplotlib
 matplotlib.use('Agg')
 from pymongo import MongoClient
 from TweetPinna import check_config
+from TweetPinna import load_config
 from TweetPinna import Logger
-import config
+from TweetPinnaAggregates import TweetRollups
 import matplotlib.pyplot as plt
 import os
 import pandas as pd
@@ -39,7 +40,7 @@ import numpy as np
 try:
     if os.path.isfile(sys.argv[1]):
         if check_config(sys.argv[1]):
-            cfg = config.Config(open(sys.argv[1], 'r'))
+            cfg = load_config(sys.argv[1])
             log = Logger(cfg)
         else:
             print ('Configuration appears to be faulty')
@@ -49,7 +50,7 @@ try:
         sys.exit(1)
 except IndexError:
     print ('Using default configuration')
-    cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
+    cfg = load_config('cfg/TweetPinnaDefault.cfg')
     log = Logger(cfg)
 
 plt.style.use('ggplot')
@@ -62,6 +63,41 @@ if not os.path.isdir('dashboard/static/img/results'):
 mongo_client = MongoClient(cfg['mongo_path'])
 mongo_db = mongo_client[cfg['mongo_db']]
 mongo_coll_tweets = mongo_db[cfg['mongo_coll']]
+mongo_coll_rollups = mongo_db[TweetRollups.collection_name(cfg)]
+
+# Length of the periods in minutes
+PERIODS = {'1h': 60, '1d': 1440}
+
+
+def get_tweet_counts(freq, n=0):
+    """Returning the number of tweets per period, including empty periods.
+
+    Only tweets received from the stream are counted. With ingest_rollups,
+    the counts are summed from the per-minute rollups. Otherwise, the
+    timestamps of the last n tweets are loaded.
+
+    :param str freq: the period, '1h' or '1d'
+    :param int n: the number of latest tweets to consider; 0 for all
+    :return object: a pandas Series of counts indexed by the period start
+    """
+    if cfg['ingest_rollups'] == 1:
+        rollups = TweetRollups(mongo_coll_rollups)
+        start = rollups.start(n, 'streamed') if n > 0 else None
+        totals = rollups.totals(PERIODS[freq], start, field='streamed')
+        counts = pd.Series([count for period, count in totals],
+                           index=pd.to_datetime(
+                               [period for period, count in totals]))
+    else:
+        tweet_timestamps = mongo_coll_tweets.find(
+            {'timestamp_ms': {'$exists': True}},
+            {'timestamp_ms': 1, '_id': 0}).sort([['_id', -1]])
+        if n > 0:
+            tweet_timestamps = tweet_timestamps.limit(n)
+        tweet_datetimes = pd.to_datetime(np.array(
+            [int(d['timestamp_ms']) for d in tweet_timestamps]), unit='ms')
+        counts = pd.Series(1, index=tweet_datetimes)
+
+    return counts.resample(freq).sum()
 
 
 def tweets_by_hour(n):
@@ -70,26 +106,20 @@ def tweets_by_hour(n):
     :param int n: the number of tweets to consider
     """
     try:
-        tweet_timestamps = list(mongo_coll_tweets.find(
-            {'timestamp_ms': {'$exists': True}}, {'timestamp_ms': 1, '_id': 0}).sort([['_id', -1]]).limit(n))
-        tweet_datetimes = pd.to_datetime(
-            np.array(list(map(int, [d['timestamp_ms'] for d in tweet_timestamps]))), unit='ms')
-
-        df = pd.DataFrame(tweet_datetimes, columns=['date'])
-        df.set_index('date', drop=False, inplace=True)
-        grouped_df = df.groupby(pd.Grouper(freq='1h')).count()
-        grouped_df_average = grouped_df["date"].sum() / len(grouped_df)
-        tweets_by_hour = grouped_df.plot(
+        counts = get_tweet_counts('1h', n)
+        tweets_by_hour = counts.plot(
             kind='bar', legend=False, color='#262626', rot=75)
         tweets_by_hour.set_xlabel('Date', fontsize=12)
         tweets_by_hour.set_ylabel('Nr. of Tweets', fontsize=12)
         tweets_by_hour.set_title(
             'Tweets by Hour\n({} Tweets, avg. {} Tweets/h)\n {}'.format(
-                n, round(grouped_df_average), time.strftime("%Y-%m-%d %H:%M:%S")),
+                counts.sum(), round(counts.mean()),
+                time.strftime("%Y-%m-%d %H:%M:%S")),
             position=(0.5, 1.05))
         tweets_by_hour.get_figure().savefig(
             'dashboard/static/img/results/tweets-by-hour.png',
             bbox_inches='tight')
+        plt.close('all')
 
         log.log_add(1, 'Graph tweets-by-hour.png created')
     except Exception as e:
@@ -104,30 +134,24 @@ def tweets_by_day(n):
     :param int n: the number of tweets to consider
     """
     try:
-        tweet_timestamps = list(mongo_coll_tweets.find(
-            {'timestamp_ms': {'$exists': True}}, {'timestamp_ms': 1, '_id': 0}).sort([['_id', -1]]).limit(n))
-        tweet_datetimes = pd.to_datetime(
-            np.array(list(map(int, [d['timestamp_ms'] for d in tweet_timestamps]))), unit='ms')
-
-        df = pd.DataFrame(tweet_datetimes, columns=['date'])
-        df.set_index('date', drop=False, inplace=True)
-        grouped_df = df.groupby(pd.Grouper(freq='1d')).count()
-        grouped_df_average = grouped_df["date"].sum() / len(grouped_df)
-        grouped_df['day'] = grouped_df.date.keys().strftime('%Y-%m-%d')
-
-        tweets_by_day = grouped_df.plot(
-            kind='bar', x='day', legend=False, color='#262626',
+        counts = get_tweet_counts('1d', n)
+        counts.index = counts.index.strftime('%Y-%m-%d')
+
+        tweets_by_day = counts.plot(
+            kind='bar', legend=False, color='#262626',
             rot=75)
         tweets_by_day.set_xlabel('Date', fontsize=12)
         tweets_by_day.set_ylabel('Nr. of Tweets', fontsize=12)
         tweets_by_day.set_title(
             'Tweets by Day\n({} Tweets, avg. {} Tweets/day)\n {}'.
-            format(n, round(grouped_df_average), time.strftime("%Y-%m-%d %H:%M:%S")),
+            format(counts.sum(), round(counts.mean()),
+                   time.strftime("%Y-%m-%d %H:%M:%S")),
             position=(0.5, 1.05))
 
         tweets_by_day.get_figure().savefig(
             'dashboard/static/img/results/tweets-by-day.png',
             bbox_inches='tight')
+        plt.close('all')
 
         log.log_add(1, 'Graph tweets-by-day.png created')
     except Exception as e:
@@ -140,30 +164,25 @@ def tweets_by_day(n):
 def tweets_over_time(n):
     """Generating a chart of the overall development of the collection.
 
-    :param int n: the number of tweets to consider
+    :param int n: the number of tweets to consider; with ingest_rollups,
+    the whole collection is shown
     """
     try:
-        tweet_timestamps = list(mongo_coll_tweets.find(
-            {'timestamp_ms': {'$exists': True}}, {'timestamp_ms': 1, '_id': 0}).sort([['_id', -1]]).limit(n))
-        tweet_datetimes = pd.to_datetime(
-            np.array(list(map(int, [d['timestamp_ms'] for d in tweet_timestamps]))), unit='ms')
-
-        df = pd.DataFrame(tweet_datetimes, columns=['date'])
-        df.set_index('date', drop=False, inplace=True)
-        grouped_df = df.groupby(pd.Grouper(freq='1d')).count()
-        grouped_df_average = grouped_df["date"].sum() / len(grouped_df)
+        counts = get_tweet_counts('1d',
+                                  0 if cfg['ingest_rollups'] == 1 else n)
 
-        tweets_over_time = grouped_df.cumsum().plot(
+        tweets_over_time = counts.cumsum().plot(
             kind='area', legend=False, color='#262626',
             stacked='False', rot=75)
         tweets_over_time.set_xlabel('Date', fontsize=12)
         tweets_over_time.set_ylabel('Nr. of Additional Tweets', fontsize=12)
         tweets_over_time.set_title('Tweets over Time\n({} Tweets, avg. {} Tweets/day)\n {})'.
-                                   format(n, round(grouped_df_average), time.strftime("%Y-%m-%d %H:%M:%S")),
+                                   format(counts.sum(), round(counts.mean()), time.strftime("%Y-%m-%d %H:%M:%S")),
                                           position=(0.5, 1.05))
         tweets_over_time.get_figure().savefig(
             'dashboard/static/img/results/tweets-over-time.png',
             bbox_inches='tight')
+        plt.close('all')
 
         log.log_add(1, 'Graph tweets-over-time.png created')
     except Exception as e:
@@ -20,22 +20,20 @@ Example:
 from bson.objectid import ObjectId
 from pymongo import MongoClient
 from TweetPinna import check_config
+from TweetPinna import load_config
 from TweetPinna import Logger
-import config
-import datetime
-import mimetypes
+from TweetPinnaMedia import create_media_directories
+from TweetPinnaMedia import create_media_manifest
+from TweetPinnaMedia import download_media_file
+from TweetPinnaMedia import get_media_jobs
 import os.path
-import requests
 import signal
 import sys
-from urllib.parse import urlparse
-from urllib.parse import urlsplit
-import shutil
 
 try:
     if os.path.isfile(sys.argv[1]):
         if check_config(sys.argv[1]):
-            cfg = config.Config(open(sys.argv[1], 'r'))
+            cfg = load_config(sys.argv[1])
             log = Logger(cfg)
         else:
             print('Configuration appears to be faulty')
@@ -45,14 +43,11 @@ try:
         sys.exit(1)
 except IndexError:
     print('Using default configuration')
-    cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
+    cfg = load_config('cfg/TweetPinnaDefault.cfg')
     log = Logger(cfg)
 
 # Create directories
-if not os.path.exists(cfg['media_photo_storage']):
-    os.makedirs(cfg['media_photo_storage'])
-if not os.path.exists(cfg['media_user_storage']):
-    os.makedirs(cfg['media_user_storage'])
+create_media_directories(cfg)
 
 
 def signal_handler(signum, frame):
@@ -60,61 +55,6 @@ def signal_handler(signum, frame):
     sys.exit(1)
 
 
-def get_file_extension(url):
-    """Getting the extensions (filetype) of an url.
-
-    :param str url: the url to the file
-    """
-    filetype = os.path.splitext(
-        os.path.basename(
-            urlsplit(url).path))[1]
-
-    return filetype
-
-
-def download_media_file(type, url, filename, filetype='', copy_to=''):
-    """Downloading a media file.
-
-    :param str type: the type of the file (photo, user-profile-img,
-    user-banner-img, user-bg-img)
-    :param str url: the url to download from
-    :param str filename: the filename to save to
-    :param str filetype: the filytype (optional)
-    :param str copy_to: a folder to which a copy of the file is sent
-    """
-    if (len(url) > 0):
-        try:
-            if type == 'photo':
-                path = cfg['media_photo_storage'] + filename
-            elif type in (
-                    'user-profile-img', 'user-banner-img', 'user-bg-img'):
-                path = cfg['media_user_storage'] + filename
-            else:
-                return False
-
-            if not os.path.exists(path):
-                r = requests.get(url, stream=True)
-
-                if not filetype:
-                    try:
-                        path = path + mimetypes.guess_extension(
-                            r.headers['content-type'])
-                    except:
-                        path = path + '.unknown'
-
-                with open(path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:
-                            f.write(chunk)
-
-            if copy_to:
-                shutil.copy2(path, copy_to)
-
-
-        except Exception as e:
-            log.log_add(3, 'Image download failed ({})'.format(e))
-
-
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, signal_handler)
 
@@ -122,6 +62,9 @@ if __name__ == '__main__':
     mongo_client = MongoClient(cfg['mongo_path'])
     mongo_db = mongo_client[cfg['mongo_db']]
     mongo_coll_tweets = mongo_db[cfg['mongo_coll']]
+    media_manifest = create_media_manifest(cfg, mongo_db)
+    if media_manifest:
+        media_manifest.ensure_indexes()
 
     # Whole collections vs. individual ObjectId
     try:
@@ -151,53 +94,12 @@ if __name__ == '__main__':
             print ('{} of {} Tweets processed'.format(current_count,
                                                       number_tweets))
 
-        object_id = tweet["_id"]
-        tweet_timestamp_s = int(tweet["timestamp_ms"]) / 1000
-        tweet_date = datetime.datetime.fromtimestamp(
-            tweet_timestamp_s).strftime('%Y%m%d')
-
-        tweet_id = int(tweet["id"])
-        user_id = tweet["user"]["id"]
-
-        print(tweet_id)
-
-        if "profile_image_url" in tweet["user"]:
-            user_profile_image_url = tweet["user"]["profile_image_url"]
-
-            if cfg['media_profile_image_hd'] == 1:
-                user_profile_image_url = user_profile_image_url.replace(
-                    'normal', '400x400')
-
-            filetype = get_file_extension(user_profile_image_url)
-            download_media_file(
-                'user-profile-img', user_profile_image_url, '{}-profile-{}{}'.
-                format(user_id, tweet_date, filetype), filetype)
-
-        if "profile_banner_url" in tweet["user"]:
-            user_profile_banner_url = tweet["user"]["profile_banner_url"]
-            filetype = get_file_extension(user_profile_banner_url)
-            download_media_file(
-                'user-banner-img', user_profile_banner_url, '{}-banner-{}{}'.
-                format(user_id, tweet_date, filetype), filetype)
-
-        if "profile_background_image_url" in tweet["user"]:
-            user_profile_bg_url = tweet["user"]["profile_background_image_url"]
-            filetype = get_file_extension(user_profile_bg_url)
-            download_media_file(
-                'user-bg-img', user_profile_bg_url, '{}-bg-{}{}'.
-                format(user_id, tweet_date, filetype), filetype)
-
-        if "media" in tweet["entities"]:
-            for media in tweet["entities"]["media"]:
-                media_id = media["id"]
-                if media["type"] == "photo":
-                    photo_url = media["media_url_https"]
-                    filetype = get_file_extension(photo_url)
-                    download_media_file(
-                        'photo', photo_url, '{0}-{1}-{2}{3}'.format(object_id,
-                                                                    tweet_id,
-                                                                    media_id,
-                                                                    filetype),
-                        filetype)
+        print(tweet["id"])
+
+        for media_type, url, filename, filetype in get_media_jobs(cfg,
+                                                                   tweet):
+            download_media_file(cfg, log, media_type, url, filename,
+                                filetype, manifest=media_manifest,
+                                tweet_id=tweet['id'])
 
         current_count += 1
@@ -0,0 +1,874 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Ingest.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module contains the building blocks of the ingest pipeline
+which are shared by the streaming scripts.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from pymongo import errors
+from pymongo import MongoClient
+from TweetPinnaMetrics import registry
+import collections
+import datetime
+import queue
+import random
+import threading
+import time
+
+# The raw ingest mode uses the fastest JSON parser that is available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+
+# MongoDB error code of a duplicate key
+DUPLICATE_KEY = 11000
+
+# The sub-document holding the fields derived at ingest
+ENRICHMENT_FIELD = 'tp'
+
+# Metrics shared by all stages of the ingest pipeline
+STAGE_SECONDS = registry.histogram(
+    'tweetpinna_stage_seconds',
+    'Time spent in an ingest stage (parse, enqueue, write, media_enqueue, '
+    'spool)', ['stage'])
+TWEETS = registry.counter(
+    'tweetpinna_tweets_total',
+    'Tweets per ingest event (received, enqueued, dropped, filtered, '
+    'inserted, duplicate, failed, spooled, spool_dropped, replayed, shed)',
+    ['event'])
+COMMIT_LATENCY = registry.histogram(
+    'tweetpinna_commit_latency_seconds',
+    'Time from the receipt of a tweet until it has been written to MongoDB')
+
+
+def ensure_indexes(collection, log):
+    """Creating the indexes the ingest relies on. Returns True on success.
+
+    The unique index on id lets MongoDB reject tweets that are already
+    stored, so writers do not have to look them up first. Without it, the
+    stored ids have to be looked up (see insert_documents).
+
+    :param object collection: the tweet collection
+    :param object log: the TweetPinna logger
+    """
+    try:
+        collection.create_index('id', unique=True, background=True)
+        return True
+    except errors.DuplicateKeyError:
+        log.log_add(log.cfg['log_email_threshold'],
+                    'Could not create the unique index on id because the '
+                    'collection contains duplicates (run TweetPinnaMaintenance.py '
+                    '<config> remove-duplicates)')
+    except Exception as e:
+        log.log_add(4, 'Could not create the unique index on id ({})'.format(e))
+
+    return False
+
+
+def insert_documents(collection, documents, check_stored=False):
+    """Inserting documents with an unordered insert_many.
+
+    Documents which already exist are skipped. Connection errors are raised.
+
+    :param object collection: the MongoDB collection
+    :param list documents: the documents to insert
+    :param bool check_stored: looking up the ids which are already stored
+    first, if there is no unique index on id (see ensure_indexes)
+    :return tuple: the inserted documents, the number of duplicates and the
+    number of documents that failed for other reasons
+    """
+    stored = 0
+    if check_stored:
+        stored_ids = set(document['id'] for document in collection.find(
+            {'id': {'$in': [document['id'] for document in documents]}},
+            {'id': 1, '_id': 0}))
+        new_documents = [document for document in documents
+                         if document['id'] not in stored_ids]
+        stored = len(documents) - len(new_documents)
+        documents = new_documents
+        if not documents:
+            return [], stored, 0
+
+    try:
+        collection.insert_many(documents, ordered=False)
+        return documents, stored, 0
+    except errors.BulkWriteError as e:
+        write_errors = e.details.get('writeErrors', [])
+        failed = set(error['index'] for error in write_errors)
+        duplicates = sum(1 for error in write_errors
+                         if error['code'] == DUPLICATE_KEY)
+        inserted = [document for index, document in enumerate(documents)
+                    if index not in failed]
+        return inserted, stored + duplicates, len(failed) - duplicates
+
+
+def ensure_enrichment_indexes(collection, log):
+    """Creating the indexes on the derived fields. Returns True on success.
+
+    :param object collection: the tweet collection
+    :param object log: the TweetPinna logger
+    """
+    try:
+        for field in ('created', 'hashtags', 'term', 'matched_terms'):
+            collection.create_index('{}.{}'.format(ENRICHMENT_FIELD, field),
+                                    background=True)
+        return True
+    except Exception as e:
+        log.log_add(4, 'Could not create the indexes on {} ({})'.format(
+            ENRICHMENT_FIELD, e))
+
+    return False
+
+
+def get_full_text(tweet):
+    """Returning the untruncated text of a tweet.
+
+    Retweets are rebuilt from the retweeted status, since their own text is
+    truncated.
+
+    :param dict tweet: the status
+    """
+    retweeted = tweet.get('retweeted_status')
+    if retweeted:
+        return 'RT @{}: {}'.format(
+            retweeted.get('user', {}).get('screen_name', ''),
+            get_full_text(retweeted))
+
+    extended = tweet.get('extended_tweet')
+    if extended and 'full_text' in extended:
+        return extended['full_text']
+
+    return tweet.get('full_text') or tweet.get('text') or ''
+
+
+def get_created_date(tweet):
+    """Returning the creation time of a tweet as a (UTC) datetime.
+
+    :param dict tweet: the status
+    """
+    if 'timestamp_ms' in tweet:
+        return datetime.datetime.utcfromtimestamp(
+            int(tweet['timestamp_ms']) / 1000)
+
+    try:
+        return datetime.datetime.strptime(tweet['created_at'],
+                                          '%a %b %d %H:%M:%S +0000 %Y')
+    except (KeyError, ValueError):
+        return None
+
+
+def get_hashtags(tweet):
+    """Returning the lowercase hashtags of a tweet.
+
+    Includes the hashtags that only appear in the extended tweet or the
+    retweeted status.
+
+    :param dict tweet: the status
+    """
+    hashtags = []
+    for status in (tweet, tweet.get('retweeted_status') or {}):
+        for entities in (status.get('entities'),
+                         (status.get('extended_tweet') or {}).get('entities')):
+            for hashtag in (entities or {}).get('hashtags', []):
+                text = hashtag.get('text', '').lower()
+                if text and text not in hashtags:
+                    hashtags.append(text)
+
+    return hashtags
+
+
+def enrich_tweet(tweet, matcher=None):
+    """Adding the derived fields to a tweet.
+
+    The sub-document contains the full text, the creation time as a date,
+    the lowercase hashtags, the number of tokens, the matched tracking terms
+    and the first of them.
+
+    :param dict tweet: the status; changed in place
+    :param object matcher: the TermMatcher of the tracking terms, if any
+    :return dict: the sub-document
+    """
+    text = get_full_text(tweet)
+    matched_terms = matcher.match(tweet) if matcher else []
+    enrichment = {
+        'text': text,
+        'created': get_created_date(tweet),
+        'hashtags': get_hashtags(tweet),
+        'tokens': len(text.split()),
+        'term': matched_terms[0] if matched_terms else None,
+        'matched_terms': matched_terms}
+    tweet[ENRICHMENT_FIELD] = enrichment
+
+    return enrichment
+
+
+def has_media(tweet):
+    """Returning whether a tweet or its retweeted status contains media.
+
+    :param dict tweet: the status
+    """
+    for status in (tweet, tweet.get('retweeted_status') or {}):
+        for entities in (status.get('extended_entities'),
+                         status.get('entities'),
+                         (status.get('extended_tweet') or {}).get('entities')):
+            if entities and entities.get('media'):
+                return True
+
+    return False
+
+
+def get_priority(tweet):
+    """Returning the priority of a tweet when tweets have to be shed.
+
+    0: retweets without media, 1: retweets with media, 2: other tweets
+    without media, 3: other tweets with media
+
+    :param dict tweet: the status
+    """
+    priority = 2 if not tweet.get('retweeted_status') else 0
+    if has_media(tweet):
+        priority += 1
+
+    return priority
+
+
+def parse_raw_status(raw_data):
+    """Parsing a raw stream message without building tweepy models.
+
+    Returns the status as a dict, or None if the message is not a status
+    (e.g. limit, delete or disconnect notices).
+
+    :param str raw_data: the raw JSON message received from the stream
+    """
+    data = json_loads(raw_data)
+    if isinstance(data, dict) and 'in_reply_to_status_id' in data:
+        return data
+
+    return None
+
+
+class RecentIdFilter():
+    """Remembering the most recent tweet ids to drop obvious duplicates.
+
+    A bounded LRU set; duplicates older than the last dedup_recent_ids
+    tweets are left to the unique index.
+    """
+
+    def __init__(self, size):
+        """Initialization.
+
+        :param int size: the number of ids to remember
+        """
+        self.size = size
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    def seen(self, tweet_id):
+        """Returning True if the id has been seen before; remembering it.
+
+        :param int tweet_id: the id of the tweet
+        """
+        if self.size <= 0:
+            return False
+
+        with self.lock:
+            if tweet_id in self.ids:
+                self.ids.move_to_end(tweet_id)
+                self.duplicates += 1
+                TWEETS.labels('filtered').inc()
+                return True
+
+            self.ids[tweet_id] = None
+            if len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+            return False
+
+
+class BulkWriter():
+    """Collecting documents and writing them to MongoDB in batches.
+
+    A batch is flushed with an unordered insert_many as soon as it holds
+    mongo_batch_size documents or its oldest document is older than
+    mongo_batch_max_age seconds.
+    """
+
+    # Number of recent receipt-to-commit latencies kept for percentiles
+    LATENCY_SAMPLES = 100000
+
+    def __init__(self, cfg, log, collection=None, on_inserted=None,
+                 on_failed=None):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object log: the TweetPinna logger
+        :param object collection: the MongoDB collection to write to
+        :param function on_inserted: called with the list of inserted documents
+        :param function on_failed: called with the documents of a batch that
+        could not be written and the exception
+        """
+        self.cfg = cfg
+        self.log = log
+        self.collection = collection
+        self.on_inserted = on_inserted
+        self.on_failed = on_failed
+        self.batch_size = max(1, cfg['mongo_batch_size'])
+        self.batch_max_age = cfg['mongo_batch_max_age']
+
+        self.documents = []
+        self.received = []
+        self.batch_started = None
+        self.lock = threading.Lock()
+
+        # Batch number -> the oldest receipt time of a batch being written
+        self.writing = {}
+        self.batch_number = 0
+
+        # Statistics
+        self.flushes = 0
+        self.flushed_documents = 0
+        self.flush_time = 0.0
+        self.flush_time_max = 0.0
+        self.batch_size_max = 0
+        self.duplicates = 0
+        self.commit_latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+
+        self.stopped = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_loop)
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def add(self, document, received=None):
+        """Adding a document to the current batch.
+
+        :param dict document: the document to insert
+        :param float received: the time the document has been received;
+        defaults to now
+        """
+        batch = None
+        now = time.time()
+        with self.lock:
+            if not self.documents:
+                self.batch_started = now
+            self.documents.append(document)
+            self.received.append(received or now)
+            if len(self.documents) >= self.batch_size:
+                batch = self._take_batch()
+
+        if batch:
+            self._write(*batch)
+
+    def flush(self):
+        """Writing the current batch regardless of its size or age."""
+        with self.lock:
+            batch = self._take_batch()
+
+        if batch:
+            self._write(*batch)
+
+    def stop(self):
+        """Stopping the flush thread and writing the remaining documents."""
+        self.stopped.set()
+        self.flush()
+
+    def pending(self):
+        """Returning the number of documents waiting to be written."""
+        return len(self.documents)
+
+    def latency(self):
+        """Returning the receipt-to-commit latency of the last written
+        document in seconds; 0 if nothing was written."""
+        try:
+            return self.commit_latencies[-1]
+        except IndexError:
+            return 0
+
+    def oldest_age(self):
+        """Returning the age in seconds of the oldest document that has not
+        been written yet (in the current batch or being written); 0 if
+        there is none. Unlike the commit latency, it keeps growing while
+        writes stall."""
+        with self.lock:
+            receipts = list(self.writing.values())
+            if self.received:
+                receipts.append(min(self.received))
+
+        if not receipts:
+            return 0
+        return max(0, time.time() - min(receipts))
+
+    def latency_percentiles(self, *percentiles):
+        """Returning percentiles of the receipt-to-commit latency in seconds.
+
+        :param float percentiles: the percentiles, e.g. 50 and 99
+        :return list: one latency per percentile, None if nothing was written
+        """
+        latencies = sorted(self.commit_latencies)
+        if not latencies:
+            return [None for percentile in percentiles]
+
+        return [latencies[min(len(latencies) - 1,
+                              int(len(latencies) * percentile / 100))]
+                for percentile in percentiles]
+
+    def report(self):
+        """Returning a short summary of the flush statistics."""
+        if self.flushes == 0:
+            return 'no batches written yet'
+
+        return '{} batches, avg. {} docs/batch, max. {} docs/batch, ' \
+               'avg. flush {} ms, max. flush {} ms, {} duplicates'.format(
+                   self.flushes,
+                   round(self.flushed_documents / self.flushes, 1),
+                   self.batch_size_max,
+                   round(self.flush_time / self.flushes * 1000, 1),
+                   round(self.flush_time_max * 1000, 1),
+                   self.duplicates)
+
+    def _take_batch(self):
+        """Taking the documents and receipt times of the current batch.
+
+        Must be called while holding the lock.
+        """
+        if not self.documents:
+            return None
+
+        batch = (self.documents, self.received)
+        self.documents = []
+        self.received = []
+        self.batch_started = None
+        return batch
+
+    def _flush_loop(self):
+        """Flushing batches that have grown older than batch_max_age."""
+        interval = max(0.05, self.batch_max_age / 2)
+        while not self.stopped.wait(interval):
+            with self.lock:
+                if (self.batch_started is not None and
+                        time.time() - self.batch_started >= self.batch_max_age):
+                    batch = self._take_batch()
+                else:
+                    batch = None
+
+            if batch:
+                self._write(*batch)
+
+    def _write(self, batch, received):
+        """Writing a batch to MongoDB.
+
+        :param list batch: the documents to insert
+        :param list received: the times the documents have been received
+        """
+        start = time.time()
+        with self.lock:
+            self.batch_number += 1
+            number = self.batch_number
+            self.writing[number] = min(received)
+        try:
+            inserted, duplicates, failed = insert_documents(self.collection,
+                                                            batch)
+            self.duplicates += duplicates
+            TWEETS.labels('duplicate').inc(duplicates)
+            if failed:
+                TWEETS.labels('failed').inc(failed)
+                self.log.log_add(3, 'Could not write {} of {} documents to '
+                                 'MongoDB'.format(failed, len(batch)))
+        except Exception as e:
+            if self.on_failed:
+                self.on_failed(batch, e)
+            else:
+                self.log.log_add(self.cfg['log_email_threshold'],
+                                 'Could not write to MongoDB ({})'.format(e))
+            return
+        finally:
+            with self.lock:
+                del self.writing[number]
+
+        now = time.time()
+        latency = now - start
+        STAGE_SECONDS.labels('write').observe(latency)
+        TWEETS.labels('inserted').inc(len(inserted))
+        for receipt in received:
+            self.commit_latencies.append(now - receipt)
+            COMMIT_LATENCY.observe(now - receipt)
+        self.flushes += 1
+        self.flushed_documents += len(batch)
+        self.flush_time += latency
+        self.flush_time_max = max(self.flush_time_max, latency)
+        self.batch_size_max = max(self.batch_size_max, len(batch))
+
+        if self.on_inserted and inserted:
+            self.on_inserted(inserted)
+
+
+class IngestQueue():
+    """Handing statuses from the stream thread over to a pool of workers.
+
+    The stream thread only enqueues; the workers call the handler. If the
+    queue is full for longer than ingest_queue_timeout seconds, the item is
+    dropped so that the stream socket keeps being read.
+    """
+
+    def __init__(self, cfg, log, handler):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object log: the TweetPinna logger
+        :param function handler: called by the workers for every item
+        """
+        self.cfg = cfg
+        self.log = log
+        self.handler = handler
+        self.timeout = cfg['ingest_queue_timeout']
+        self.queue = queue.Queue(maxsize=cfg['ingest_queue_size'])
+
+        # Statistics
+        self.enqueued = 0
+        self.dropped = 0
+        self.enqueue_wait = 0.0
+        self.enqueue_wait_max = 0.0
+        self.depth_max = 0
+
+        self.workers = []
+        for i in range(max(1, cfg['ingest_workers'])):
+            worker = threading.Thread(target=self._work,
+                                      name='IngestWorker-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, item):
+        """Enqueueing an item. Returns False if it had to be dropped.
+
+        :param object item: the item to hand over to the workers
+        """
+        start = time.time()
+        try:
+            if self.timeout > 0:
+                self.queue.put(item, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            TWEETS.labels('dropped').inc()
+            if self.dropped == 1 or self.dropped % self.cfg['report_steps'] == 0:
+                self.log.log_add(4, '{} Tweets have been dropped because the '
+                                 'ingest queue is full'.format(self.dropped))
+            return False
+        finally:
+            wait = time.time() - start
+            self.enqueue_wait += wait
+            self.enqueue_wait_max = max(self.enqueue_wait_max, wait)
+            STAGE_SECONDS.labels('enqueue').observe(wait)
+
+        self.enqueued += 1
+        TWEETS.labels('enqueued').inc()
+        self.depth_max = max(self.depth_max, self.queue.qsize())
+        return True
+
+    def depth(self):
+        """Returning the number of items waiting in the queue."""
+        return self.queue.qsize()
+
+    def stop(self):
+        """Letting the workers finish the queue and stopping them."""
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def report(self):
+        """Returning a short summary of the queue statistics."""
+        attempts = max(1, self.enqueued + self.dropped)
+        return 'queue depth {} (max. {}), avg. enqueue wait {} ms, ' \
+               'max. enqueue wait {} ms, {} dropped'.format(
+                   self.depth(), self.depth_max,
+                   round(self.enqueue_wait / attempts * 1000, 2),
+                   round(self.enqueue_wait_max * 1000, 2),
+                   self.dropped)
+
+    def _work(self):
+        """Handling items until a None is received."""
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.handler(item)
+            except Exception as e:
+                self.log.log_add(3, 'Ingest worker failed ({})'.format(e))
+            finally:
+                self.queue.task_done()
+
+
+class OverloadPolicy():
+    """Shedding tweets while the ingest pipeline cannot keep up.
+
+    The pipeline is overloaded if the ingest queue is filled beyond
+    overload_queue_fill or the oldest tweet that has not been written yet
+    was received more than overload_write_latency seconds ago. While it is, the shedding level is
+    raised every overload_interval seconds; once both are below half their
+    thresholds, it is lowered the same way until everything is captured
+    again.
+
+    With the 'priority' policy, level n sheds the tweets with a priority
+    below n (see get_priority): first retweets, then retweets with media,
+    then all tweets without media. With 'sample', level n keeps a random
+    1/2^n of all tweets. The shed tweets, and those dropped by a full
+    ingest queue, are counted per minute of their creation.
+    """
+
+    MAX_LEVELS = {'off': 0, 'priority': 3, 'sample': 6}
+
+    def __init__(self, cfg, log, queue_fill, latency):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object log: the TweetPinna logger
+        :param function queue_fill: returns the filled share of the queue
+        :param function latency: returns the age in s of the oldest tweet
+        not yet written, see BulkWriter.oldest_age
+        """
+        self.cfg = cfg
+        self.log = log
+        self.policy = cfg['overload_policy']
+        if self.policy not in self.MAX_LEVELS:
+            log.log_add(3, 'Unknown overload_policy {}, not shedding'.format(
+                self.policy))
+            self.policy = 'off'
+        self.max_level = self.MAX_LEVELS[self.policy]
+        self.queue_fill = queue_fill
+        self.latency = latency
+        self.interval = cfg['overload_interval']
+
+        self.level = 0
+        self.changed = 0
+        self.checked = 0
+        self.lock = threading.Lock()
+
+        # (minute, shed or dropped) -> number of tweets, until taken
+        self.lost_minutes = collections.Counter()
+
+        # Statistics
+        self.shed = 0
+        self.level_max = 0
+
+    def admit(self, document):
+        """Returning whether a tweet is to be captured; counting it if not.
+
+        :param dict document: the status
+        """
+        if self.max_level == 0:
+            return True
+
+        now = time.time()
+        if now - self.checked >= 1:
+            self._adjust(now)
+
+        level = self.level
+        if level == 0:
+            return True
+        if self.policy == 'priority':
+            if get_priority(document) >= level:
+                return True
+        elif random.random() < 1.0 / 2 ** level:
+            return True
+
+        self.shed += 1
+        self._count(document, 'shed')
+        TWEETS.labels('shed').inc()
+        return False
+
+    def dropped(self, document):
+        """Counting a tweet that has been dropped by the full ingest queue.
+
+        :param dict document: the status
+        """
+        self._count(document, 'dropped')
+
+    def take_lost(self):
+        """Returning and resetting the numbers of shed and dropped tweets.
+
+        :return dict: (minute, 'shed' or 'dropped') -> number of tweets
+        """
+        with self.lock:
+            lost_minutes = self.lost_minutes
+            self.lost_minutes = collections.Counter()
+        return lost_minutes
+
+    def report(self):
+        """Returning a short summary of the shedding."""
+        return '{} policy, level {} (max. {}), {} shed'.format(
+            self.policy, self.level, self.level_max, self.shed)
+
+    def _count(self, document, reason):
+        """Counting a lost tweet in the minute of its creation."""
+        created = get_created_date(document) or datetime.datetime.utcnow()
+        with self.lock:
+            self.lost_minutes[(created.replace(second=0, microsecond=0),
+                               reason)] += 1
+
+    def _adjust(self, now):
+        """Raising or lowering the level according to the load."""
+        self.checked = now
+        fill = self.queue_fill()
+        latency = self.latency()
+        overloaded = fill >= self.cfg['overload_queue_fill'] or \
+            latency >= self.cfg['overload_write_latency']
+        recovered = fill < self.cfg['overload_queue_fill'] / 2 and \
+            latency < self.cfg['overload_write_latency'] / 2
+
+        if now - self.changed < self.interval:
+            return
+        if overloaded and self.level < self.max_level:
+            self.level += 1
+            self.level_max = max(self.level_max, self.level)
+            self.log.log_add(4, 'Ingest overloaded (queue {}% full, oldest '
+                             'Tweet {} s), shedding at level {}'.format(
+                                 round(fill * 100), round(latency, 1),
+                                 self.level))
+        elif recovered and self.level > 0:
+            self.level -= 1
+            self.log.log_add(3, 'Ingest recovering, shedding at level {}; '
+                             '{} Tweets shed so far'.format(self.level,
+                                                           self.shed))
+        else:
+            return
+        self.changed = now
+
+
+class MongoConnection():
+    """Owning the MongoDB client and coordinating reconnects.
+
+    There is exactly one client. Once a failure is reported, a single
+    coordinator thread checks the connection with exponential backoff and
+    jitter and calls on_connected after the connection is back.
+    """
+
+    CONNECTED = 'connected'
+    DISCONNECTED = 'disconnected'
+    RECONNECTING = 'reconnecting'
+
+    def __init__(self, cfg, log, on_connected=None):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object log: the TweetPinna logger
+        :param function on_connected: called by the coordinator thread after
+        the connection has been (re)established
+        """
+        self.cfg = cfg
+        self.log = log
+        self.on_connected = on_connected
+        self.backoff = cfg['mongo_reconnect_backoff']
+        self.backoff_max = cfg['mongo_reconnect_backoff_max']
+
+        self.client = MongoClient(cfg['mongo_path'], connectTimeoutMS=500,
+                                  serverSelectionTimeoutMS=500)
+        self.db = self.client[cfg['mongo_db']]
+        self.collection = self.db[cfg['mongo_coll']]
+        self.state = self.DISCONNECTED
+
+        # Statistics
+        self.failures = 0
+        self.reconnects = 0
+
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def connect(self):
+        """Checking whether MongoDB is reachable. Returns True if so."""
+        try:
+            self.client.server_info()
+            self.state = self.CONNECTED
+            return True
+        except Exception:
+            self.state = self.DISCONNECTED
+            return False
+
+    def connected(self):
+        """Returning whether the connection is considered healthy."""
+        return self.state == self.CONNECTED
+
+    def start(self):
+        """Starting the coordinator thread.
+
+        If the connection is already established, on_connected is called
+        once, e.g. to write a buffer left over from a previous run.
+        """
+        if not self.connected():
+            self.lost.set()
+        self.thread = threading.Thread(target=self._run,
+                                       name='MongoReconnect')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stopping the coordinator thread."""
+        self.stopped.set()
+        self.lost.set()
+
+    def report_failure(self, error=None):
+        """Marking the connection as lost. Cheap and safe to call often.
+
+        :param Exception error: the error that has been observed
+        """
+        if self.state == self.CONNECTED:
+            self.failures += 1
+            self.state = self.DISCONNECTED
+            self.log.log_add(3, 'Connection to MongoDB lost ({})'.format(error))
+        self.lost.set()
+
+    def report(self):
+        """Returning a short summary of the connection health."""
+        return 'MongoDB {}, {} failures, {} reconnects'.format(
+            self.state, self.failures, self.reconnects)
+
+    def _run(self):
+        """Reconnecting whenever a failure has been reported."""
+        if self.connected():
+            self._connected()
+
+        while not self.stopped.is_set():
+            self.lost.wait()
+            if self.stopped.is_set():
+                break
+
+            self.state = self.RECONNECTING
+            delay = self.backoff
+            while not self.stopped.is_set():
+                self.lost.clear()
+                if self.connect():
+                    self.reconnects += 1
+                    self.log.log_add(2, 'Connection to MongoDB established')
+                    self._connected()
+                    break
+
+                self.state = self.RECONNECTING
+                # The jitter keeps several instances from reconnecting in sync
+                self.stopped.wait(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, self.backoff_max)
+
+    def _connected(self):
+        """Calling on_connected without letting it kill the coordinator."""
+        if self.on_connected:
+            try:
+                self.on_connected()
+            except Exception as e:
+                self.log.log_add(3, 'Could not handle reconnect ({})'.format(e))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Mail Server.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This script is a local stand-in for an SMTP server. It accepts every
+login and prints the emails it receives instead of delivering them.
+STARTTLS is not supported.
+
+To test the alert emails, set email_server to 'localhost', email_server_port
+to the port of this server and email_starttls to 0.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+
+Example:
+    $ python TweetPinnaMailServer.py 8025
+"""
+
+from email import message_from_bytes
+from socketserver import StreamRequestHandler
+from socketserver import TCPServer
+from socketserver import ThreadingMixIn
+import sys
+import threading
+import time
+
+
+class SMTPHandler(StreamRequestHandler):
+    """Speaking just enough SMTP for smtplib."""
+
+    def reply(self, line):
+        """Sending a reply line."""
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        """Handling the commands of one session."""
+        self.server.sessions += 1
+        self.reply('220 localhost TweetPinna SMTP stand-in')
+        sender = None
+        recipients = []
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'AUTH':
+                if command.upper().startswith('AUTH LOGIN'):
+                    # Username and password
+                    self.reply('334 VXNlcm5hbWU6')
+                    self.rfile.readline()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                sender = command.split(':', 1)[1].strip()
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b'.\r\n', b'.\n'):
+                        break
+                    if data_line.startswith(b'.'):
+                        data_line = data_line[1:]
+                    data.append(data_line)
+                self.server.received(sender, recipients, b''.join(data))
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+
+class MailServer(ThreadingMixIn, TCPServer):
+    """An SMTP server keeping the received emails in memory."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, verbose=False):
+        """Initialization.
+
+        :param tuple address: the host and port to listen on
+        :param bool verbose: printing every received email
+        """
+        TCPServer.__init__(self, address, SMTPHandler)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.messages = []
+        self.sessions = 0
+
+    def received(self, sender, recipients, data):
+        """Storing a received email.
+
+        :param str sender: the envelope sender
+        :param list recipients: the envelope recipients
+        :param bytes data: the email
+        """
+        message = message_from_bytes(data)
+        with self.lock:
+            self.messages.append(message)
+
+        if self.verbose:
+            print('[{}] Email from {} to {} (session {}): {}'.format(
+                time.strftime("%Y-%m-%d %H:%M:%S"), sender,
+                ', '.join(recipients), self.sessions, message['Subject']))
+            print(message.get_payload())
+
+
+if __name__ == '__main__':
+    try:
+        port = int(sys.argv[1])
+    except IndexError:
+        port = 8025
+
+    server = MailServer(('127.0.0.1', port), verbose=True)
+    print('Accepting emails on localhost:{}'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Maintenance.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This script bundles maintenance tasks for existing collections.
+
+Commands:
+    remove-duplicates   removing all but the first copy of every tweet and
+                        creating the unique index on id
+    enrich              adding the derived fields (see enrich_tweet) to
+                        tweets that have been stored without them
+    rebuild-hashtags    recounting the hashtag collection from scratch
+    check-hashtags      comparing the hashtag collection with a full
+                        aggregation of the tweets
+    rebuild-rollups     recounting the per-minute rollups from scratch
+    rebuild-statistics  recounting the running totals of the dashboard
+    rebuild-sample      drawing a new random sample of the stored tweets
+    rebuild-user-summaries
+                        rebuilding the summaries of the tracked users
+    reconcile-media     rebuilding the media manifest from the files in
+                        media_storage
+    users-report        estimating the storage saved by mongo_compact_users
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+
+Example:
+    $ python TweetPinnaMaintenance.py config.cfg remove-duplicates
+    $ python TweetPinnaMaintenance.py config.cfg enrich
+    $ python TweetPinnaMaintenance.py config.cfg rebuild-hashtags
+    $ python TweetPinnaMaintenance.py config.cfg rebuild-rollups
+    $ python TweetPinnaMaintenance.py config.cfg rebuild-statistics
+    $ python TweetPinnaMaintenance.py config.cfg rebuild-sample
+    $ python TweetPinnaMaintenance.py config.cfg rebuild-user-summaries
+    $ python TweetPinnaMaintenance.py config.cfg reconcile-media
+    $ python TweetPinnaMaintenance.py config.cfg users-report
+"""
+
+from pymongo import MongoClient
+from pymongo import UpdateOne
+from TweetPinna import check_config
+from TweetPinna import load_config
+from TweetPinna import Logger
+from TweetPinnaAggregates import HashtagCounter
+from TweetPinnaAggregates import TweetRollups
+from TweetPinnaAggregates import TweetSample
+from TweetPinnaAggregates import TweetStatistics
+from TweetPinnaAggregates import UserSummaries
+from TweetPinnaIngest import enrich_tweet
+from TweetPinnaIngest import ENRICHMENT_FIELD
+from TweetPinnaIngest import ensure_enrichment_indexes
+from TweetPinnaIngest import ensure_indexes
+from TweetPinnaMatcher import TermMatcher
+from TweetPinnaMediaManifest import MediaManifest
+from TweetPinnaUsers import storage_report
+from TweetPinnaUsers import UserStore
+import os
+import sys
+import time
+
+
+def remove_duplicates():
+    """Removing all but the first stored copy of every tweet."""
+    pipeline = [
+        {'$match': {'id': {'$exists': True}}},
+        {'$group': {'_id': '$id', 'count': {'$sum': 1},
+                    'first': {'$min': '$_id'}}},
+        {'$match': {'count': {'$gt': 1}}}]
+
+    removed = 0
+    for duplicate in mongo_coll_tweets.aggregate(pipeline, allowDiskUse=True):
+        removed += mongo_coll_tweets.delete_many(
+            {'id': duplicate['_id'],
+             '_id': {'$ne': duplicate['first']}}).deleted_count
+
+    print('{} duplicates removed'.format(removed))
+    log.log_add(1, 'Maintenance: {} duplicates removed'.format(removed))
+
+    if ensure_indexes(mongo_coll_tweets, log):
+        print('Unique index on id created')
+
+
+def enrich(batch_size=1000):
+    """Adding the derived fields to all tweets that do not have them yet.
+
+    The job can be interrupted and restarted; enriched tweets are skipped.
+    Tweets enriched before the matched terms were recorded are redone.
+
+    :param int batch_size: the number of updates per bulk write
+    """
+    projection = ['text', 'full_text', 'extended_tweet', 'retweeted_status',
+                  'quoted_status', 'entities', 'extended_entities',
+                  'timestamp_ms', 'created_at']
+    matcher = TermMatcher(cfg['twitter_tracking_terms'])
+    tweets = mongo_coll_tweets.find(
+        {ENRICHMENT_FIELD + '.matched_terms': {'$exists': False}},
+        projection, no_cursor_timeout=True)
+
+    enriched = 0
+    updates = []
+    try:
+        for tweet in tweets:
+            updates.append(UpdateOne(
+                {'_id': tweet['_id']},
+                {'$set': {ENRICHMENT_FIELD: enrich_tweet(tweet, matcher)}}))
+            if len(updates) >= batch_size:
+                mongo_coll_tweets.bulk_write(updates, ordered=False)
+                enriched += len(updates)
+                updates = []
+                if enriched % (batch_size * 100) == 0:
+                    print('{} tweets enriched'.format(enriched))
+
+        if updates:
+            mongo_coll_tweets.bulk_write(updates, ordered=False)
+            enriched += len(updates)
+    finally:
+        tweets.close()
+
+    print('{} tweets enriched'.format(enriched))
+    log.log_add(1, 'Maintenance: {} tweets enriched'.format(enriched))
+
+    if ensure_enrichment_indexes(mongo_coll_tweets, log):
+        print('Indexes on {} created'.format(ENRICHMENT_FIELD))
+
+
+def rebuild_hashtags():
+    """Recounting the hashtag collection from the stored tweets."""
+    hashtag_counter = HashtagCounter(
+        mongo_db[HashtagCounter.collection_name(cfg)],
+        mongo_db[TweetStatistics.collection_name(cfg)])
+    hashtag_counter.rebuild(mongo_coll_tweets)
+
+    print('{} hashtags counted'.format(hashtag_counter.number()))
+    log.log_add(1, 'Maintenance: {} hashtags counted'.format(
+        hashtag_counter.number()))
+
+
+def check_hashtags():
+    """Printing the differences between the hashtag collection and the
+    tweets."""
+    hashtag_counter = HashtagCounter(
+        mongo_db[HashtagCounter.collection_name(cfg)])
+    differences = hashtag_counter.check(mongo_coll_tweets)
+
+    print('{} hashtags differ'.format(len(differences)))
+    for hashtag, counted, aggregated in differences[:10]:
+        print('{}: {} counted, {} in the tweets'.format(hashtag, counted,
+                                                        aggregated))
+
+
+def rebuild_rollups():
+    """Recounting the per-minute rollups from the stored tweets."""
+    rollups = TweetRollups(mongo_db[TweetRollups.collection_name(cfg)],
+                           cfg['ingest_rollups_details'] == 1)
+    rollups.rebuild(mongo_coll_tweets)
+
+    print('{} tweets counted'.format(rollups.total()))
+    log.log_add(1, 'Maintenance: {} tweets counted in the rollups'.format(
+        rollups.total()))
+
+
+def rebuild_statistics():
+    """Recounting the running totals from the stored tweets."""
+    tweet_statistics = TweetStatistics(
+        mongo_db[TweetStatistics.collection_name(cfg)])
+    counted = tweet_statistics.rebuild(mongo_coll_tweets)
+
+    print('{} tweets counted'.format(counted))
+    log.log_add(1, 'Maintenance: {} tweets counted in the statistics'.format(
+        counted))
+
+
+def rebuild_sample():
+    """Drawing a new random sample from the stored tweets."""
+    tweet_sample = TweetSample(mongo_db[TweetSample.collection_name(cfg)],
+                               cfg['ingest_sample_size'])
+    sampled = tweet_sample.rebuild(mongo_coll_tweets)
+
+    print('{} of {} tweets sampled'.format(sampled, tweet_sample.seen()))
+    log.log_add(1, 'Maintenance: {} tweets sampled'.format(sampled))
+
+
+def rebuild_user_summaries():
+    """Rebuilding the summaries of the tracked users from the stored
+    tweets."""
+    user_summaries = UserSummaries(
+        mongo_db[UserSummaries.collection_name(cfg)], mongo_coll_tweets,
+        cfg['twitter_tracking_users'])
+    user_summaries.ensure_indexes()
+    counted = user_summaries.rebuild()
+
+    print('{} tweets of {} tracked users counted'.format(
+        counted, len(user_summaries.screen_names)))
+    log.log_add(1, 'Maintenance: {} tweets counted in the user '
+                'summaries'.format(counted))
+
+
+def reconcile_media():
+    """Rebuilding the media manifest and its totals from the disk."""
+    manifest = MediaManifest(mongo_db[MediaManifest.collection_name(cfg)],
+                             mongo_db[TweetStatistics.collection_name(cfg)],
+                             cfg['media_storage'])
+    manifest.ensure_indexes()
+    counts = manifest.reconcile(cfg['media_photo_storage'])
+    totals = manifest.totals()
+
+    print('{} files found: {} added, {} updated, {} removed'.format(
+        counts['found'], counts['added'], counts['updated'],
+        counts['removed']))
+    print('{} files, {} MB'.format(totals['files'],
+                                   round(totals['bytes'] / 1000000, 1)))
+    log.log_add(1, 'Maintenance: media manifest reconciled ({} files, {} '
+                'added, {} updated, {} removed)'.format(
+                    counts['found'], counts['added'], counts['updated'],
+                    counts['removed']))
+
+
+def users_report():
+    """Printing the storage saved by the compact user storage."""
+    report = storage_report(mongo_coll_tweets,
+                            mongo_db[UserStore.collection_name(cfg)])
+
+    print('Tweets:                {}'.format(report['tweets']))
+    print('Compacted (sample):    {}%'.format(
+        round(report['compacted_share'] * 100, 1)))
+    print('Avg. stored size:      {} bytes'.format(
+        round(report['avg_stored_size'])))
+    print('Avg. full size:        {} bytes'.format(
+        round(report['avg_full_size'])))
+    print('User snapshots:        {} ({} MB)'.format(
+        report['snapshots'], round(report['users_size'] / 1000000, 1)))
+    print('Saved (estimated):     {} MB, {} MB net'.format(
+        round(report['saved'] / 1000000, 1),
+        round(report['net_saved'] / 1000000, 1)))
+
+
+commands = {
+    'remove-duplicates': remove_duplicates,
+    'enrich': enrich,
+    'rebuild-hashtags': rebuild_hashtags,
+    'check-hashtags': check_hashtags,
+    'rebuild-rollups': rebuild_rollups,
+    'rebuild-statistics': rebuild_statistics,
+    'rebuild-sample': rebuild_sample,
+    'rebuild-user-summaries': rebuild_user_summaries,
+    'reconcile-media': reconcile_media,
+    'users-report': users_report,
+}
+
+
+if __name__ == '__main__':
+    # Config
+    try:
+        if os.path.isfile(sys.argv[1]):
+            if check_config(sys.argv[1]):
+                cfg = load_config(sys.argv[1])
+                log = Logger(cfg)
+            else:
+                print('Configuration appears to be faulty')
+                sys.exit(1)
+        else:
+            print('Configuration file {} could not be found'.
+                  format(sys.argv[1]))
+            sys.exit(1)
+    except IndexError:
+        print('Using default configuration')
+        cfg = load_config('cfg/TweetPinnaDefault.cfg')
+        log = Logger(cfg)
+
+    try:
+        command = commands[sys.argv[2]]
+    except (IndexError, KeyError):
+        print('Available commands: {}'.format(', '.join(sorted(commands))))
+        sys.exit(1)
+
+    # MongoDB
+    mongo_client = MongoClient(cfg['mongo_path'])
+    mongo_db = mongo_client[cfg['mongo_db']]
+    mongo_coll_tweets = mongo_db[cfg['mongo_coll']]
+
+    start = time.time()
+    command()
+    print('Finished in {} s'.format(round(time.time() - start, 1)))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Matcher.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module finds the tracking terms a tweet has matched. All words of all
+terms are searched in a single pass over the tweet (Aho-Corasick), so the
+cost grows with the length of the tweet, not with the number of terms.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from TweetPinnaIngest import get_full_text
+import collections
+
+# The C implementation is used if it is installed
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+def get_searchable_text(tweet):
+    """Returning the parts of a tweet Twitter matches tracking terms against.
+
+    These are the full text, the hashtags, the mentioned screen names and
+    the expanded and display URLs of the tweet and its retweeted or quoted
+    status, one per line.
+
+    :param dict tweet: the status
+    """
+    parts = [get_full_text(tweet)]
+    statuses = [tweet]
+    for key in ('retweeted_status', 'quoted_status'):
+        if tweet.get(key):
+            statuses.append(tweet[key])
+    if tweet.get('quoted_status'):
+        parts.append(get_full_text(tweet['quoted_status']))
+
+    for status in statuses:
+        for entities in (status.get('entities'),
+                         status.get('extended_entities'),
+                         (status.get('extended_tweet') or {}).get('entities')):
+            if not entities:
+                continue
+            for hashtag in entities.get('hashtags') or []:
+                parts.append('#' + hashtag.get('text', ''))
+            for mention in entities.get('user_mentions') or []:
+                parts.append('@' + mention.get('screen_name', ''))
+            for url in (entities.get('urls') or []) + \
+                    (entities.get('media') or []):
+                parts.append(url.get('expanded_url') or '')
+                parts.append(url.get('display_url') or '')
+
+    return '\n'.join(parts)
+
+
+def is_word_character(character):
+    """Returning whether a character continues a word (letter, digit, _)."""
+    return character.isalnum() or character == '_'
+
+
+class TermMatcher():
+    """Matching tweets against all tracking terms at once.
+
+    Like the track parameter of the streaming API, a term matches if all of
+    its words appear in the tweet, in any order and regardless of case. A
+    word has to stand on its own: 'vote' matches 'Vote!', '#vote' and
+    '@vote', but not 'voter'. Punctuation within a word is part of it, e.g.
+    '#vote' matches only the hashtag.
+
+    The matcher is built once; matching takes a number of steps linear in
+    the length of the tweet, not in the number of terms.
+    """
+
+    def __init__(self, terms):
+        """Initialization.
+
+        :param list terms: the tracking terms
+        """
+        self.terms = list(terms)
+        self.words = []
+
+        # Term number -> the word numbers of the term
+        self.term_words = []
+        word_numbers = {}
+        frequencies = collections.Counter()
+        for term in self.terms:
+            words = set()
+            for word in term.lower().split():
+                if word not in word_numbers:
+                    word_numbers[word] = len(self.words)
+                    self.words.append(word)
+                words.add(word_numbers[word])
+            frequencies.update(words)
+            self.term_words.append(frozenset(words))
+
+        # Word number -> the terms anchored at it. Every term is only
+        # checked if its rarest word has been found, so that common words
+        # shared by many terms do not slow matching down.
+        self.anchored_terms = [[] for word in self.words]
+        for term_number, words in enumerate(self.term_words):
+            if words:
+                anchor = min(words, key=lambda word: frequencies[word])
+                self.anchored_terms[anchor].append(term_number)
+
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for word_number, word in enumerate(self.words):
+                self.automaton.add_word(word, (word_number, len(word)))
+            if self.words:
+                self.automaton.make_automaton()
+        else:
+            self.automaton = None
+            self._build()
+
+    def _build(self):
+        """Building the automaton: a trie of all words with failure links."""
+        transitions = [{}]
+        outputs = [[]]
+        for word_number, word in enumerate(self.words):
+            state = 0
+            for character in word:
+                if character not in transitions[state]:
+                    transitions.append({})
+                    outputs.append([])
+                    transitions[state][character] = len(transitions) - 1
+                state = transitions[state][character]
+            outputs[state].append((word_number, len(word)))
+
+        # The failure link of a state points to the longest proper suffix
+        # that is also in the trie; breadth-first, so that it is complete
+        # before the links of the children are computed
+        failures = [0] * len(transitions)
+        queue = collections.deque(transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, child in transitions[state].items():
+                failure = failures[state]
+                while failure and character not in transitions[failure]:
+                    failure = failures[failure]
+                failures[child] = transitions[failure].get(character, 0)
+                outputs[child] = outputs[child] + outputs[failures[child]]
+                queue.append(child)
+
+        self.transitions = transitions
+        self.failures = failures
+        self.outputs = outputs
+
+    def _find(self, text):
+        """Yielding (word number, length, end index) for every word found.
+
+        :param str text: the lowercase text
+        """
+        if self.automaton is not None:
+            if self.words:
+                for end, (word_number, length) in self.automaton.iter(text):
+                    yield word_number, length, end
+            return
+
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        state = 0
+        for index, character in enumerate(text):
+            # At most as many failure steps as characters in total
+            while state and character not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(character, 0)
+            if outputs[state]:
+                for word_number, length in outputs[state]:
+                    yield word_number, length, index
+
+    def match_text(self, text):
+        """Returning the terms matched by a text, in the configured order.
+
+        :param str text: the text, e.g. from get_searchable_text
+        """
+        text = text.lower()
+        last = len(text) - 1
+
+        found = set()
+        for word_number, length, end in self._find(text):
+            if word_number in found:
+                continue
+            start = end - length + 1
+            # Only standalone words count
+            if start > 0 and is_word_character(text[start - 1]) and \
+                    is_word_character(text[start]):
+                continue
+            if end < last and is_word_character(text[end + 1]) and \
+                    is_word_character(text[end]):
+                continue
+            found.add(word_number)
+
+        matched = []
+        for word_number in found:
+            for term_number in self.anchored_terms[word_number]:
+                if self.term_words[term_number] <= found:
+                    matched.append(term_number)
+
+        return [self.terms[term_number] for term_number in sorted(matched)]
+
+    def match(self, tweet):
+        """Returning the terms a tweet has matched, in the configured order.
+
+        :param dict tweet: the status
+        """
+        return self.match_text(get_searchable_text(tweet))
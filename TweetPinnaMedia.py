@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Media.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module finds and downloads the media files of tweets. It is used by
+the image downloader, the media queue and the dashboard; the configuration
+and the logger are passed in, so importing it has no side effects.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from TweetPinnaAggregates import TweetStatistics
+from TweetPinnaMediaManifest import MediaManifest
+from urllib.parse import urlsplit
+import datetime
+import hashlib
+import mimetypes
+import os.path
+import requests
+import shutil
+
+
+def create_media_directories(cfg):
+    """Creating the media storage directories if they do not exist.
+
+    :param object cfg: the TweetPinna configuration
+    """
+    for directory in (cfg['media_photo_storage'], cfg['media_user_storage']):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+
+def get_file_extension(url):
+    """Getting the extensions (filetype) of an url.
+
+    :param str url: the url to the file
+    """
+    filetype = os.path.splitext(
+        os.path.basename(
+            urlsplit(url).path))[1]
+
+    return filetype
+
+
+def create_media_manifest(cfg, db):
+    """Returning the MediaManifest of an instance, if media_manifest is on.
+
+    :param object cfg: the TweetPinna configuration
+    :param object db: the MongoDB database
+    """
+    if cfg['media_manifest'] != 1:
+        return None
+
+    return MediaManifest(db[MediaManifest.collection_name(cfg)],
+                         db[TweetStatistics.collection_name(cfg)],
+                         cfg['media_storage'])
+
+
+def download_media_file(cfg, log, type, url, filename, filetype='',
+                        copy_to='', manifest=None, tweet_id=None):
+    """Downloading a media file. Returns True if the file is available.
+
+    :param object cfg: the TweetPinna configuration
+    :param object log: the TweetPinna logger
+    :param str type: the type of the file (photo, user-profile-img,
+    user-banner-img, user-bg-img)
+    :param str url: the url to download from
+    :param str filename: the filename to save to
+    :param str filetype: the filytype (optional)
+    :param str copy_to: a folder to which a copy of the file is sent
+    :param object manifest: the MediaManifest recording new files, if any
+    :param int tweet_id: the id of the tweet the file belongs to
+    """
+    if (len(url) > 0):
+        try:
+            if type == 'photo':
+                path = cfg['media_photo_storage'] + filename
+            elif type in (
+                    'user-profile-img', 'user-banner-img', 'user-bg-img'):
+                path = cfg['media_user_storage'] + filename
+            else:
+                return False
+
+            if not os.path.exists(path):
+                r = requests.get(url, stream=True, timeout=30)
+                r.raise_for_status()
+
+                if not filetype:
+                    try:
+                        path = path + mimetypes.guess_extension(
+                            r.headers['content-type'])
+                    except:
+                        path = path + '.unknown'
+
+                # A partial download must not look like a finished file
+                size = 0
+                digest = hashlib.sha1()
+                with open(path + '.part', 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=1024):
+                        if chunk:
+                            f.write(chunk)
+                            size += len(chunk)
+                            digest.update(chunk)
+                os.replace(path + '.part', path)
+
+                if manifest:
+                    try:
+                        manifest.add(path, type, size, digest.hexdigest(),
+                                     tweet_id)
+                    except Exception as e:
+                        log.log_add(3, 'Could not record {} in the media '
+                                    'manifest ({})'.format(filename, e))
+
+            if copy_to:
+                shutil.copy2(path, copy_to)
+
+            return True
+
+        except Exception as e:
+            log.log_add(3, 'Image download failed ({})'.format(e))
+
+    return False
+
+
+def get_media_jobs(cfg, tweet):
+    """Getting the media files of a tweet which should be downloaded.
+
+    :param object cfg: the TweetPinna configuration
+    :param dict tweet: the tweet, including its MongoDB _id
+    :return list: (type, url, filename, filetype) tuples
+    """
+    jobs = []
+    object_id = tweet["_id"]
+
+    try:
+        tweet_timestamp_s = int(tweet["timestamp_ms"]) / 1000
+    except KeyError:
+        # Tweets from timelines do not have a timestamp_ms
+        tweet_timestamp_s = object_id.generation_time.timestamp()
+    tweet_date = datetime.datetime.fromtimestamp(
+        tweet_timestamp_s).strftime('%Y%m%d')
+
+    tweet_id = int(tweet["id"])
+    user_id = tweet["user"]["id"]
+
+    if "profile_image_url" in tweet["user"]:
+        user_profile_image_url = tweet["user"]["profile_image_url"]
+
+        if cfg['media_profile_image_hd'] == 1:
+            user_profile_image_url = user_profile_image_url.replace(
+                'normal', '400x400')
+
+        filetype = get_file_extension(user_profile_image_url)
+        jobs.append(('user-profile-img', user_profile_image_url,
+                     '{}-profile-{}{}'.format(user_id, tweet_date, filetype),
+                     filetype))
+
+    if "profile_banner_url" in tweet["user"]:
+        user_profile_banner_url = tweet["user"]["profile_banner_url"]
+        filetype = get_file_extension(user_profile_banner_url)
+        jobs.append(('user-banner-img', user_profile_banner_url,
+                     '{}-banner-{}{}'.format(user_id, tweet_date, filetype),
+                     filetype))
+
+    if "profile_background_image_url" in tweet["user"]:
+        user_profile_bg_url = tweet["user"]["profile_background_image_url"]
+        filetype = get_file_extension(user_profile_bg_url)
+        jobs.append(('user-bg-img', user_profile_bg_url,
+                     '{}-bg-{}{}'.format(user_id, tweet_date, filetype),
+                     filetype))
+
+    if "media" in tweet["entities"]:
+        for media in tweet["entities"]["media"]:
+            media_id = media["id"]
+            if media["type"] == "photo":
+                photo_url = media["media_url_https"]
+                filetype = get_file_extension(photo_url)
+                jobs.append(('photo', photo_url,
+                             '{0}-{1}-{2}{3}'.format(object_id, tweet_id,
+                                                     media_id, filetype),
+                             filetype))
+
+    return jobs
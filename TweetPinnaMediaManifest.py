@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Media Manifest.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module keeps a manifest of the downloaded media files. Every file is
+recorded with its size, type, tweet or user id and hash when it is stored,
+and running totals are kept, so that the size of the storage does not have
+to be determined by walking it.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from pymongo import UpdateOne
+import collections
+import datetime
+import hashlib
+import os
+import re
+import uuid
+
+# Filenames as chosen by get_media_jobs and the dashboard
+PHOTO_FILENAME = re.compile(r'^[0-9a-f]{24}-(?P<tweet_id>\d+)-\d+')
+USER_FILENAME = re.compile(
+    r'^(?P<user_id>\d+)-(?P<kind>profile|banner|bg)-')
+USER_TYPES = {'profile': 'user-profile-img', 'banner': 'user-banner-img',
+              'bg': 'user-bg-img'}
+
+
+def parse_media_filename(filename):
+    """Returning the type, tweet id and user id encoded in a filename.
+
+    :param str filename: the name of the file, without directories
+    :return tuple: type, tweet id and user id; unknown values are None
+    """
+    match = PHOTO_FILENAME.match(filename)
+    if match:
+        return 'photo', int(match.group('tweet_id')), None
+
+    match = USER_FILENAME.match(filename)
+    if match:
+        return USER_TYPES[match.group('kind')], None, \
+            int(match.group('user_id'))
+
+    return None, None, None
+
+
+def get_file_hash(path):
+    """Returning the SHA-1 of a file.
+
+    :param str path: the path of the file
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaManifest():
+    """Recording the stored media files and their running totals.
+
+    Every file is a document (_id: the path relative to media_storage) in
+    the manifest collection. The totals (files and bytes, overall and per
+    type) are a single document in the statistics collection, so reading
+    them does not depend on the number of files. They are complete once the
+    files stored before the manifest was enabled have been recorded by
+    reconcile (or the storage was empty).
+    """
+
+    TOTALS_ID = 'media'
+
+    # Files looked up and written at once by reconcile
+    BATCH_SIZE = 1000
+
+    def __init__(self, collection, totals_collection, storage):
+        """Initialization.
+
+        :param object collection: the manifest collection
+        :param object totals_collection: the collection of the totals, see
+        TweetStatistics
+        :param str storage: the media_storage directory
+        """
+        self.collection = collection
+        self.totals_collection = totals_collection
+        self.storage = storage
+
+    @staticmethod
+    def collection_name(cfg):
+        """Returning the name of the manifest collection of an instance.
+
+        :param object cfg: the TweetPinna configuration
+        """
+        return '{}_media'.format(cfg['mongo_coll'])
+
+    def ensure_indexes(self):
+        """Creating the indexes used to find the files of a tweet or user.
+
+        An empty storage needs no reconciliation, the totals are marked
+        complete.
+        """
+        self.collection.create_index('tweet_id', background=True)
+        self.collection.create_index('user_id', background=True)
+
+        if not self.complete() and not any(
+                filenames for directory, subdirectories, filenames
+                in os.walk(self.storage)):
+            self.totals_collection.update_one(
+                {'_id': self.TOTALS_ID},
+                {'$set': {'reconciled': datetime.datetime.utcnow()}},
+                upsert=True)
+
+    def complete(self):
+        """Returning whether the totals include all stored files."""
+        return self.totals_collection.find_one(
+            {'_id': self.TOTALS_ID, 'reconciled': {'$exists': True}},
+            {'_id': 1}) is not None
+
+    def get_key(self, path):
+        """Returning the key of a file: its path relative to the storage.
+
+        :param str path: the path of the file
+        """
+        return os.path.relpath(path, self.storage).replace(os.sep, '/')
+
+    def add(self, path, media_type, size, file_hash, tweet_id=None,
+            user_id=None):
+        """Recording a file that has just been stored.
+
+        Ids which are not given are taken from the filename, if possible.
+        Files that are already recorded are not counted again; if they have
+        been replaced (e.g. downloaded again), their size and type are
+        updated in the totals.
+
+        :param str path: the path of the file
+        :param str media_type: photo, user-profile-img, user-banner-img or
+        user-bg-img
+        :param int size: the size in bytes
+        :param str file_hash: the SHA-1 of the file
+        :param int tweet_id: the id of the tweet the file belongs to
+        :param int user_id: the id of the user the file belongs to
+        """
+        parsed_type, parsed_tweet_id, parsed_user_id = parse_media_filename(
+            os.path.basename(path))
+        previous = self.collection.find_one_and_update(
+            {'_id': self.get_key(path)},
+            {'$set': {
+                'type': media_type,
+                'extension': os.path.splitext(path)[1].lower(),
+                'size': size,
+                'hash': file_hash},
+             '$setOnInsert': {
+                'tweet_id': tweet_id or parsed_tweet_id,
+                'user_id': user_id or parsed_user_id,
+                'added': datetime.datetime.utcnow()}},
+            {'size': 1, 'type': 1}, upsert=True)
+
+        increments = collections.Counter()
+        if previous is None:
+            increments['files'] += 1
+            increments['types.{}.files'.format(media_type)] += 1
+        elif previous['type'] != media_type:
+            increments['types.{}.files'.format(previous['type'])] -= 1
+            increments['types.{}.files'.format(media_type)] += 1
+        previous_size = previous['size'] if previous else 0
+        previous_type = previous['type'] if previous else media_type
+        increments['bytes'] += size - previous_size
+        increments['types.{}.bytes'.format(previous_type)] -= previous_size
+        increments['types.{}.bytes'.format(media_type)] += size
+
+        increments = {field: value for field, value in increments.items()
+                      if value}
+        if increments:
+            self.totals_collection.update_one(
+                {'_id': self.TOTALS_ID}, {'$inc': increments}, upsert=True)
+
+    def totals(self):
+        """Returning the number and size of the stored files.
+
+        :return dict: files, bytes and types (type -> files and bytes)
+        """
+        totals = self.totals_collection.find_one({'_id': self.TOTALS_ID}) \
+            or {}
+        return {'files': totals.get('files', 0),
+                'bytes': totals.get('bytes', 0),
+                'types': totals.get('types', {})}
+
+    def reconcile(self, photo_storage=None):
+        """Rebuilding the manifest and the totals from the files on disk.
+
+        New and changed files are hashed and recorded, records of files
+        that no longer exist are removed. Files downloaded meanwhile are
+        kept, but their totals may be off until the next reconciliation.
+
+        :param str photo_storage: the media_photo_storage directory; other
+        files are typed by their names
+        :return dict: the numbers of files found, added, updated and removed
+        """
+        run = uuid.uuid4().hex
+        started = datetime.datetime.utcnow()
+        counts = {'found': 0, 'added': 0, 'updated': 0, 'removed': 0}
+        if photo_storage:
+            photo_storage = os.path.abspath(photo_storage)
+
+        batch = []
+        for directory, subdirectories, filenames in os.walk(self.storage):
+            in_photo_storage = photo_storage and \
+                os.path.abspath(directory).startswith(photo_storage)
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+                path = os.path.join(directory, filename)
+                media_type = parse_media_filename(filename)[0] or \
+                    ('photo' if in_photo_storage else 'other')
+                try:
+                    batch.append((path, media_type, os.path.getsize(path)))
+                except OSError:
+                    continue
+                if len(batch) >= self.BATCH_SIZE:
+                    self._reconcile_batch(batch, run, counts)
+                    batch = []
+        self._reconcile_batch(batch, run, counts)
+
+        counts['removed'] = self.collection.delete_many(
+            {'reconciled': {'$ne': run},
+             'added': {'$lt': started}}).deleted_count
+
+        # Recounting the totals from the manifest
+        totals = {'files': 0, 'bytes': 0, 'types': {},
+                  'reconciled': datetime.datetime.utcnow()}
+        for media_type in self.collection.aggregate([
+                {'$group': {'_id': '$type', 'files': {'$sum': 1},
+                            'bytes': {'$sum': '$size'}}}]):
+            totals['files'] += media_type['files']
+            totals['bytes'] += media_type['bytes']
+            totals['types'][media_type['_id']] = {
+                'files': media_type['files'], 'bytes': media_type['bytes']}
+        self.totals_collection.replace_one({'_id': self.TOTALS_ID}, totals,
+                                           upsert=True)
+
+        return counts
+
+    def _reconcile_batch(self, batch, run, counts):
+        """Recording a batch of files found on disk.
+
+        :param list batch: (path, type, size) tuples
+        :param str run: the id of the reconciliation
+        :param dict counts: the counts of the reconciliation; updated
+        """
+        if not batch:
+            return
+
+        keys = [self.get_key(path) for path, media_type, size in batch]
+        recorded = {document['_id']: document['size'] for document in
+                    self.collection.find({'_id': {'$in': keys}},
+                                         {'size': 1})}
+
+        operations = []
+        for key, (path, media_type, size) in zip(keys, batch):
+            counts['found'] += 1
+            if recorded.get(key) == size:
+                operations.append(UpdateOne({'_id': key},
+                                            {'$set': {'reconciled': run}}))
+                continue
+
+            try:
+                file_hash = get_file_hash(path)
+            except OSError:
+                continue
+            counts['updated' if key in recorded else 'added'] += 1
+            parsed_type, tweet_id, user_id = parse_media_filename(
+                os.path.basename(path))
+            operations.append(UpdateOne(
+                {'_id': key},
+                {'$set': {'type': media_type,
+                          'extension': os.path.splitext(path)[1].lower(),
+                          'size': size,
+                          'hash': file_hash,
+                          'reconciled': run},
+                 '$setOnInsert': {'tweet_id': tweet_id,
+                                  'user_id': user_id,
+                                  'added': datetime.datetime.utcnow()}},
+                upsert=True))
+
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
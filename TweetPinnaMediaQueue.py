@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Media Queue.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module provides a persistent queue of media downloads which is
+processed by a pool of long-lived worker threads.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from TweetPinnaMedia import create_media_directories
+from TweetPinnaMedia import download_media_file
+from TweetPinnaMedia import get_media_jobs
+from TweetPinnaMetrics import registry
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+DOWNLOADS = registry.counter(
+    'tweetpinna_media_downloads_total',
+    'Media download attempts by result (done, retry, failed)', ['result'])
+
+
+class MediaDownloadQueue():
+    """A download queue which is stored in a local SQLite file.
+
+    Jobs are added at ingest with the media urls of a tweet. Workers take
+    pending jobs, retry failed downloads with an increasing delay and keep
+    the status of every job. Jobs that were running when TweetPinna
+    stopped are picked up again on the next start. Finished jobs are deleted
+    after media_queue_retention seconds; the number of jobs per status is
+    kept in memory.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    # Seconds before the first retry; doubled with every further attempt
+    RETRY_DELAY = 60
+
+    # Seconds between deletions of finished jobs
+    PRUNE_INTERVAL = 600
+
+    def __init__(self, cfg, log, manifest=None):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object log: the TweetPinna logger
+        :param object manifest: the MediaManifest recording the downloaded
+        files, if any
+        """
+        self.cfg = cfg
+        self.log = log
+        self.manifest = manifest
+        self.path = cfg['media_queue_path']
+        self.retries = cfg['media_queue_retries']
+        self.retention = cfg['media_queue_retention']
+        self.prune_at = 0
+        create_media_directories(cfg)
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.db = self._connect()
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type TEXT NOT NULL,
+                url TEXT NOT NULL,
+                filename TEXT NOT NULL UNIQUE,
+                filetype TEXT,
+                tweet_id INTEGER,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated REAL)''')
+            self.db.execute('''CREATE INDEX IF NOT EXISTS jobs_status
+                ON jobs (status, next_attempt)''')
+
+            # Jobs which were interrupted by a restart
+            self.db.execute('UPDATE jobs SET status = ? WHERE status = ?',
+                            (self.PENDING, self.RUNNING))
+            self.status_counts = collections.Counter(dict(self.db.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status')))
+
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.workers = []
+        for i in range(max(1, cfg['media_queue_workers'])):
+            worker = threading.Thread(target=self._work,
+                                      name='MediaWorker-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def add_tweets(self, tweets):
+        """Adding the media files of tweets to the queue.
+
+        :param list tweets: the inserted tweets, including their _id
+        """
+        jobs = []
+        for tweet in tweets:
+            try:
+                for job in get_media_jobs(self.cfg, tweet):
+                    jobs.append(job + (tweet['id'],))
+            except Exception as e:
+                self.log.log_add(3, 'Could not queue media files ({})'.
+                                 format(e))
+
+        if jobs:
+            now = time.time()
+            with self.lock, self.db:
+                # A file which is already queued (e.g. a profile picture of
+                # the same day) is not queued twice
+                added = self.db.executemany(
+                    '''INSERT OR IGNORE INTO jobs (type, url, filename,
+                    filetype, tweet_id, status, updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    [job + (self.PENDING, now) for job in jobs]).rowcount
+                self.status_counts[self.PENDING] += added
+            self.wakeup.set()
+
+    def stop(self):
+        """Stopping the workers after their current download."""
+        self.stopped.set()
+        self.wakeup.set()
+
+    def counts(self):
+        """Returning the number of jobs per status."""
+        with self.lock:
+            return dict(self.status_counts)
+
+    def report(self):
+        """Returning a short summary of the queue."""
+        counts = self.counts()
+        return 'media queue {} pending, {} running, {} done, {} failed'.format(
+            counts.get(self.PENDING, 0), counts.get(self.RUNNING, 0),
+            counts.get(self.DONE, 0), counts.get(self.FAILED, 0))
+
+    def _connect(self):
+        """Opening a connection to the queue file."""
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def _claim(self):
+        """Taking the next due job and marking it as running."""
+        now = time.time()
+        with self.lock, self.db:
+            job = self.db.execute(
+                '''SELECT id, type, url, filename, filetype, tweet_id, attempts
+                FROM jobs WHERE status = ? AND next_attempt <= ?
+                ORDER BY id LIMIT 1''', (self.PENDING, now)).fetchone()
+            if job:
+                self.db.execute(
+                    '''UPDATE jobs SET status = ?, attempts = attempts + 1,
+                    updated = ? WHERE id = ?''', (self.RUNNING, now, job[0]))
+                self.status_counts[self.PENDING] -= 1
+                self.status_counts[self.RUNNING] += 1
+            return job
+
+    def _finish(self, job_id, attempts, success, error=None):
+        """Storing the result of a download."""
+        now = time.time()
+        with self.lock, self.db:
+            if success:
+                status = self.DONE
+                self.db.execute(
+                    '''UPDATE jobs SET status = ?, last_error = NULL,
+                    updated = ? WHERE id = ?''', (status, now, job_id))
+                DOWNLOADS.labels('done').inc()
+            elif attempts < self.retries:
+                status = self.PENDING
+                delay = self.RETRY_DELAY * 2 ** (attempts - 1)
+                self.db.execute(
+                    '''UPDATE jobs SET status = ?, next_attempt = ?,
+                    last_error = ?, updated = ? WHERE id = ?''',
+                    (status, now + delay, error, now, job_id))
+                DOWNLOADS.labels('retry').inc()
+            else:
+                status = self.FAILED
+                self.db.execute(
+                    '''UPDATE jobs SET status = ?, last_error = ?, updated = ?
+                    WHERE id = ?''', (status, error, now, job_id))
+                DOWNLOADS.labels('failed').inc()
+            self.status_counts[self.RUNNING] -= 1
+            self.status_counts[status] += 1
+
+    def _prune(self):
+        """Deleting the jobs which have been done for longer than
+        media_queue_retention seconds.
+
+        A file queued again after its job has been deleted is not downloaded
+        twice, since existing files are skipped.
+        """
+        now = time.time()
+        if now < self.prune_at:
+            return
+
+        self.prune_at = now + self.PRUNE_INTERVAL
+        with self.lock, self.db:
+            deleted = self.db.execute(
+                'DELETE FROM jobs WHERE status = ? AND updated < ?',
+                (self.DONE, now - self.retention)).rowcount
+            self.status_counts[self.DONE] -= deleted
+
+    def _work(self):
+        """Downloading jobs until the queue is stopped."""
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            try:
+                self._prune()
+                job = self._claim()
+            except sqlite3.Error as e:
+                self.log.log_add(3, 'Media queue error ({})'.format(e))
+                job = None
+
+            if job is None:
+                # Waiting for new jobs or for a retry to become due
+                self.wakeup.wait(self.RETRY_DELAY / 4)
+                continue
+
+            job_id, media_type, url, filename, filetype, tweet_id, \
+                attempts = job
+            try:
+                success = download_media_file(
+                    self.cfg, self.log, media_type, url, filename, filetype,
+                    manifest=self.manifest, tweet_id=tweet_id)
+                error = None if success else 'download failed'
+            except Exception as e:
+                success = False
+                error = str(e)
+
+            try:
+                self._finish(job_id, attempts + 1, success, error)
+            except sqlite3.Error as e:
+                self.log.log_add(3, 'Media queue error ({})'.format(e))
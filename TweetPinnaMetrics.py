@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Metrics.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module provides counters, gauges and latency histograms which are
+exposed in the Prometheus text format over HTTP.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+import bisect
+import threading
+
+# Upper bounds (seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    """Formatting a sample value for the text format."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(labels):
+    """Formatting a list of (name, value) pairs as a label set."""
+    if not labels:
+        return ''
+
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        escaped.append('{}="{}"'.format(name, value.replace('\n', '\\n')))
+    return '{' + ','.join(escaped) + '}'
+
+
+class CounterValue():
+    """A value that only goes up."""
+
+    def __init__(self):
+        """Initialization."""
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increasing the counter.
+
+        :param float amount: the amount to add
+        """
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        """Returning the (suffix, labels, value) samples."""
+        return [('', [], self.value)]
+
+
+class GaugeValue():
+    """A value that can go up and down or is read from a function."""
+
+    def __init__(self):
+        """Initialization."""
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        """Setting the gauge.
+
+        :param float value: the current value
+        """
+        self.value = value
+
+    def inc(self, amount=1):
+        """Increasing the gauge.
+
+        :param float amount: the amount to add
+        """
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        """Decreasing the gauge.
+
+        :param float amount: the amount to subtract
+        """
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Reading the value from a function whenever it is exposed.
+
+        :param function function: returns the current value
+        """
+        self.function = function
+
+    def samples(self):
+        """Returning the (suffix, labels, value) samples."""
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                return []
+        return [('', [], value)]
+
+
+class HistogramValue():
+    """Counting observations in cumulative buckets."""
+
+    def __init__(self, buckets):
+        """Initialization.
+
+        :param tuple buckets: the sorted upper bounds of the buckets
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Adding an observation.
+
+        :param float value: the observed value, e.g. a duration in seconds
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        """Returning the (suffix, labels, value) samples."""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', [('le', format_value(float(bound)))],
+                            cumulative))
+        samples.append(('_sum', [], total))
+        samples.append(('_count', [], cumulative))
+        return samples
+
+
+class Metric():
+    """A metric with an optional set of labels.
+
+    Without labels, the methods of the value (inc, set, observe, ...) can be
+    called on the metric itself; otherwise on labels(...).
+    """
+
+    def __init__(self, name, documentation, metric_type, value_factory,
+                 labelnames=()):
+        """Initialization.
+
+        :param str name: the metric name
+        :param str documentation: the help text
+        :param str metric_type: counter, gauge or histogram
+        :param function value_factory: creates the value of a label set
+        :param tuple labelnames: the names of the labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.value_factory = value_factory
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        """Returning the value of a label set, creating it if necessary.
+
+        :param str labelvalues: one value per label name
+        """
+        key = tuple(str(value) for value in labelvalues)
+        value = self.values.get(key)
+        if value is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError('{} expects the labels {}'.format(
+                    self.name, ', '.join(self.labelnames)))
+            with self.lock:
+                value = self.values.setdefault(key, self.value_factory())
+        return value
+
+    def __getattr__(self, attribute):
+        """Delegating to the value of a metric without labels."""
+        if attribute in ('inc', 'dec', 'set', 'set_function', 'observe') \
+                and not self.labelnames:
+            return getattr(self.labels(), attribute)
+        raise AttributeError(attribute)
+
+    def expose(self):
+        """Returning the metric in the text format; '' if it has no values."""
+        with self.lock:
+            values = sorted(self.values.items())
+        if not values:
+            return ''
+
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for key, value in values:
+            labels = list(zip(self.labelnames, key))
+            for suffix, extra_labels, sample in value.samples():
+                lines.append('{}{}{} {}'.format(
+                    self.name, suffix, format_labels(labels + extra_labels),
+                    format_value(sample)))
+        return '\n'.join(lines)
+
+
+class MetricsRegistry():
+    """Keeping all metrics of a process.
+
+    Metrics are created on first use; asking for an existing name returns
+    the existing metric, so that modules can declare what they use.
+    """
+
+    def __init__(self):
+        """Initialization."""
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        """Returning a counter.
+
+        :param str name: the metric name, ending in _total
+        :param str documentation: the help text
+        :param tuple labelnames: the names of the labels
+        """
+        return self._get(name, documentation, 'counter', CounterValue,
+                         labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Returning a gauge.
+
+        :param str name: the metric name
+        :param str documentation: the help text
+        :param tuple labelnames: the names of the labels
+        """
+        return self._get(name, documentation, 'gauge', GaugeValue, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        """Returning a histogram.
+
+        :param str name: the metric name
+        :param str documentation: the help text
+        :param tuple labelnames: the names of the labels
+        :param tuple buckets: the upper bounds of the buckets
+        """
+        buckets = tuple(sorted(buckets))
+        return self._get(name, documentation, 'histogram',
+                         lambda: HistogramValue(buckets), labelnames)
+
+    def expose(self):
+        """Returning all metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        exposed = [metric.expose() for name, metric in metrics]
+        return ''.join(text + '\n' for text in exposed if text)
+
+    def _get(self, name, documentation, metric_type, value_factory,
+             labelnames):
+        """Returning an existing metric or registering a new one."""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = Metric(name, documentation, metric_type,
+                                value_factory, labelnames)
+                self.metrics[name] = metric
+            elif metric.type != metric_type:
+                raise ValueError('{} is already registered as a {}'.format(
+                    name, metric.type))
+            return metric
+
+
+# The metrics of this process
+registry = MetricsRegistry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answering GET /metrics."""
+
+    def do_GET(self):
+        """Returning the metrics of the registry."""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Not logging scrapes."""
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """A lightweight HTTP server exposing a registry on a daemon thread."""
+
+    daemon_threads = True
+
+    def __init__(self, registry, host, port):
+        """Initialization.
+
+        :param object registry: the MetricsRegistry to expose
+        :param str host: the address to listen on
+        :param int port: the port to listen on
+        """
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.registry = registry
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='MetricsServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stopping the server."""
+        self.shutdown()
+        self.server_close()
@@ -19,9 +19,14 @@ Example:
 
 from pymongo import MongoClient
 from TweetPinna import check_config
+from TweetPinna import load_config
 from TweetPinna import Logger
+from TweetPinnaAggregates import Aggregates
+from TweetPinnaIngest import enrich_tweet
+from TweetPinnaIngest import ensure_indexes
+from TweetPinnaIngest import insert_documents
+from TweetPinnaUsers import UserStore
 import tweepy
-import config
 import os
 import sys
 import time
@@ -42,15 +47,25 @@ def get_replies(user_name, tweet_id):
 
 
 def store_tweets(status_objects):
+    """Storing tweets; tweets which are already stored are skipped."""
     insert_ids = []
 
-    for tweet in status_objects:
-        try:
-            if mongo_coll_tweets.find({'id': tweet._json["id"]}).count() == 0:
-                insert = mongo_coll_tweets.insert_one(tweet._json)
-                insert_ids.append(insert.inserted_id)
-        except Exception as e:
-            log.log_add(3, f'Could not store tweet {e}')
+    try:
+        documents = [tweet._json for tweet in status_objects]
+        if cfg['ingest_enrich'] == 1:
+            for document in documents:
+                enrich_tweet(document)
+        if users:
+            for document in documents:
+                users.compact(document)
+        inserted, duplicates, failed = insert_documents(
+            mongo_coll_tweets, documents, not unique_ids)
+        if users:
+            users.flush()
+        insert_ids = [document['_id'] for document in inserted]
+        aggregates.update(inserted, 'replies')
+    except Exception as e:
+        log.log_add(3, f'Could not store tweet {e}')
 
     return insert_ids
 
@@ -60,7 +75,7 @@ if __name__ == '__main__':
     try:
         if os.path.isfile(sys.argv[1]):
             if check_config(sys.argv[1]):
-                cfg = config.Config(open(sys.argv[1], 'r'))
+                cfg = load_config(sys.argv[1])
                 log = Logger(cfg)
             else:
                 print ('Configuration appears to be faulty')
@@ -71,7 +86,7 @@ if __name__ == '__main__':
             sys.exit(1)
     except IndexError:
         print ('Using default configuration')
-        cfg = config.Config(open('cfg/TweetPinnaDefault.cfg', 'r'))
+        cfg = load_config('cfg/TweetPinnaDefault.cfg')
         log = Logger(cfg)
 
     # TweetPinna
@@ -104,6 +119,16 @@ if __name__ == '__main__':
                     format(cfg['instance_name']))
         sys.exit(1)
 
+    # Replies which are already stored are rejected by the unique index on id
+    # or, while it cannot be created, looked up before they are inserted
+    unique_ids = ensure_indexes(mongo_coll_tweets, log)
+    aggregates = Aggregates(cfg, mongo_db)
+    aggregates.ensure_indexes()
+    users = None
+    if cfg['mongo_compact_users'] == 1:
+        users = UserStore(mongo_db[UserStore.collection_name(cfg)])
+        users.ensure_indexes()
+
     # Looping over collected tweets
     if sys.argv[1]:
         lim = int(sys.argv[2])
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Spool.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module provides the disk-backed tweet buffer that is used while
+MongoDB is unavailable.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from bson import json_util
+from bson.objectid import ObjectId
+from TweetPinnaIngest import insert_documents
+from TweetPinnaIngest import STAGE_SECONDS
+from TweetPinnaIngest import TWEETS
+import json
+import os
+import threading
+import time
+
+
+class TweetSpool():
+    """An append-only, segment-rotated write-ahead spool on local disk.
+
+    Every document is stored as one line of compact JSON. Segments are
+    replayed in order; after each written batch the position is saved as a
+    checkpoint so that a replay can resume after a crash. Documents receive
+    a new _id when they are replayed, so that they are ordered after the
+    tweets written meanwhile (see TweetStatistics). Replaying a batch twice
+    only results in duplicate key errors on the unique index on id, which
+    are ignored.
+    """
+
+    def __init__(self, cfg, log, name):
+        """Initialization.
+
+        :param object cfg: the TweetPinna configuration
+        :param object log: the TweetPinna logger
+        :param str name: the name of the spool (a subfolder of tweet_spool_dir)
+        """
+        self.cfg = cfg
+        self.log = log
+        self.path = os.path.join(cfg['tweet_spool_dir'], name)
+        self.segment_size = cfg['tweet_spool_segment_size'] * 1000000
+        self.max_size = cfg['tweet_spool_max_size'] * 1000000
+        self.batch_size = max(1, cfg['mongo_batch_size'])
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.lock = threading.Lock()
+        self.replay_lock = threading.Lock()
+        self.file = None
+        self.file_size = 0
+        self.checkpoint = self._load_checkpoint()
+
+        # New segments are always numbered above the checkpoint, so that a
+        # stale checkpoint offset can never apply to them
+        segments = self._segments()
+        self.next_segment = max(segments[-1] + 1 if segments else 0,
+                                self.checkpoint['segment'] + 1)
+        self.size = sum(os.path.getsize(self._segment_path(number))
+                        for number in segments)
+        self.has_pending = len(segments) > 0
+
+        # Statistics
+        self.spooled = 0
+        self.dropped = 0
+        self.replayed = 0
+
+        if self.has_pending:
+            self.log.log_add(3, 'Spool contains {} MB from a previous run'.
+                             format(round(self.size / 1000000, 2)))
+
+    def append(self, documents):
+        """Appending documents to the spool.
+
+        :param list documents: the documents to spool
+        """
+        start = time.time()
+        with self.lock:
+            for document in documents:
+                line = json_util.dumps(document, separators=(',', ':'))
+                line = (line + '\n').encode('utf-8')
+
+                if self.max_size and self.size + len(line) > self.max_size:
+                    self.dropped += 1
+                    TWEETS.labels('spool_dropped').inc()
+                    if self.dropped == 1 or \
+                            self.dropped % self.cfg['report_steps'] == 0:
+                        self.log.log_add(self.cfg['log_email_threshold'],
+                                         'Spool is full, {} Tweets have been '
+                                         'dropped'.format(self.dropped))
+                    continue
+
+                if self.file is None or self.file_size >= self.segment_size:
+                    self._open_segment()
+
+                self.file.write(line)
+                self.file_size += len(line)
+                self.size += len(line)
+                self.spooled += 1
+                TWEETS.labels('spooled').inc()
+                self.has_pending = True
+
+            if self.file is not None:
+                self.file.flush()
+
+        STAGE_SECONDS.labels('spool').observe(time.time() - start)
+
+    def pending(self):
+        """Returning whether there are spooled documents to replay."""
+        return self.has_pending
+
+    def replaying(self):
+        """Returning whether a replay is currently running."""
+        return self.replay_lock.locked()
+
+    def replay(self, collection, on_inserted=None):
+        """Writing all spooled documents to MongoDB using bulk inserts.
+
+        Returns True if the spool has been emptied. Only one replay runs at
+        a time; further calls return False immediately.
+
+        :param object collection: the MongoDB collection to write to
+        :param function on_inserted: called with every written batch
+        """
+        if not self.replay_lock.acquire(blocking=False):
+            return False
+
+        start = time.time()
+        replayed_before = self.replayed
+        try:
+            while True:
+                # Closing the active segment, new documents go to a new one
+                with self.lock:
+                    self._close_segment()
+                    segments = self._segments()
+                    if not segments:
+                        self.has_pending = False
+                        break
+
+                for number in segments:
+                    self._replay_segment(number, collection, on_inserted)
+
+            replayed = self.replayed - replayed_before
+            duration = max(time.time() - start, 0.001)
+            self.log.log_add(3, 'Spool replayed: {} Tweets in {} s ({} Tweets/s)'.
+                             format(replayed, round(duration, 1),
+                                    round(replayed / duration)))
+            return True
+        except Exception as e:
+            replayed = self.replayed - replayed_before
+            self.log.log_add(3, 'Spool replay interrupted after {} Tweets ({})'.
+                             format(replayed, e))
+            return False
+        finally:
+            self.replay_lock.release()
+
+    def report(self):
+        """Returning a short summary of the spool statistics."""
+        return 'spool {} MB, {} spooled, {} replayed, {} dropped'.format(
+            round(self.size / 1000000, 2), self.spooled, self.replayed,
+            self.dropped)
+
+    def _replay_segment(self, number, collection, on_inserted):
+        """Replaying a single segment, starting at the checkpoint.
+
+        :param int number: the segment number
+        :param object collection: the MongoDB collection to write to
+        :param function on_inserted: called with every written batch
+        """
+        path = self._segment_path(number)
+        offset = 0
+        if self.checkpoint['segment'] == number:
+            offset = self.checkpoint['offset']
+
+        with open(path, 'rb') as segment:
+            segment.seek(offset)
+            eof = False
+            while not eof:
+                batch = []
+                while len(batch) < self.batch_size:
+                    line = segment.readline()
+                    if not line:
+                        eof = True
+                        break
+                    try:
+                        document = json_util.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # A partially written line, e.g. after a crash
+                        self.log.log_add(3, 'Skipped a corrupt spool entry')
+                        continue
+                    document['_id'] = ObjectId()
+                    batch.append(document)
+
+                if not batch:
+                    continue
+
+                inserted, duplicates, failed = insert_documents(collection,
+                                                                batch)
+                if failed:
+                    self.log.log_add(3, 'Could not replay {} of {} spooled '
+                                     'Tweets'.format(failed, len(batch)))
+                self._save_checkpoint(number, segment.tell())
+                self.replayed += len(batch)
+                TWEETS.labels('replayed').inc(len(batch))
+                if on_inserted and inserted:
+                    on_inserted(inserted)
+
+        size = os.path.getsize(path)
+        os.remove(path)
+        with self.lock:
+            self.size -= size
+        self._save_checkpoint(number + 1, 0)
+
+    def _segments(self):
+        """Returning the numbers of all segments on disk, sorted."""
+        segments = []
+        for filename in os.listdir(self.path):
+            if filename.startswith('segment-') and filename.endswith('.jsonl'):
+                segments.append(int(filename[8:-6]))
+
+        return sorted(segments)
+
+    def _segment_path(self, number):
+        """Returning the path of a segment."""
+        return os.path.join(self.path, 'segment-{:010d}.jsonl'.format(number))
+
+    def _open_segment(self):
+        """Starting a new segment. Must be called while holding the lock."""
+        self._close_segment()
+        self.file = open(self._segment_path(self.next_segment), 'ab')
+        self.file_size = 0
+        self.next_segment += 1
+
+    def _close_segment(self):
+        """Closing the active segment. Must be called while holding the lock."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _load_checkpoint(self):
+        """Loading the replay checkpoint."""
+        try:
+            with open(os.path.join(self.path, 'checkpoint'), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'segment': 0, 'offset': 0}
+
+    def _save_checkpoint(self, segment, offset):
+        """Saving the replay checkpoint atomically."""
+        self.checkpoint = {'segment': segment, 'offset': offset}
+        path = os.path.join(self.path, 'checkpoint')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Stream Server.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This script is a local stand-in for the Twitter streaming API. It replays
+recorded statuses (one JSON document per line, e.g. from mongoexport) or
+synthetic ones with the length-delimited framing used by the streaming API.
+Disconnects and 420/429 responses can be injected.
+
+To point TweetPinna at it, set twitter_stream_host to 'localhost:<port>' and
+twitter_stream_verify to the path of the certificate (or 0).
+
+A certificate can be created with:
+    $ openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=localhost \
+        -addext subjectAltName=DNS:localhost,IP:127.0.0.1 \
+        -keyout key.pem -out cert.pem
+If none is given, a temporary one is created this way.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+
+Example:
+    $ python TweetPinnaStreamServer.py --rate 500 --count 100000
+    $ python TweetPinnaStreamServer.py --file tweets.json --errors 420,429
+"""
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from TweetPinnaBenchmark import generate_tweet
+import argparse
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+
+def create_certificate(directory):
+    """Creating a self-signed certificate for localhost using openssl.
+
+    :param str directory: the directory to store cert.pem and key.pem in
+    :return tuple: the paths of the certificate and the key
+    """
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-days', '30', '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+         '-keyout', keyfile, '-out', certfile],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def synthetic_tweets(count, terms=()):
+    """Yielding synthetic statuses.
+
+    :param int count: the number of statuses; 0 for an endless stream
+    :param list terms: terms of which one is mentioned in every text
+    """
+    number = 0
+    while count == 0 or number < count:
+        yield json.dumps(generate_tweet(number, terms)).encode('utf-8')
+        number += 1
+
+
+def recorded_tweets(path):
+    """Yielding recorded statuses from a file with one JSON object per line.
+
+    The MongoDB _id is removed, TweetPinna assigns a new one.
+
+    :param str path: the path of the file
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            tweet = json.loads(line)
+            tweet.pop('_id', None)
+            yield json.dumps(tweet).encode('utf-8')
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """Answering the streaming requests of Tweepy."""
+
+    # The response has no length, it ends with the connection
+    protocol_version = 'HTTP/1.0'
+
+    def do_POST(self):
+        """Streaming statuses until the source is exhausted."""
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        server = self.server
+
+        error = server.next_error()
+        if error:
+            self.send_response(error)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(b'Exceeded connection limit for user')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        server.connected()
+
+        sent = 0
+        while not server.stopped.is_set():
+            message = server.next_tweet()
+            if message is None:
+                break
+
+            message += b'\r\n'
+            try:
+                self.wfile.write(str(len(message)).encode('ascii') + b'\r\n' +
+                                 message)
+            except (OSError, ValueError):
+                # The client has disconnected, the status is lost
+                return
+            sent += 1
+
+            if server.disconnect_every and sent >= server.disconnect_every:
+                server.log('Disconnecting after {} Tweets'.format(sent))
+                return
+
+        # Like Twitter, keeping the idle connection open with blank lines
+        while not server.stopped.wait(5):
+            try:
+                self.wfile.write(b'\r\n')
+            except (OSError, ValueError):
+                return
+
+    def log_message(self, format, *args):
+        """Logging requests only if the server is verbose."""
+        self.server.log(format % args)
+
+
+class StreamServer(ThreadingMixIn, HTTPServer):
+    """A TLS server replaying statuses at a given rate.
+
+    All connections share one source; after a disconnect, the replay
+    continues with the next status.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, tweets, certfile, keyfile, rate=0,
+                 disconnect_every=0, errors=(), verbose=False):
+        """Initialization.
+
+        :param tuple address: the host and port to listen on
+        :param iterator tweets: the encoded statuses to replay
+        :param str certfile: the path of the TLS certificate
+        :param str keyfile: the path of the TLS key
+        :param float rate: statuses per second; 0 sends as fast as possible
+        :param int disconnect_every: closing each connection after this many
+        statuses; 0 keeps connections open
+        :param list errors: status codes (e.g. 420, 429) to answer the first
+        connection attempts with
+        :param bool verbose: printing requests and events
+        """
+        HTTPServer.__init__(self, address, StreamHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+        self.tweets = iter(tweets)
+        self.rate = rate
+        self.disconnect_every = disconnect_every
+        self.errors = list(errors)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        # Statistics
+        self.connections = 0
+        self.sent = 0
+        self.first_sent = None
+        self.last_sent = None
+        self.exhausted = False
+
+    def next_error(self):
+        """Returning the status code to answer a connection with, if any."""
+        with self.lock:
+            if self.errors:
+                error = self.errors.pop(0)
+                self.log('Answering with {}'.format(error))
+                return error
+        return None
+
+    def connected(self):
+        """Counting an accepted connection."""
+        with self.lock:
+            self.connections += 1
+        self.log('Connection {} accepted'.format(self.connections))
+
+    def next_tweet(self):
+        """Returning the next status once it is due; None if there is none."""
+        with self.lock:
+            try:
+                message = next(self.tweets)
+            except StopIteration:
+                if not self.exhausted:
+                    self.exhausted = True
+                    self.log('All {} Tweets sent'.format(self.sent))
+                return None
+
+            now = time.time()
+            if self.first_sent is None:
+                self.first_sent = now
+            if self.rate > 0:
+                due = self.first_sent + self.sent / self.rate
+                if due > now:
+                    time.sleep(due - now)
+            self.sent += 1
+            self.last_sent = time.time()
+            return message
+
+    def stop(self):
+        """Closing the open connections and stopping the server."""
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+    def log(self, message):
+        """Printing a message if the server is verbose."""
+        if self.verbose:
+            print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), message))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Twitter streaming API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--cert', help='TLS certificate (PEM)')
+    parser.add_argument('--key', help='TLS key (PEM)')
+    parser.add_argument('--file', help='recorded Tweets, one JSON per line')
+    parser.add_argument('--count', type=int, default=0,
+                        help='number of synthetic Tweets; 0 is endless')
+    parser.add_argument('--terms', default='',
+                        help='comma separated terms for synthetic Tweets')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Tweets per second; 0 is unlimited')
+    parser.add_argument('--disconnect-every', type=int, default=0,
+                        help='close each connection after n Tweets')
+    parser.add_argument('--errors', default='',
+                        help='comma separated status codes, e.g. 420,429')
+    args = parser.parse_args()
+
+    if args.cert and args.key:
+        certfile, keyfile = args.cert, args.key
+    else:
+        certfile, keyfile = create_certificate(tempfile.mkdtemp())
+        print('Created a temporary certificate: {}'.format(certfile))
+
+    if args.file:
+        tweets = recorded_tweets(args.file)
+    else:
+        terms = [term for term in args.terms.split(',') if term]
+        tweets = synthetic_tweets(args.count, terms)
+
+    errors = [int(error) for error in args.errors.split(',') if error]
+    server = StreamServer((args.host, args.port), tweets, certfile, keyfile,
+                          rate=args.rate,
+                          disconnect_every=args.disconnect_every,
+                          errors=errors, verbose=True)
+    print('Streaming on https://localhost:{}/1.1/statuses/filter.json'.
+          format(args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
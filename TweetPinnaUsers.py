@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TweetPinna - Twitter Status Archiver - Users.
+
+TweetPinna streams Twitter statuses into a
+MongoDB database based on given search terms.
+It is also capable of retrieving a user's timeline.
+
+This module implements the compact user storage. Instead of the complete
+user object, tweets keep a few frequently used fields and a reference to a
+snapshot of the profile in a separate users collection.
+
+Author: Ingo Kleiber <ingo@kleiber.me> (2019)
+License: MIT
+Version: 1.1.1
+Status: Protoype
+"""
+
+from bson import BSON
+from pymongo import UpdateOne
+import collections
+import datetime
+import hashlib
+import json
+import threading
+
+# The fields kept in the tweet: identity, the per-tweet counters and the
+# images used by the dashboard and the media downloader
+HOT_USER_FIELDS = ('id', 'id_str', 'screen_name', 'name', 'verified',
+                   'followers_count', 'friends_count', 'listed_count',
+                   'favourites_count', 'statuses_count', 'profile_image_url',
+                   'profile_image_url_https', 'profile_banner_url',
+                   'profile_background_image_url')
+
+# The field of the compact user referencing the snapshot
+SNAPSHOT_FIELD = 'snapshot'
+
+
+def get_users(tweet):
+    """Returning the user objects of a tweet and its embedded statuses.
+
+    :param dict tweet: the status
+    :return list: the dicts containing a user object
+    """
+    statuses = []
+    pending = [tweet]
+    while pending:
+        status = pending.pop()
+        if not isinstance(status, dict):
+            continue
+        if isinstance(status.get('user'), dict):
+            statuses.append(status)
+        pending.append(status.get('retweeted_status'))
+        pending.append(status.get('quoted_status'))
+
+    return statuses
+
+
+def get_snapshot_id(user):
+    """Returning the id of the snapshot of a user's profile.
+
+    The id changes whenever a profile field (other than the hot fields)
+    changes.
+
+    :param dict user: the complete user object
+    """
+    profile = {key: value for key, value in user.items()
+               if key not in HOT_USER_FIELDS}
+    digest = hashlib.sha1(json.dumps(profile, sort_keys=True,
+                                     default=str).encode('utf-8'))
+    return '{}-{}'.format(user.get('id'), digest.hexdigest()[:16])
+
+
+class UserStore():
+    """Compacting the users of tweets and keeping their profile snapshots.
+
+    compact replaces the user objects of a tweet before it is written; the
+    new snapshots are written by flush, after the tweets. Snapshots known to
+    be stored are remembered, so that unchanged profiles are not written
+    again. Tweets that are spooled instead of written get their complete
+    user objects back (expand), since the snapshots that have not been
+    written yet only exist in memory.
+    """
+
+    # Number of users whose last snapshot is remembered
+    KNOWN_USERS = 100000
+
+    def __init__(self, collection):
+        """Initialization.
+
+        :param object collection: the users collection
+        """
+        self.collection = collection
+        self.known = collections.OrderedDict()
+        self.pending = {}
+        # Snapshots being written by flush
+        self.writing = {}
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.compacted = 0
+        self.snapshots = 0
+
+    @staticmethod
+    def collection_name(cfg):
+        """Returning the name of the users collection of an instance.
+
+        :param object cfg: the TweetPinna configuration
+        """
+        return '{}_users'.format(cfg['mongo_coll'])
+
+    def ensure_indexes(self):
+        """Creating the index used for the snapshots of a user."""
+        self.collection.create_index('user_id', background=True)
+
+    def compact(self, tweet):
+        """Replacing the user objects of a tweet by compact references.
+
+        :param dict tweet: the status; changed in place
+        """
+        for status in get_users(tweet):
+            user = status['user']
+            if SNAPSHOT_FIELD in user:
+                continue
+
+            snapshot_id = get_snapshot_id(user)
+            with self.lock:
+                if self.known.get(user.get('id')) == snapshot_id:
+                    self.known.move_to_end(user.get('id'))
+                elif snapshot_id not in self.pending:
+                    self.pending[snapshot_id] = {
+                        'user_id': user.get('id'),
+                        'profile': {key: value for key, value in user.items()
+                                    if key not in HOT_USER_FIELDS},
+                        'first_seen': datetime.datetime.utcnow()}
+                self.compacted += 1
+
+            compact = {key: user[key] for key in HOT_USER_FIELDS
+                       if key in user}
+            compact[SNAPSHOT_FIELD] = snapshot_id
+            status['user'] = compact
+
+    def flush(self):
+        """Writing the new snapshots. Raises if they could not be written,
+        they are kept for the next attempt."""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.writing.update(pending)
+        if not pending:
+            return
+
+        try:
+            self.collection.bulk_write(
+                [UpdateOne({'_id': snapshot_id},
+                           {'$setOnInsert': snapshot}, upsert=True)
+                 for snapshot_id, snapshot in pending.items()],
+                ordered=False)
+        except Exception:
+            with self.lock:
+                for snapshot_id, snapshot in pending.items():
+                    self.pending.setdefault(snapshot_id, snapshot)
+                    self.writing.pop(snapshot_id, None)
+            raise
+
+        with self.lock:
+            for snapshot_id, snapshot in pending.items():
+                self.writing.pop(snapshot_id, None)
+                self.known[snapshot['user_id']] = snapshot_id
+                self.known.move_to_end(snapshot['user_id'])
+            while len(self.known) > self.KNOWN_USERS:
+                self.known.popitem(last=False)
+            self.snapshots += len(pending)
+
+    def expand(self, tweets):
+        """Restoring the user objects whose snapshot has not been written.
+
+        Tweets whose snapshots are stored remain compact.
+
+        :param list tweets: the compacted tweets; changed in place
+        :return list: the tweets
+        """
+        with self.lock:
+            for tweet in tweets:
+                for status in get_users(tweet):
+                    snapshot_id = status['user'].get(SNAPSHOT_FIELD)
+                    snapshot = self.pending.get(snapshot_id) or \
+                        self.writing.get(snapshot_id)
+                    if snapshot is None:
+                        continue
+                    user = dict(snapshot['profile'])
+                    user.update(status['user'])
+                    del user[SNAPSHOT_FIELD]
+                    status['user'] = user
+
+        return tweets
+
+    def report(self):
+        """Returning a short summary of the compaction."""
+        return '{} users compacted, {} snapshots written'.format(
+            self.compacted, self.snapshots)
+
+
+def rehydrate(users_collection, tweets):
+    """Restoring the complete user objects of compacted tweets.
+
+    Tweets which are not compacted are returned as they are. Missing
+    snapshots leave the compact user in place.
+
+    :param object users_collection: the users collection
+    :param list tweets: the tweets; changed in place
+    :return list: the tweets
+    """
+    compacted = [status for tweet in tweets if tweet
+                 for status in get_users(tweet)
+                 if SNAPSHOT_FIELD in status['user']]
+    if not compacted:
+        return tweets
+
+    snapshot_ids = list(set(status['user'][SNAPSHOT_FIELD]
+                            for status in compacted))
+    snapshots = {snapshot['_id']: snapshot['profile']
+                 for snapshot in users_collection.find(
+                     {'_id': {'$in': snapshot_ids}}, {'profile': 1})}
+
+    for status in compacted:
+        profile = snapshots.get(status['user'][SNAPSHOT_FIELD])
+        if profile is None:
+            continue
+        user = dict(profile)
+        user.update(status['user'])
+        del user[SNAPSHOT_FIELD]
+        status['user'] = user
+
+    return tweets
+
+
+def storage_report(tweets_collection, users_collection, sample_size=1000):
+    """Estimating the storage saved by the compact user storage.
+
+    The sizes of a sample of tweets are compared with the sizes of the same
+    tweets with the complete user objects.
+
+    :param object tweets_collection: the tweet collection
+    :param object users_collection: the users collection
+    :param int sample_size: the number of tweets to compare
+    :return dict: the report
+    """
+    tweets = tweets_collection.estimated_document_count()
+    sample = list(tweets_collection.aggregate(
+        [{'$sample': {'size': sample_size}}]))
+    stored_size = sum(len(BSON.encode(tweet)) for tweet in sample)
+    compacted = sum(1 for tweet in sample
+                    if any(SNAPSHOT_FIELD in status['user']
+                           for status in get_users(tweet)))
+    rehydrate(users_collection, sample)
+    full_size = sum(len(BSON.encode(tweet)) for tweet in sample)
+
+    sampled = max(1, len(sample))
+    users_size = users_collection.database.command(
+        'collstats', users_collection.name).get('size', 0)
+    saved = int((full_size - stored_size) / sampled * tweets)
+
+    return {
+        'tweets': tweets,
+        'compacted_share': compacted / sampled,
+        'avg_stored_size': stored_size / sampled,
+        'avg_full_size': full_size / sampled,
+        'snapshots': users_collection.estimated_document_count(),
+        'users_size': users_size,
+        'saved': saved,
+        'net_saved': saved - users_size}